@@ -0,0 +1,220 @@
+# benchmarks/benchmark_analysis.py
+"""
+Scaling benchmark for the DESeq2/GSEA analysis stage.
+
+Generates synthetic negative-binomial count matrices and GMT files over a grid of gene and
+sample counts and times the analysis helpers of rsa/util/deseq2.py on them: the DESeq2 fit
+and Wald test, the PCA plot, the clustered heatmap and GSEA prerank. Only the pure analysis
+helpers are called, so nothing is written to the database and no ProjectFiles are created.
+
+Usage (from the repository root):
+    python benchmarks/benchmark_analysis.py
+    python benchmarks/benchmark_analysis.py --genes 1000 5000 --samples 6 24 --output report.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rsp.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+import pydeseq2  # noqa: E402
+from pydeseq2.dds import DeseqDataSet  # noqa: E402
+from pydeseq2.default_inference import DefaultInference  # noqa: E402
+from rsa.util.deseq2 import (  # noqa: E402
+    GSEA_MAX_SIZE, GSEA_MIN_SIZE, create_cluster_heatmap, create_pca_plot, filter_prerank_results,
+    filter_results, fit_deseq2, prefilter_counts, prepare_ranked_list, run_contrast
+)
+from rsa.util.genesets import build_gmt_index, load_gmt_index  # noqa: E402
+from rsa.util.gsea import prerank, write_enrichment_pdf  # noqa: E402
+
+DEFAULT_GENES = [1000, 5000, 20000, 60000]
+DEFAULT_SAMPLES = [6, 24, 96, 200]
+STAGES = ['deseq2', 'pca', 'heatmap', 'gsea']
+
+def make_counts(n_genes, n_samples, seed=0):
+    """
+    Synthetic negative-binomial counts for two equally sized conditions.
+
+    Means are log-normal, dispersions follow the usual 1/mean trend and 10% of the genes are
+    differentially expressed.
+
+    Returns:
+        tuple: Samples x genes counts DataFrame and metadata with a 'condition' column.
+    """
+    rng = np.random.default_rng(seed)
+    base_mean = rng.lognormal(mean=4.0, sigma=1.5, size=n_genes)
+    dispersion = 0.05 + 1.0 / base_mean
+    log2_fold_change = np.zeros(n_genes)
+    de_genes = rng.choice(n_genes, size=n_genes // 10, replace=False)
+    log2_fold_change[de_genes] = rng.normal(0.0, 2.0, size=len(de_genes))
+
+    conditions = np.array(['control'] * (n_samples // 2) + ['treatment'] * (n_samples - n_samples // 2))
+    size_factors = rng.lognormal(mean=0.0, sigma=0.2, size=n_samples)
+    mu = base_mean[None, :] * size_factors[:, None] * np.where(
+        (conditions == 'treatment')[:, None], 2.0 ** log2_fold_change[None, :], 1.0)
+    n = 1.0 / dispersion
+    counts = rng.negative_binomial(n[None, :], n[None, :] / (n[None, :] + mu)).astype(np.int32)
+
+    samples = [f"sample{i + 1}" for i in range(n_samples)]
+    genes = [f"GENE{i + 1:05d}" for i in range(n_genes)]
+    return (pd.DataFrame(counts, index=samples, columns=genes),
+            pd.DataFrame({'condition': conditions}, index=samples))
+
+def make_gmt(gene_symbols, gmt_path, seed=0):
+    """Write a GMT file of random gene sets (15-500 genes) over gene_symbols."""
+    rng = np.random.default_rng(seed)
+    n_sets = max(50, len(gene_symbols) // 20)
+    max_size = min(500, len(gene_symbols))
+    with open(gmt_path, 'w') as f:
+        for i in range(n_sets):
+            members = rng.choice(gene_symbols, size=rng.integers(15, max_size + 1), replace=False)
+            f.write(f"BENCHMARK_SET_{i + 1}\tBS:{i + 1:05d}\t" + '\t'.join(members) + '\n')
+    return gmt_path
+
+def measure(func, *args, trace_memory=True, **kwargs):
+    """
+    Run func, returning (result, seconds, peak traced memory in MB).
+
+    tracemalloc slows allocation-heavy code several-fold, so the timing comes from an untraced
+    call and the peak memory from a second, traced call (None when trace_memory is False).
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = round(time.perf_counter() - start, 3)
+    if not trace_memory:
+        return result, seconds, None
+
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, round(peak / (1024 * 1024), 1)
+
+def fit_and_test(counts, metadata, n_cpus):
+    """Prefilter, fit DESeq2 once and run the Wald test, as run_deseq2 does."""
+    counts, _ = prefilter_counts(counts, metadata)
+    inference = DefaultInference(n_cpus=n_cpus)
+    dds = DeseqDataSet(counts=counts, metadata=metadata, design='condition', inference=inference,
+                       quiet=True, low_memory=True)
+    fit_deseq2(dds, {})
+    gene_mapping = {gene: gene.replace('GENE', 'SYM') for gene in dds.var_names}
+    results_df = run_contrast(dds, inference, ['condition', 'control', 'treatment'], gene_mapping)
+    normed_counts = pd.DataFrame(dds.layers['normed_counts'].T, index=dds.var_names, columns=dds.obs_names)
+    return results_df, normed_counts
+
+def prerank_and_plot(ranked_list, gmt_path, pdf_path):
+    """
+    Run GSEA prerank (numpy engine) and write the combined PDF of the top terms, as
+    run_gsea_library does.
+
+    The gene-set index is compiled next to the GMT file in the work directory rather than in the
+    app's reference cache, so the benchmark leaves nothing behind in rsa/references.
+    """
+    index_path = f"{os.path.splitext(gmt_path)[0]}.npz"
+    build_gmt_index(gmt_path, index_path)
+    # Bypass the per-path memoization: every case rewrites the same index path
+    index = load_gmt_index.__wrapped__(index_path)
+    results = filter_prerank_results(prerank(
+        ranked_list, index, permutations=getattr(settings, 'GSEA_PERMUTATIONS', 1000),
+        min_size=GSEA_MIN_SIZE, max_size=GSEA_MAX_SIZE, seed=42
+    ))
+    write_enrichment_pdf(results, ranked_list, index, pdf_path, top_n=getattr(settings, 'GSEA_PLOT_TOP_N', 20))
+    return results
+
+def run_case(n_genes, n_samples, stages, n_cpus, work_dir, trace_memory=True):
+    """Benchmark every requested stage for one matrix size."""
+    project = SimpleNamespace(id=0, name='benchmark', species='benchmark', pvalue_cutoff=0.05)
+    counts, metadata = make_counts(n_genes, n_samples)
+    rows = []
+
+    def record(stage, seconds, peak_mb, **extra):
+        rows.append({'stage': stage, 'genes': n_genes, 'samples': n_samples,
+                     'seconds': seconds, 'peak_mb': peak_mb, **extra})
+        memory = f"{peak_mb:>9.1f} MB" if peak_mb is not None else ''
+        print(f"{stage:>8}  genes={n_genes:<6} samples={n_samples:<4} {seconds:>9.3f}s  {memory}", flush=True)
+
+    (results_df, normed_counts), seconds, peak_mb = measure(fit_and_test, counts, metadata, n_cpus,
+                                                           trace_memory=trace_memory and 'deseq2' in stages)
+    if 'deseq2' in stages:
+        record('deseq2', seconds, peak_mb, genes_tested=len(results_df))
+
+    if 'pca' in stages:
+        _, seconds, peak_mb = measure(create_pca_plot, counts, metadata,
+                                      os.path.join(work_dir, 'pca_plot.png'), project, trace_memory=trace_memory)
+        record('pca', seconds, peak_mb)
+
+    if 'heatmap' in stages:
+        significant = filter_results(results_df, project.pvalue_cutoff)
+        if significant.empty:
+            print(f"{'heatmap':>8}  genes={n_genes:<6} samples={n_samples:<4} skipped: no significant genes")
+        else:
+            _, seconds, peak_mb = measure(create_cluster_heatmap, normed_counts, significant,
+                                          os.path.join(work_dir, 'heatmap.png'), project, trace_memory=trace_memory)
+            record('heatmap', seconds, peak_mb, genes_plotted=len(significant))
+
+    if 'gsea' in stages:
+        ranked_list = prepare_ranked_list(results_df)
+        gmt_path = make_gmt(ranked_list.index.to_numpy(), os.path.join(work_dir, 'benchmark.gmt'))
+        pdf_path = os.path.join(work_dir, 'gsea_plot.pdf')
+        _, seconds, peak_mb = measure(prerank_and_plot, ranked_list, gmt_path, pdf_path, trace_memory=trace_memory)
+        record('gsea', seconds, peak_mb)
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DESeq2/GSEA analysis stage on synthetic data.")
+    parser.add_argument('--genes', type=int, nargs='+', default=DEFAULT_GENES, help="Gene counts to benchmark")
+    parser.add_argument('--samples', type=int, nargs='+', default=DEFAULT_SAMPLES, help="Sample counts to benchmark")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help="Stages to benchmark")
+    parser.add_argument('--cpus', type=int, default=1, help="Cores for the DESeq2 fit (default: 1)")
+    parser.add_argument('--output', default='benchmark_report.json', help="Path of the JSON report")
+    parser.add_argument('--skip-memory', action='store_true',
+                        help="Skip the traced second run of each stage that measures peak memory")
+    args = parser.parse_args()
+
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'pydeseq2': pydeseq2.__version__,
+        'cpus': args.cpus,
+        'memory_note': 'peak_mb is traced Python/NumPy memory of a second, traced call of each stage',
+        'results': [],
+    }
+    work_dir = tempfile.mkdtemp(prefix='rnaseek_benchmark_')
+    try:
+        for n_genes in args.genes:
+            for n_samples in args.samples:
+                report['results'].extend(run_case(n_genes, n_samples, args.stages, args.cpus, work_dir,
+                                                  trace_memory=not args.skip_memory))
+                # Write after every case so a long grid leaves a usable partial report
+                with open(args.output, 'w') as f:
+                    json.dump(report, f, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"Benchmark report written to {args.output}")
+
+if __name__ == '__main__':
+    main()
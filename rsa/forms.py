@@ -71,6 +71,18 @@ class RNAseekForm(forms.Form):
             'class': 'mt-1 block w-full px-4 py-3 border border-gray-300 rounded-lg shadow-sm focus:ring-emerald-500 focus:border-emerald-500 sm:text-sm transition-all duration-300'
         })
     )
+    enrichment_mode = forms.ChoiceField(
+        choices=[
+            ('gsea', 'GSEA (ranked, permutation-based)'),
+            ('ora', 'Over-representation (fast, significant genes only)')
+        ],
+        required=False,
+        label="Enrichment Analysis",
+        initial='gsea',
+        widget=forms.RadioSelect(attrs={
+            'class': 'h-4 w-4 text-emerald-600 border-gray-300 focus:ring-emerald-500'
+        })
+    )
     files = MultipleFileField(
         required=False,
         label="Upload Files",
@@ -142,23 +154,13 @@ class RNAseekForm(forms.Form):
         return cleaned_data
 
 class DeseqMetadataForm(forms.Form):
-    condition1 = forms.CharField(
-        max_length=50,
+    conditions = forms.CharField(
+        max_length=500,
         required=True,
-        label="Condition 1",
-        initial="control",
+        label="Conditions",
+        initial="control, treatment",
         widget=forms.TextInput(attrs={
-            'placeholder': 'e.g., control',
-            'class': 'mt-1 block w-full px-4 py-3 border border-gray-300 rounded-lg shadow-sm focus:ring-emerald-500 focus:border-emerald-500 sm:text-sm transition-all duration-300'
-        })
-    )
-    condition2 = forms.CharField(
-        max_length=50,
-        required=True,
-        label="Condition 2",
-        initial="treatment",
-        widget=forms.TextInput(attrs={
-            'placeholder': 'e.g., treatment',
+            'placeholder': 'e.g., control, treatment, knockout',
             'class': 'mt-1 block w-full px-4 py-3 border border-gray-300 rounded-lg shadow-sm focus:ring-emerald-500 focus:border-emerald-500 sm:text-sm transition-all duration-300'
         })
     )
@@ -168,6 +170,12 @@ class DeseqMetadataForm(forms.Form):
         sequencing_type = kwargs.pop('sequencing_type', 'single')
         super().__init__(*args, **kwargs)
 
+        # Sample selects offer one choice per comma-separated condition name (condition1, condition2, ...)
+        self.condition_names = self.parse_conditions(self.data.get('conditions', self.fields['conditions'].initial))
+        condition_choices = [('', 'Select condition')] + [
+            (f'condition{i}', name) for i, name in enumerate(self.condition_names, start=1)
+        ]
+
         # Dynamically add fields for each file or sample
         self.sample_names = []
         if sequencing_type == 'single':
@@ -175,7 +183,7 @@ class DeseqMetadataForm(forms.Form):
                 name = file.name.split('.fastq')[0]
                 self.sample_names.append(name)
                 self.fields[f'condition_{name}'] = forms.ChoiceField(
-                    choices=[('', 'Select condition'), ('condition1', 'Condition 1'), ('condition2', 'Condition 2')],
+                    choices=condition_choices,
                     required=True,
                     label=f"Condition for {name}",
                     widget=forms.Select(attrs={
@@ -193,7 +201,7 @@ class DeseqMetadataForm(forms.Form):
                         sample_names[sample_name] = True
                         self.sample_names.append(sample_name)
                         self.fields[f'condition_{sample_name}'] = forms.ChoiceField(
-                            choices=[('', 'Select condition'), ('condition1', 'Condition 1'), ('condition2', 'Condition 2')],
+                            choices=condition_choices,
                             required=True,
                             label=f"Condition for {sample_name}",
                             widget=forms.Select(attrs={
@@ -201,13 +209,26 @@ class DeseqMetadataForm(forms.Form):
                             })
                         )
 
+    @staticmethod
+    def parse_conditions(value):
+        """Split a comma-separated list of condition names."""
+        return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+    def clean_conditions(self):
+        conditions = self.parse_conditions(self.cleaned_data.get('conditions'))
+        if len(conditions) < 2:
+            raise forms.ValidationError("Enter at least two conditions, separated by commas.")
+        if len(set(conditions)) != len(conditions):
+            raise forms.ValidationError("Condition names must be different.")
+        for condition in conditions:
+            if len(condition) > 50:
+                raise forms.ValidationError(f"Condition name {condition} is too long. Maximum length is 50 characters.")
+            if not re.match(r'^[\w.-]+$', condition):
+                raise forms.ValidationError(f"Condition name {condition} may only contain letters, numbers, underscores, dots and hyphens.")
+        return conditions
+
     def clean(self):
         cleaned_data = super().clean()
-        condition1 = cleaned_data.get('condition1')
-        condition2 = cleaned_data.get('condition2')
-
-        if condition1 and condition2 and condition1 == condition2:
-            raise forms.ValidationError("Condition 1 and Condition 2 must be different.")
 
         # Ensure all sample conditions are selected
         condition_selections = []
@@ -218,7 +239,16 @@ class DeseqMetadataForm(forms.Form):
                 condition_selections.append(cleaned_data.get(field_name))
 
         # Ensure conditions are not one-sided
-        if condition_selections and (all(c == 'condition1' for c in condition_selections) or all(c == 'condition2' for c in condition_selections)):
-            raise forms.ValidationError("Samples must be assigned to both Condition 1 and Condition 2. All samples cannot be in the same condition.")
+        if condition_selections and len(set(condition_selections)) < 2:
+            raise forms.ValidationError("Samples must be assigned to at least two different conditions. All samples cannot be in the same condition.")
+
+        return cleaned_data
 
-        return cleaned_data
\ No newline at end of file
+    def get_grouped_samples(self):
+        """Map each condition name to the samples assigned to it (only conditions with samples)."""
+        grouped_samples = {}
+        for sample_name in self.sample_names:
+            choice = self.cleaned_data.get(f'condition_{sample_name}')
+            condition = self.condition_names[int(choice[len('condition'):]) - 1]
+            grouped_samples.setdefault(condition, []).append(sample_name)
+        return grouped_samples
\ No newline at end of file
@@ -0,0 +1,15 @@
+# rsa/management/commands/build_term_links.py
+from django.core.management.base import BaseCommand
+from rsa.util.links import build_link_indexes
+
+class Command(BaseCommand):
+    help = "Compile the term -> link index of every species GMT file (all species in parallel)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gmt-dir', help="Directory of the GMT files (default: rsa/references/gmt)")
+
+    def handle(self, *args, **options):
+        index_paths = build_link_indexes(options['gmt_dir'])
+        for gmt_path, index_path in index_paths.items():
+            self.stdout.write(f"{gmt_path} -> {index_path}")
+        self.stdout.write(self.style.SUCCESS(f"Built term link indexes for {len(index_paths)} GMT files"))
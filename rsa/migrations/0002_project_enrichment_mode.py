@@ -0,0 +1,18 @@
+# Generated by Django 5.2.2 on 2026-10-19 05:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rsa', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='enrichment_mode',
+            field=models.CharField(default='gsea', max_length=10),
+        ),
+    ]
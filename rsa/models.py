@@ -21,6 +21,7 @@ class Project(models.Model):
     pipeline_version = models.CharField(max_length=20)
     sequencing_type = models.CharField(max_length=20)
     pvalue_cutoff = models.FloatField(default=0.05)
+    enrichment_mode = models.CharField(max_length=10, default='gsea')  # 'gsea' (prerank) or 'ora' (over-representation)
     created_at = models.DateTimeField(auto_now_add=True)
     error_message = models.TextField(null=True, blank=True)
     is_running = models.BooleanField(default=False)
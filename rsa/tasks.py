@@ -10,14 +10,44 @@ from .util.fastqc import run_fastqc
 from .util.trimmomatic import run_trimmomatic, get_trimmomatic_file_ids
 from .util.hisat2 import run_hisat2
 from .util.samtools import run_samtools
-from .util.featurecounts import run_featurecounts
-from .util.deseq2 import run_deseq2
+from .util.featurecounts import run_featurecounts, FeatureCountsShards
+from .util.deseq2 import run_deseq2, run_enrichment
+from .util.resources import get_core_budget
 import os
 from django.db import transaction
 from django.core.exceptions import ValidationError
 
 logger = logging.getLogger(__name__)
 
+def set_project_status(channel_layer, project, new_status, error_message=None):
+    """Save a project's status and send it to the session's WebSocket group."""
+    with transaction.atomic():
+        project.status = new_status
+        if error_message:
+            project.error_message = error_message
+        project.is_running = (new_status not in ['completed', 'failed'])
+        project.save()
+        logger.debug(f"Project {project.name} status set to '{new_status}'")
+        event = {
+            'type': 'project_status_update',
+            'project_id': str(project.id),
+            'status': new_status,
+            'project_name': project.name,
+            'session_id': project.session_id,
+            'pvalue_cutoff': project.pvalue_cutoff,
+            'species': project.species,
+            'genome_reference': project.genome_reference,
+            'pipeline_version': project.pipeline_version,
+            'sequencing_type': project.sequencing_type
+        }
+        if error_message:
+            event['error_message'] = error_message
+        logger.debug(f"Sending WebSocket update to group: project_status_{project.session_id}, event: {event}")
+        async_to_sync(channel_layer.group_send)(
+            f'project_status_{project.session_id}',
+            event
+        )
+
 @shared_task
 def run_rnaseek_pipeline(project_id):
     channel_layer = get_channel_layer()
@@ -31,32 +61,7 @@ def run_rnaseek_pipeline(project_id):
             project.save()
 
         def update_status(new_status, error_message=None):
-            with transaction.atomic():
-                project.status = new_status
-                if error_message:
-                    project.error_message = error_message
-                project.is_running = (new_status not in ['completed', 'failed'])
-                project.save()
-                logger.debug(f"Project {project.name} status set to '{new_status}'")
-                event = {
-                    'type': 'project_status_update',
-                    'project_id': str(project.id),
-                    'status': new_status,
-                    'project_name': project.name,
-                    'session_id': project.session_id,
-                    'pvalue_cutoff': project.pvalue_cutoff,
-                    'species': project.species,
-                    'genome_reference': project.genome_reference,
-                    'pipeline_version': project.pipeline_version,
-                    'sequencing_type': project.sequencing_type
-                }
-                if error_message:
-                    event['error_message'] = error_message
-                logger.debug(f"Sending WebSocket update to group: project_status_{project.session_id}, event: {event}")
-                async_to_sync(channel_layer.group_send)(
-                    f'project_status_{project.session_id}',
-                    event
-                )
+            set_project_status(channel_layer, project, new_status, error_message)
 
         output_dir = os.path.join(settings.MEDIA_ROOT, 'output', str(project.session_id), str(project.id), 'fastqc')
         input_files = ProjectFiles.objects.filter(project=project, type='input_fastq')
@@ -98,24 +103,48 @@ def run_rnaseek_pipeline(project_id):
 
         update_status('converting_sam_to_bam')
         samtools_output_dir = os.path.join(settings.MEDIA_ROOT, 'output', str(project.session_id), str(project.id), 'samtools')
+        featurecounts_output_dir = os.path.join(settings.MEDIA_ROOT, 'output', str(project.session_id), str(project.id), 'featurecounts')
         sam_files_queryset = ProjectFiles.objects.filter(project=project, path__in=sam_files)
-        bam_files = run_samtools(project, sam_files_queryset, samtools_output_dir)
-        logger.info(f"SAMtools BAM files generated: {bam_files}")
+        # Sharded counting starts on each sample as soon as its sorted BAM is written, so sorting
+        # and counting split the core budget between them
+        core_budget = get_core_budget()
+        sort_cores = core_budget
+        counting_shards = None
+        if getattr(settings, 'FEATURECOUNTS_SHARDED', False):
+            counting_cores = max(1, core_budget // 2)
+            sort_cores = max(1, core_budget - counting_cores)
+            counting_shards = FeatureCountsShards(project, featurecounts_output_dir, core_budget=counting_cores)
+        try:
+            bam_files = run_samtools(project, sam_files_queryset, samtools_output_dir,
+                                     on_bam_ready=counting_shards.submit if counting_shards else None,
+                                     core_budget=sort_cores)
+            logger.info(f"SAMtools BAM files generated: {bam_files}")
 
-        update_status('quantifying_reads')
-        featurecounts_output_dir = os.path.join(settings.MEDIA_ROOT, 'output', str(project.session_id), str(project.id), 'featurecounts')
-        bam_files_queryset = ProjectFiles.objects.filter(project=project, path__in=bam_files)
-        counts_files = run_featurecounts(project, bam_files_queryset, featurecounts_output_dir)
-        logger.info(f"FeatureCounts files generated: {counts_files}")
+            update_status('quantifying_reads')
+            if counting_shards:
+                counts_files = counting_shards.merge(bam_files)
+            else:
+                bam_files_queryset = ProjectFiles.objects.filter(project=project, path__in=bam_files)
+                counts_files = run_featurecounts(project, bam_files_queryset, featurecounts_output_dir)
+            logger.info(f"FeatureCounts files generated: {counts_files}")
+        finally:
+            if counting_shards:
+                counting_shards.shutdown()
 
         update_status('differential_expression')
         deseq2_output_dir = os.path.join(settings.MEDIA_ROOT, 'output', str(project.session_id), str(project.id), 'deseq2')
         metadata_file = ProjectFiles.objects.get(project=project, type='deseq_metadata').path
-        deseq2_results = run_deseq2(project, counts_files[0], metadata_file, deseq2_output_dir)
+
+        # The DE results can be viewed while enrichment runs as its own task; it is queued as soon
+        # as the results are saved, so it runs alongside the plot rendering
+        def start_enrichment():
+            update_status('de_ready')
+            run_enrichment_analysis.delay(project.id)
+            logger.info(f"Project {project.name} differential expression ready, enrichment analysis queued")
+
+        deseq2_results = run_deseq2(project, counts_files[0], metadata_file, deseq2_output_dir,
+                                    on_results_ready=start_enrichment)
         logger.info(f"DESeq2 results generated: {deseq2_results}")
-        
-        update_status('completed')
-        logger.info(f"Project {project.name} completed successfully")
 
     except Exception as e:
         error_msg = str(e)
@@ -140,4 +169,27 @@ def run_rnaseek_pipeline(project_id):
                 'sequencing_type': project.sequencing_type,
                 'error_message': error_msg
             }
-        )
\ No newline at end of file
+        )
+
+@shared_task
+def run_enrichment_analysis(project_id):
+    """
+    Enrichment analysis of a project whose DESeq2 results are ready ('de_ready'), chained after
+    run_rnaseek_pipeline. A failure keeps the DE results viewable: the project completes with the
+    error message.
+    """
+    channel_layer = get_channel_layer()
+    project = Project.objects.get(id=project_id)
+    if project.status != 'de_ready':
+        logger.warning(f"Skipping enrichment for project {project.name} (ID: {project_id}) in status '{project.status}'")
+        return
+    try:
+        deseq2_output_dir = os.path.join(settings.MEDIA_ROOT, 'output', str(project.session_id), str(project.id), 'deseq2')
+        enrichment_results = run_enrichment(project, deseq2_output_dir)
+        logger.info(f"Enrichment results generated: {enrichment_results}")
+        set_project_status(channel_layer, project, 'completed')
+        logger.info(f"Project {project.name} completed successfully")
+    except Exception as e:
+        error_msg = f"Enrichment analysis failed: {str(e)}"
+        logger.error(f"Error in enrichment for project {project_id}: {error_msg}")
+        set_project_status(channel_layer, project, 'completed', error_msg)
@@ -9,6 +9,13 @@ register = template.Library()
 def basename(value):
     return os.path.basename(value)
 
+@register.filter
+def parent_dirname(value):
+    """
+    Name of the directory holding a file, e.g. the contrast of a contrasts/<a>_vs_<b>/ plot.
+    """
+    return os.path.basename(os.path.dirname(value))
+
 @register.filter
 def filter_by_type(queryset, type_name):
     """
@@ -7,5 +7,10 @@ urlpatterns = [
     path('results/', views.results, name='results'),
     path('result/<int:project_id>/', views.project_detail, name='project_detail'),
     path('download/<int:file_id>/', views.download_file, name='download_file'),
+    path('result/<int:project_id>/status/', views.project_status, name='project_status'),
+    path('result/<int:project_id>/region/', views.download_region, name='download_region'),
+    path('result/<int:project_id>/rethreshold/', views.rethreshold_results, name='rethreshold_results'),
+    path('result/<int:project_id>/expression/', views.expression_query, name='expression_query'),
+    path('result/<int:project_id>/gsea-plot/', views.gsea_term_plot, name='gsea_term_plot'),
     path('example-analysis/', views.example_analysis, name='example_analysis'),
 ]
\ No newline at end of file
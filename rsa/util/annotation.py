@@ -0,0 +1,146 @@
+import os
+import csv
+import functools
+import logging
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from .cache import get_cached_artifact
+
+logger = logging.getLogger(__name__)
+
+def get_gff3_path(species):
+    """Return the GFF3 annotation file for a species."""
+    species_to_gff3 = {
+        'human': 'Homo_sapiens.GRCh38.114.gff3',
+        'mouse': 'Mus_musculus.GRCm39.114.gff3',
+        'yeast': 'Saccharomyces_cerevisiae.R64-1-1.114.gff3',
+        'arabidopsis': 'Arabidopsis_thaliana.TAIR10.61.gff3',
+        'worm': 'Caenorhabditis_elegans.WBcel235.114.gff3',
+        'zebrafish': 'Danio_rerio.GRCz11.114.gff3',
+        'fly': 'Drosophila_melanogaster.BDGP6.54.61.gff3',
+        'rice': 'Oryza_sativa.IRGSP-1.0.61.gff3',
+        'maize': 'Zea_mays.Zm-B73-REFERENCE-NAM-5.0.61.gff3'
+    }
+    gff3_file = species_to_gff3.get(species.lower(), None)
+    if not gff3_file:
+        logger.error(f"No GFF3 annotation file defined for species: {species}")
+        raise RuntimeError(f"No GFF3 annotation file defined for species: {species}")
+    gff3_path = os.path.join(settings.BASE_DIR, 'rsa', 'references', 'gff3', gff3_file)
+    if not os.path.exists(gff3_path):
+        logger.error(f"GFF3 annotation file not found: {gff3_path}")
+        raise RuntimeError(f"GFF3 annotation file not found: {gff3_path}")
+    return gff3_path
+
+def parse_gff3_attributes(attributes):
+    """Split a GFF3 attribute column into a dict."""
+    return dict(field.split('=', 1) for field in attributes.split(';') if '=' in field)
+
+def build_saf(gff3_path, saf_path):
+    """Compile the GFF3 `gene` features into featureCounts SAF format, keyed by gene_id."""
+    genes = 0
+    with open(gff3_path, 'r') as gff3, open(saf_path, 'w') as saf:
+        saf.write('GeneID\tChr\tStart\tEnd\tStrand\n')
+        for line in gff3:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] != 'gene':
+                continue
+            gene_id = parse_gff3_attributes(fields[8]).get('gene_id')
+            if gene_id:
+                saf.write(f"{gene_id}\t{fields[0]}\t{fields[3]}\t{fields[4]}\t{fields[6]}\n")
+                genes += 1
+    logger.info(f"Compiled {genes} genes from {gff3_path} into SAF")
+
+def get_saf_path(species):
+    """
+    Return the featureCounts-ready SAF annotation for a species.
+
+    The SAF is compiled once from the species GFF3 into rsa/references/saf and rebuilt
+    automatically when the GFF3 checksum changes.
+    """
+    gff3_path = get_gff3_path(species)
+    saf_dir = os.path.join(settings.BASE_DIR, 'rsa', 'references', 'saf')
+    return get_cached_artifact(gff3_path, saf_dir, '.saf', build_saf)
+
+@functools.lru_cache(maxsize=16)
+def load_gene_regions(saf_path):
+    """Map gene_id to its 'seqid:start-end' region from a compiled SAF (memoized per worker)."""
+    regions = {}
+    with open(saf_path, 'r') as f:
+        next(f)
+        for line in f:
+            gene_id, chrom, start, end, strand = line.rstrip('\n').split('\t')
+            if gene_id in regions:
+                prev_chrom, prev_start, prev_end = regions[gene_id]
+                if prev_chrom == chrom:
+                    regions[gene_id] = (chrom, min(prev_start, int(start)), max(prev_end, int(end)))
+            else:
+                regions[gene_id] = (chrom, int(start), int(end))
+    return {gene_id: f"{chrom}:{start}-{end}" for gene_id, (chrom, start, end) in regions.items()}
+
+def build_symbol_index(gff3_path, index_path):
+    """
+    Compile the gene_id -> Name mapping of the GFF3 `gene` features into a .npz lookup.
+
+    The GFF3 is streamed in chunks and only the feature type and attribute columns are parsed;
+    genes without a Name map to their gene_id.
+    """
+    gene_ids, symbols = [], []
+    chunks = pd.read_csv(gff3_path, sep='\t', comment='#', header=None, usecols=[2, 8],
+                         names=['feature', 'attributes'], dtype=str, quoting=csv.QUOTE_NONE,
+                         chunksize=200000)
+    for chunk in chunks:
+        attributes = chunk.loc[chunk['feature'] == 'gene', 'attributes']
+        gene_id = attributes.str.extract(r'(?:^|;)gene_id=([^;]+)', expand=False)
+        name = attributes.str.extract(r'(?:^|;)Name=([^;]+)', expand=False)
+        found = gene_id.notna()
+        gene_ids.append(gene_id[found].to_numpy(dtype=str))
+        symbols.append(name[found].fillna(gene_id[found]).to_numpy(dtype=str))
+    gene_ids = np.concatenate(gene_ids) if gene_ids else np.array([], dtype=str)
+    symbols = np.concatenate(symbols) if symbols else np.array([], dtype=str)
+    with open(index_path, 'wb') as f:
+        np.savez(f, gene_ids=gene_ids, symbols=symbols)
+    logger.info(f"Compiled {len(gene_ids)} gene symbols from {gff3_path}")
+
+def get_symbol_index_path(gff3_path):
+    """Return the compiled gene symbol index for a GFF3, rebuilt when the GFF3 checksum changes."""
+    symbols_dir = os.path.join(settings.BASE_DIR, 'rsa', 'references', 'symbols')
+    return get_cached_artifact(gff3_path, symbols_dir, '.npz', build_symbol_index)
+
+@functools.lru_cache(maxsize=16)
+def load_gene_symbols(index_path):
+    """Map gene_id to gene symbol from a compiled symbol index (memoized per worker)."""
+    with np.load(index_path) as index:
+        return dict(zip(index['gene_ids'].tolist(), index['symbols'].tolist()))
+
+@functools.lru_cache(maxsize=16)
+def load_symbol_gene_ids(index_path):
+    """Map upper-cased gene symbol to the first gene_id carrying it (memoized per worker)."""
+    gene_ids = {}
+    for gene_id, symbol in load_gene_symbols(index_path).items():
+        gene_ids.setdefault(symbol.upper(), gene_id)
+    return gene_ids
+
+def get_gene_symbols(species):
+    """Return the gene_id -> gene symbol mapping for a species."""
+    return load_gene_symbols(get_symbol_index_path(get_gff3_path(species)))
+
+def find_gene_region(species, gene):
+    """
+    Resolve a gene ID or gene name to its genomic region.
+
+    Gene IDs are looked up in the compiled SAF; names are first resolved to a gene ID through
+    the compiled symbol index.
+
+    Returns:
+        str: Region as 'seqid:start-end', or None if the gene is not annotated.
+    """
+    regions = load_gene_regions(get_saf_path(species))
+    region = regions.get(gene)
+    if region:
+        return region
+
+    gene_id = load_symbol_gene_ids(get_symbol_index_path(get_gff3_path(species))).get(gene.upper())
+    return regions.get(gene_id) if gene_id else None
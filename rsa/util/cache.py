@@ -0,0 +1,76 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+_checksums = {}
+
+def file_checksum(path, stamp_dir=None):
+    """
+    SHA-256 of a file, memoized per process by path, size and modification time.
+
+    When stamp_dir is given, the checksum is also recorded there so later worker processes
+    only re-hash the file if its size or modification time changed.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key in _checksums:
+        return _checksums[key]
+
+    stamp_path = os.path.join(stamp_dir, f"{os.path.basename(path)}.checksum.json") if stamp_dir else None
+    if stamp_path and os.path.exists(stamp_path):
+        try:
+            with open(stamp_path, 'r') as f:
+                stamp = json.load(f)
+            if stamp['size'] == stat.st_size and stamp['mtime_ns'] == stat.st_mtime_ns:
+                _checksums[key] = stamp['sha256']
+                return stamp['sha256']
+        except (OSError, ValueError, KeyError):
+            logger.warning(f"Ignoring unreadable checksum stamp: {stamp_path}")
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(4 * 1024 * 1024), b''):
+            sha256.update(chunk)
+    checksum = sha256.hexdigest()
+    _checksums[key] = checksum
+    logger.debug(f"Computed checksum for {path}: {checksum}")
+
+    if stamp_path:
+        os.makedirs(stamp_dir, exist_ok=True)
+        with open(stamp_path, 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': checksum}, f)
+    return checksum
+
+def get_cached_artifact(source_path, cache_dir, suffix, build):
+    """
+    Return the path of an artifact compiled from source_path, building it on first use.
+
+    Artifacts are named after the source checksum, so a changed source gets a new artifact
+    and stale ones are removed. build(source_path, output_path) must write output_path.
+    """
+    checksum = file_checksum(source_path, stamp_dir=cache_dir)[:16]
+    stem = os.path.basename(source_path)
+    artifact_path = os.path.join(cache_dir, f"{stem}.{checksum}{suffix}")
+    if os.path.exists(artifact_path):
+        return artifact_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Build under a temporary name that keeps the suffix, then publish atomically
+    tmp_path = os.path.join(cache_dir, f".{stem}.{checksum}.{os.getpid()}{suffix}")
+    try:
+        build(source_path, tmp_path)
+        os.replace(tmp_path, artifact_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    logger.info(f"Built cached artifact {artifact_path} from {source_path}")
+
+    for stale_path in glob.glob(os.path.join(cache_dir, f"{glob.escape(stem)}.*{suffix}")):
+        if stale_path != artifact_path:
+            os.remove(stale_path)
+            logger.info(f"Removed stale cached artifact: {stale_path}")
+    return artifact_path
@@ -2,48 +2,42 @@ import pandas as pd
 import logging
 import re
 import os
+import json
+import shutil
+import time
+import itertools
+from concurrent.futures import as_completed
 from django.conf import settings
 from pydeseq2.dds import DeseqDataSet
 from pydeseq2.ds import DeseqStats
+from pydeseq2.default_inference import DefaultInference
 from rsa.models import Project, ProjectFiles
-import seaborn as sns
-import matplotlib.pyplot as plt
+from .featurecounts import load_count_matrix
+from .annotation import get_gff3_path, get_symbol_index_path, load_gene_symbols
+from .resources import get_core_budget, make_pool_executor
+from .expression import save_expression_matrices, load_normalized_counts
+from .genesets import load_gene_sets, get_gene_set_index
+from .gsea import prerank, shared_null_enrichment_scores, write_enrichment_pdf, render_term_plot
+from .ora import over_representation
+from .links import add_term_links
+from .render import render_plot, write_cluster_order, make_render_executor
 import numpy as np
 import gseapy as gp
 from sklearn.decomposition import PCA
-from PyPDF2 import PdfMerger
 
 logger = logging.getLogger(__name__)
 
+# Gene-set size limits (genes overlapping the ranked list) for GSEA
+GSEA_MIN_SIZE = 15
+GSEA_MAX_SIZE = 500
+# Benjamini-Hochberg FDR cutoff for over-representation (ORA) results
+ORA_FDR_CUTOFF = 0.05
+
 def parse_gff3_for_symbols(gff3_path):
-    """Parse GFF3 file to extract gene_id to gene_name mapping."""
+    """Return the gene_id to gene_name mapping of a GFF3 from its cached symbol index."""
     try:
-        gff3_cols = ['seqname', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame', 'attributes']
-        gff3_df = pd.read_csv(gff3_path, sep='\t', comment='#', names=gff3_cols, low_memory=False)
-        gff3_df = gff3_df[gff3_df['feature'] == 'gene']
-        gene_mapping = {}
-        
-        for attr in gff3_df['attributes']:
-            # Initialize default values
-            gene_id = None
-            gene_name = None
-            
-            # Split attributes by semicolon
-            attr_dict = dict(field.split('=') for field in attr.split(';') if '=' in field)
-            
-            # Extract gene_id
-            if 'gene_id' in attr_dict:
-                gene_id = attr_dict['gene_id']
-            
-            # Extract gene_name (use Name if available, otherwise fallback to gene_id)
-            if 'Name' in attr_dict:
-                gene_name = attr_dict['Name']
-            
-            # Only add to mapping if gene_id is found
-            if gene_id:
-                gene_mapping[gene_id] = gene_name if gene_name else gene_id
-                
-        logger.info(f"Parsed {len(gene_mapping)} gene symbols from GFF3")
+        gene_mapping = load_gene_symbols(get_symbol_index_path(gff3_path))
+        logger.info(f"Loaded {len(gene_mapping)} gene symbols for {gff3_path}")
         if not gene_mapping:
             logger.warning("No gene mappings were extracted from GFF3")
         return gene_mapping
@@ -52,6 +46,222 @@ def parse_gff3_for_symbols(gff3_path):
         logger.error(f"Failed to parse GFF3 file {gff3_path}: {str(e)}")
         raise RuntimeError(f"Failed to parse GFF3 file: {str(e)}")
 
+def _timed(timings, phase, func, *args, **kwargs):
+    """Call func and record its wall time in seconds under timings[phase]."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[phase] = round(time.perf_counter() - start, 3)
+    return result
+
+def fit_deseq2(dds, timings):
+    """
+    Run the DeseqDataSet.deseq2() fitting steps one by one, recording the time spent in each.
+
+    Args:
+        dds: DeseqDataSet to fit.
+        timings: Dict that receives seconds per fitting phase.
+    """
+    _timed(timings, 'size_factors', dds.fit_size_factors,
+           fit_type=dds.size_factors_fit_type, control_genes=dds.control_genes)
+    _timed(timings, 'genewise_dispersions', dds.fit_genewise_dispersions)
+    _timed(timings, 'dispersion_trend', dds.fit_dispersion_trend)
+    _timed(timings, 'dispersion_prior', dds.fit_dispersion_prior)
+    _timed(timings, 'map_dispersions', dds.fit_MAP_dispersions)
+    _timed(timings, 'lfc', dds.fit_LFC)
+    _timed(timings, 'cooks', dds.calculate_cooks)
+    if dds.refit_cooks:
+        _timed(timings, 'cooks_refit', dds.refit)
+    dds.cooks_outlier()
+
+def write_deseq2_summary(project, output_dir, summary):
+    """Write run statistics (phase timings, core budget, gene counts) to deseq2_summary.json and register it."""
+    summary_file = os.path.join(output_dir, "deseq2_summary.json")
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+    logger.info(f"DESeq2 summary saved to: {summary_file}")
+    ProjectFiles.objects.create(
+        project=project,
+        type='deseq2_summary',
+        path=summary_file,
+        is_directory=False,
+        file_format='json',
+        size=os.path.getsize(summary_file)
+    )
+    return summary_file
+
+def get_contrasts(conditions):
+    """Every pairwise comparison between the conditions, in the order they appear in the metadata."""
+    return [['condition', first, second] for i, first in enumerate(conditions) for second in conditions[i + 1:]]
+
+def get_contrast_name(contrast):
+    """File-system friendly name of a contrast, e.g. 'control_vs_treatment'."""
+    return f"{contrast[1]}_vs_{contrast[2]}"
+
+def run_contrast(dds, inference, contrast, gene_mapping):
+    """Run the Wald tests for one contrast of a fitted DeseqDataSet and add gene symbols."""
+    stat_res = DeseqStats(dds, inference=inference, quiet=True, contrast=contrast)
+    stat_res.summary()
+    results_df = stat_res.results_df
+    results_df['gene_symbol'] = results_df.index.map(gene_mapping)
+    return results_df
+
+def filter_results(results_df, padj_cutoff, log2fc_cutoff=1.0, base_mean_cutoff=10.0):
+    """Keep genes with padj < padj_cutoff, |log2FoldChange| > log2fc_cutoff and baseMean > base_mean_cutoff."""
+    return results_df[
+        (results_df['padj'] < padj_cutoff) &
+        (results_df['log2FoldChange'].abs() > log2fc_cutoff) &
+        (results_df['baseMean'] > base_mean_cutoff)
+    ]
+
+def prune_threshold_cache(thresholds_dir, keep):
+    """
+    Remove the least recently used re-threshold directories beyond RETHRESHOLD_CACHE_MAX
+    (by modification time, which rethreshold_deseq2 refreshes on every cache hit); keep is never removed.
+    """
+    max_entries = getattr(settings, 'RETHRESHOLD_CACHE_MAX', 20)
+    entries = [os.path.join(thresholds_dir, name) for name in os.listdir(thresholds_dir)]
+    entries = sorted((path for path in entries if os.path.isdir(path) and path != keep),
+                     key=os.path.getmtime, reverse=True)
+    for path in entries[max(max_entries - 1, 0):]:
+        shutil.rmtree(path, ignore_errors=True)
+        logger.info(f"Evicted re-threshold cache directory: {path}")
+
+def rethreshold_deseq2(project, output_dir, padj_cutoff, log2fc_cutoff, base_mean_cutoff):
+    """
+    Re-apply significance thresholds to the stored full DESeq2 results of a project.
+
+    Only the filtered CSV and the heatmap are regenerated, under output_dir/thresholds/<thresholds>;
+    a threshold combination that was already computed is served from there, and only the
+    RETHRESHOLD_CACHE_MAX most recently used combinations are kept. The clustering order of
+    the passing genes is left to rethreshold_heatmap_order.
+
+    Returns:
+        dict: Thresholds, number of genes passing, and paths of the filtered CSV and heatmap
+        (heatmap is None when no gene passes).
+    """
+    # Exact (round-tripping) float representations, so distinct thresholds never share a directory
+    threshold_dir = os.path.join(output_dir, 'thresholds',
+                                 f"padj{float(padj_cutoff)!r}_lfc{float(log2fc_cutoff)!r}_basemean{float(base_mean_cutoff)!r}")
+    summary_file = os.path.join(threshold_dir, "summary.json")
+    if os.path.exists(summary_file):
+        os.utime(threshold_dir)
+        with open(summary_file, 'r') as f:
+            return json.load(f)
+
+    full_results = pd.read_csv(os.path.join(output_dir, "deseq2_full_results.csv"), index_col=0)
+    results_df = filter_results(full_results, padj_cutoff, log2fc_cutoff, base_mean_cutoff)
+    os.makedirs(threshold_dir, exist_ok=True)
+    output_file = os.path.join(threshold_dir, "deseq2_results.csv")
+    results_df.to_csv(output_file)
+
+    heatmap_output = os.path.join(threshold_dir, "heatmap.png")
+    normed_counts = load_normalized_counts(output_dir)
+    if normed_counts is None or results_df.empty:
+        heatmap_output = None
+    else:
+        create_cluster_heatmap(normed_counts, results_df, heatmap_output, project,
+                               title=f"Clustered Heatmap - {project.name} (padj < {padj_cutoff:g})")
+
+    summary = {
+        'padj': padj_cutoff,
+        'log2fc': log2fc_cutoff,
+        'base_mean': base_mean_cutoff,
+        'n_genes': len(results_df),
+        'results': output_file,
+        'heatmap': heatmap_output,
+    }
+    # Written last so an interrupted run is recomputed rather than served from the cache
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f)
+    prune_threshold_cache(os.path.dirname(threshold_dir), threshold_dir)
+    logger.info(f"Re-thresholded DESeq2 results for project {project.id}: {len(results_df)} genes")
+    return summary
+
+def rethreshold_heatmap_order(output_dir, summary):
+    """
+    Return the clustering order CSV of the genes passing a re-thresholding (see rethreshold_deseq2,
+    capped as cluster_order_data does), computing and caching it on first use; None when no gene passes.
+    """
+    if not summary['heatmap']:
+        return None
+    order_file = os.path.join(os.path.dirname(summary['results']), "heatmap_order.csv")
+    if not os.path.exists(order_file):
+        results_df = pd.read_csv(summary['results'], index_col=0)
+        write_cluster_order(cluster_order_data(load_normalized_counts(output_dir), results_df), order_file)
+    return order_file
+
+def save_deseq2_results(project, results_df, output_dir, full_type, filtered_type):
+    """
+    Write and register the full and the filtered DESeq2 results of one contrast.
+
+    Args:
+        project: Project instance (contains pvalue_cutoff).
+        results_df: DeseqStats results with gene symbols.
+        output_dir: Directory for deseq2_full_results.csv and deseq2_results.csv.
+        full_type: ProjectFiles type of the full results.
+        filtered_type: ProjectFiles type of the filtered results.
+
+    Returns:
+        tuple: Filtered results DataFrame and the path of deseq2_results.csv.
+    """
+    output_file = os.path.join(output_dir, "deseq2_results.csv")
+    full_output_file = os.path.join(output_dir, "deseq2_full_results.csv")
+
+    # Round numerical columns to 4 significant digits for full results
+    numeric_cols = results_df.select_dtypes(include=['float64', 'int64']).columns
+    results_df[numeric_cols] = results_df[numeric_cols].round(4)
+    results_df.to_csv(full_output_file)
+    logger.info(f"Full DESeq2 results saved to: {full_output_file}")
+    if os.path.exists(full_output_file):
+        file_size = os.path.getsize(full_output_file)
+        ProjectFiles.objects.create(
+            project=project,
+            type=full_type,
+            path=full_output_file,
+            is_directory=False,
+            file_format='csv',
+            size=file_size
+        )
+        logger.info(f"Registered full DESeq2 output CSV: {full_output_file} with size {file_size} bytes")
+
+    pvalue_cutoff = project.pvalue_cutoff
+    results_df = filter_results(results_df, pvalue_cutoff)
+    logger.info(f"Filtered DESeq2 results to {len(results_df)} genes with padj < {pvalue_cutoff}, "
+                f"|log2FoldChange| > 1.0, and baseMean > 10.0")
+
+    # Round numerical columns to 4 significant digits for filtered results
+    numeric_cols = results_df.select_dtypes(include=['float64', 'int64']).columns
+    results_df[numeric_cols] = results_df[numeric_cols].round(4)
+    results_df.to_csv(output_file)
+    logger.info(f"DESeq2 results saved to: {output_file}")
+
+    if os.path.exists(output_file):
+        file_size = os.path.getsize(output_file)
+        ProjectFiles.objects.create(
+            project=project,
+            type=filtered_type,
+            path=output_file,
+            is_directory=False,
+            file_format='csv',
+            size=file_size
+        )
+        logger.info(f"Registered DESeq2 output CSV: {output_file} with size {file_size} bytes")
+    return results_df, output_file
+
+def register_visualization(project, plot_path, file_type, file_format='png'):
+    """Register a plot (PNG by default) as a ProjectFiles entry and return its path."""
+    file_size = os.path.getsize(plot_path)
+    ProjectFiles.objects.create(
+        project=project,
+        type=file_type,
+        path=plot_path,
+        is_directory=False,
+        file_format=file_format,
+        size=file_size
+    )
+    logger.info(f"Registered DESeq2 visualization: {plot_path} with size {file_size} bytes")
+    return plot_path
+
 def prepare_metadata(meta_data, counts_data):
     """Prepare metadata and align it with counts data."""
     meta_index = meta_data.columns[0]
@@ -64,69 +274,152 @@ def prepare_metadata(meta_data, counts_data):
     meta_data = meta_data.loc[shared_samples]
     return meta_data, counts_data
 
-def create_cluster_heatmap(dds, results_df, output_path, project):
-    """Generate a clustered heatmap with dendrograms for significant genes."""
+def prefilter_counts(counts, metadata):
+    """
+    Drop genes with too few reads to be tested before DESeq2 fitting.
+
+    A gene is kept when it has at least DESEQ2_PREFILTER_MIN_COUNT reads in at least
+    DESEQ2_PREFILTER_MIN_SAMPLES samples (default: the size of the smallest condition group).
+
+    Args:
+        counts: Samples x genes count DataFrame.
+        metadata: Sample metadata with a 'condition' column.
+
+    Returns:
+        tuple: Filtered counts and the number of genes removed.
+    """
+    min_count = getattr(settings, 'DESEQ2_PREFILTER_MIN_COUNT', 10)
+    min_samples = getattr(settings, 'DESEQ2_PREFILTER_MIN_SAMPLES', None) or int(metadata['condition'].value_counts().min())
+    if not min_count:
+        return counts, 0
+    keep = (counts.to_numpy() >= min_count).sum(axis=0) >= min_samples
+    genes_removed = int((~keep).sum())
+    logger.info(f"Prefiltered {genes_removed} of {counts.shape[1]} genes with fewer than {min_count} reads "
+                f"in at least {min_samples} samples")
+    return counts.loc[:, keep], genes_removed
+
+def select_heatmap_genes(results_df, max_genes):
+    """
+    Cap the heatmap genes to the top max_genes of results_df (None: no cap), ranked by padj or
+    |log2FoldChange| as HEATMAP_RANK_BY selects; the other measure breaks ties.
+    """
+    if not max_genes or len(results_df) <= max_genes:
+        return results_df
+    ranking = pd.DataFrame({'padj': results_df['padj'], 'abs_lfc': -results_df['log2FoldChange'].abs()})
+    if getattr(settings, 'HEATMAP_RANK_BY', 'padj') == 'log2fc':
+        ranking = ranking[['abs_lfc', 'padj']]
+    order = ranking.sort_values(list(ranking.columns), kind='stable').index[:max_genes]
+    return results_df.loc[order]
+
+def heatmap_plot_data(normed_counts, results_df, title):
+    """
+    Plot data of the clustered heatmap of the (filtered) genes in results_df, capped by
+    select_heatmap_genes to HEATMAP_MAX_GENES.
+
+    Args:
+        normed_counts: Genes x samples DESeq2-normalized counts.
+        results_df: Filtered DESeq2 results whose genes are plotted.
+
+    Returns:
+        dict: Render job data (see rsa.util.render.render_heatmap).
+    """
+    if results_df.empty:
+        logger.warning("No significant genes found for heatmap")
+        raise ValueError("No significant genes to plot in heatmap")
+    plotted_df = select_heatmap_genes(results_df, getattr(settings, 'HEATMAP_MAX_GENES', 500))
+    if len(plotted_df) < len(results_df):
+        logger.info(f"Capped heatmap to the top {len(plotted_df)} of {len(results_df)} significant genes")
+        title = f"{title} (top {len(plotted_df)} of {len(results_df)} genes)"
+    grapher = np.log1p(normed_counts.loc[plotted_df.index].astype(np.float64))
+    logger.info(f"Subset normalized counts to {len(plotted_df.index)} significant genes")
+    return {
+        'values': grapher.to_numpy(),
+        'genes': grapher.index.astype(str).tolist(),
+        'samples': grapher.columns.astype(str).tolist(),
+        'title': title,
+        'max_labels': getattr(settings, 'HEATMAP_MAX_LABELS', 100),
+    }
+
+def cluster_order_data(normed_counts, results_df):
+    """
+    Clustering-order job data of the genes in results_df (see rsa.util.render.write_cluster_order).
+
+    Average linkage needs memory quadratic in the number of genes, so the order covers at most the
+    top HEATMAP_ORDER_MAX_GENES genes (default 5000), selected as for the heatmap.
+    """
+    ordered_df = select_heatmap_genes(results_df, getattr(settings, 'HEATMAP_ORDER_MAX_GENES', 5000))
+    if len(ordered_df) < len(results_df):
+        logger.info(f"Capped the clustering order to the top {len(ordered_df)} of {len(results_df)} significant genes")
+    grapher = np.log1p(normed_counts.loc[ordered_df.index].astype(np.float64))
+    annotations = [column for column in ['gene_symbol', 'log2FoldChange', 'padj'] if column in ordered_df.columns]
+    return {
+        'values': grapher.to_numpy(),
+        'genes': grapher.index.astype(str).tolist(),
+        'annotations': {column: ordered_df[column].tolist() for column in annotations},
+    }
+
+def pca_plot_data(counts, metadata, title):
+    """Plot data of the PCA of the samples, fitted on counts (samples x genes)."""
+    pca = PCA(n_components=2)
+    pca_result = pca.fit_transform(counts)
+    return {
+        'pcs': pca_result[:, :2],
+        'variance': pca.explained_variance_ratio_[:2].tolist(),
+        'conditions': metadata['condition'].astype(str).tolist(),
+        'title': title,
+    }
+
+def expression_change_data(full_results_df, results_df, padj_cutoff, title):
+    """Plot data of the volcano and MA plots: every tested gene, flagged when it is in the filtered results_df."""
+    return {
+        'base_mean': full_results_df['baseMean'].to_numpy(dtype=np.float64),
+        'log2fc': full_results_df['log2FoldChange'].to_numpy(dtype=np.float64),
+        'padj': full_results_df['padj'].to_numpy(dtype=np.float64),
+        'significant': full_results_df.index.isin(results_df.index),
+        'padj_cutoff': padj_cutoff,
+        'log2fc_cutoff': 1.0,
+        'title': title,
+    }
+
+def create_cluster_heatmap(normed_counts, results_df, output_path, project, title=None):
+    """Render the clustered heatmap with dendrograms for the (filtered) genes in results_df inline."""
     try:
-        sigs = results_df[
-            (results_df['padj'] < project.pvalue_cutoff) &
-            (results_df['log2FoldChange'].abs() > 1.0) &
-            (results_df['baseMean'] > 10.0)
-        ]
-        if sigs.empty:
-            logger.warning("No significant genes found for heatmap")
-            raise ValueError("No significant genes to plot in heatmap")
-        dds_sigs = dds[:, sigs.index]
-        logger.info(f"Subset dds to {len(sigs.index)} significant genes")
-        norm_counts = dds_sigs.layers['normed_counts']
-        log1p_counts = np.log1p(norm_counts)
-        grapher = pd.DataFrame(
-            log1p_counts.T,
-            index=dds_sigs.var_names,
-            columns=dds_sigs.obs_names
-        )
-        sns.clustermap(
-            grapher,
-            z_score=0,
-            cmap='RdYlBu_r',
-            figsize=(10, 8),
-            xticklabels=True,
-            yticklabels=True,
-            cbar_kws={'label': 'Z-score'}
-        )
-        plt.title(f"Clustered Heatmap - {project.name}")
-        plt.tight_layout()
-        plt.savefig(output_path)
-        plt.close()
-        logger.info(f"Clustered heatmap saved to: {output_path}")
-        return output_path
+        return render_plot('heatmap', heatmap_plot_data(
+            normed_counts, results_df, title or f"Clustered Heatmap - {project.name}"), output_path)
     except Exception as e:
         logger.error(f"Failed to create clustered heatmap: {str(e)}")
         raise RuntimeError(f"Clustered heatmap failed: {str(e)}")
 
 def create_pca_plot(counts, metadata, output_path, project):
-    """Generate a basic PCA plot of samples based on counts."""
+    """Render a basic PCA plot of samples based on counts inline."""
     try:
-        pca = PCA(n_components=2)
-        pca_result = pca.fit_transform(counts)
-        pca_df = pd.DataFrame({
-            'PC1': pca_result[:, 0],
-            'PC2': pca_result[:, 1],
-            'Condition': metadata['condition']
-        })
-        plt.figure(figsize=(8, 6))
-        sns.scatterplot(data=pca_df, x='PC1', y='PC2', hue='Condition', s=100)
-        plt.title(f"PCA Plot - {project.name}")
-        plt.xlabel(f"PC1 ({pca.explained_variance_ratio_[0]:.2%} variance)")
-        plt.ylabel(f"PC2 ({pca.explained_variance_ratio_[1]:.2%} variance)")
-        plt.tight_layout()
-        plt.savefig(output_path)
-        plt.close()
-        logger.info(f"PCA plot saved to: {output_path}")
-        return output_path
+        return render_plot('pca', pca_plot_data(counts, metadata, f"PCA Plot - {project.name}"), output_path)
     except Exception as e:
         logger.error(f"Failed to create PCA plot: {str(e)}")
         raise RuntimeError(f"PCA plot failed: {str(e)}")
 
+def collect_plots(project, plot_jobs):
+    """
+    Wait for submitted render jobs and register the plots (and clustering orders) that were produced.
+
+    Args:
+        plot_jobs: List of (future, plot_path, file_type) tuples.
+
+    Returns:
+        list: Paths of the registered plots.
+    """
+    plot_paths = []
+    for future, plot_path, file_type in plot_jobs:
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Failed to render {plot_path}: {str(e)}")
+            continue
+        if os.path.exists(plot_path):
+            plot_paths.append(register_visualization(project, plot_path, file_type,
+                                                     os.path.splitext(plot_path)[1].lstrip('.')))
+    return plot_paths
+
 def inspect_deseq2_output(output_file):
     """Inspect DESeq2 results CSV to verify format for GSEA."""
     try:
@@ -145,8 +438,7 @@ def check_gmt_file(gmt_path):
     """Verify the GMT file format."""
     try:
         with open(gmt_path, 'r') as f:
-            lines = f.readlines()
-            for line in lines[:5]:
+            for line in itertools.islice(f, 5):
                 fields = line.strip().split('\t')
                 logger.info(f"GMT line sample: {fields[:3]}")
                 if len(fields) < 2:
@@ -157,93 +449,184 @@ def check_gmt_file(gmt_path):
         logger.error(f"Failed to check GMT file {gmt_path}: {str(e)}")
         raise
 
-def update_gsea_results_with_links(project, gsea_output_file, gmt_type, output_dir):
-    """Update GSEA results CSV with links from species-specific link files."""
-    try:
-        species_to_link = {
-            'human': {
-                'go': 'homo_sapiens_go_links.csv',
-                'kegg': 'homo_sapiens_kegg_links.csv'
-            },
-            'mouse': {
-                'go': 'mus_musculus_go_links.csv',
-                'kegg': 'mus_musculus_kegg_links.csv'
-            },
-            'yeast': {
-                'go': 'saccharomyces_cerevisiae_go_links.csv',
-                'kegg': 'saccharomyces_cerevisiae_kegg_links.csv'
-            },
-            'arabidopsis': {
-                'go': 'arabidopsis_thaliana_go_links.csv',
-                'kegg': 'arabidopsis_thaliana_kegg_links.csv'
-            },
-            'worm': {
-                'go': 'caenorhabditis_elegans_go_links.csv',
-                'kegg': 'caenorhabditis_elegans_kegg_links.csv'
-            },
-            'zebrafish': {
-                'go': 'danio_rerio_go_links.csv',
-                'kegg': 'danio_rerio_kegg_links.csv'
-            },
-            'fly': {
-                'go': 'drosophila_melanogaster_go_links.csv',
-                'kegg': 'drosophila_melanogaster_kegg_links.csv'
-            },
-            'rice': {
-                'go': 'oryza_sativa_go_links.csv',
-                'kegg': 'oryza_sativa_kegg_links.csv'
-            },
-            'maize': {
-                'go': 'zea_mays_go_links.csv',
-                'kegg': 'zea_mays_kegg_links.csv'
-            }
-        }
-        link_file = species_to_link.get(project.species.lower(), {}).get(gmt_type)
-        if not link_file:
-            logger.warning(f"No link file defined for species {project.species} and type {gmt_type}")
-            return gsea_output_file
-
-        link_path = os.path.join(settings.BASE_DIR, 'rsa', 'references', 'links', link_file)
-        if not os.path.exists(link_path):
-            logger.warning(f"Link file not found: {link_path}")
-            return gsea_output_file
-
-        # Read GSEA results and link file
-        gsea_df = pd.read_csv(gsea_output_file)
-        link_df = pd.read_csv(link_path)
-
-        # Merge dataframes based on Term and Term_Name
-        merged_df = pd.merge(
-            gsea_df,
-            link_df[['Term_Name', 'Link']],
-            left_on='Term',
-            right_on='Term_Name',
-            how='left'
+def prepare_ranked_list(deseq2_df):
+    """Build the GSEA ranked list (upper-cased gene symbol -> log2FoldChange) from DESeq2 results."""
+    ranked_list = deseq2_df[['gene_symbol', 'log2FoldChange']].dropna()
+    ranked_list['gene_symbol'] = ranked_list['gene_symbol'].str.upper()  # Convert to uppercase
+    ranked_list = ranked_list.set_index('gene_symbol')['log2FoldChange']
+    logger.info(f"Prepared ranked list for GSEA with {len(ranked_list)} genes")
+    logger.info(f"Sample gene symbols: {ranked_list.index[:5].tolist()}")
+    return ranked_list
+
+def run_prerank(ranked_list, gmt_path, null_scores=None):
+    """
+    Run GSEA prerank of a ranked list against one GMT file.
+
+    Uses the engine selected by settings.GSEA_ENGINE with settings.GSEA_PERMUTATIONS gene
+    permutations. Neither engine plots; see write_enrichment_pdf. With the numpy engine,
+    null_scores passes precomputed permutation null distributions (see
+    shared_null_enrichment_scores).
+
+    Returns:
+        DataFrame: Gene sets with |NES| > 1.5, FDR < 0.25 and NOM p-val < 0.05.
+    """
+    engine = getattr(settings, 'GSEA_ENGINE', 'numpy')
+    permutations = getattr(settings, 'GSEA_PERMUTATIONS', 1000)
+    if engine == 'gseapy':
+        res2d = gp.prerank(
+            rnk=ranked_list,
+            gene_sets=load_gene_sets(gmt_path, min_size=GSEA_MIN_SIZE),
+            outdir=None,
+            permutation_num=permutations,
+            min_size=GSEA_MIN_SIZE,
+            max_size=GSEA_MAX_SIZE,
+            seed=42
+        ).res2d
+    elif engine == 'numpy':
+        res2d = prerank(
+            ranked_list,
+            get_gene_set_index(gmt_path),
+            permutations=permutations,
+            min_size=GSEA_MIN_SIZE,
+            max_size=GSEA_MAX_SIZE,
+            seed=42,
+            null_scores=null_scores
         )
+    else:
+        logger.error(f"Unknown GSEA engine: {engine}")
+        raise RuntimeError(f"Unknown GSEA engine: {engine}")
+    logger.info(f"GSEA prerank ({engine}) scored {len(res2d)} gene sets with {permutations} permutations")
+    return filter_prerank_results(res2d)
+
+def filter_prerank_results(res2d):
+    """Keep the gene sets of GSEA prerank results with |NES| > 1.5, FDR < 0.25 and NOM p-val < 0.05."""
+    filtered_results = res2d[
+        (res2d['NES'].abs() > 1.5) &
+        (res2d['FDR q-val'] < 0.25) &
+        (res2d['NOM p-val'] < 0.05)
+    ]
+    logger.info(f"Filtered GSEA results to {len(filtered_results)} gene sets with "
+                f"|NES| > 1.5, FDR < 0.25, NOM p-val < 0.05")
+    return filtered_results
+
+def run_gsea_library(ranked_list, species, gmt_type, gmt_path, output_dir, null_scores=None):
+    """
+    Run GSEA prerank for one gene-set library and write its filtered results and the combined
+    PDF of its top terms.
 
-        # Drop the redundant Term_Name column
-        merged_df = merged_df.drop('Term_Name', axis=1, errors='ignore')
+    Runs in a worker process, so it only writes files; run_gsea registers the outputs.
 
-        # Reorder columns to place Link as the second column
-        columns = merged_df.columns.tolist()
-        if 'Link' in columns:
-            term_index = columns.index('Term')
-            columns.insert(term_index + 1, columns.pop(columns.index('Link')))
-            merged_df = merged_df[columns]
+    Returns:
+        dict: gmt_type, results_file and plot_file (None when no plots were produced).
+    """
+    check_gmt_file(gmt_path)
+    sub_output_dir = os.path.join(output_dir, gmt_type)
+    os.makedirs(sub_output_dir, exist_ok=True)
 
-        # Save the updated GSEA results
-        updated_output_file = os.path.join(output_dir, f"{gmt_type}_gsea_results.csv")
-        merged_df.to_csv(updated_output_file, index=False)
-        logger.info(f"Updated {gmt_type.upper()} GSEA results with links saved to: {updated_output_file}")
+    filtered_results = run_prerank(ranked_list, gmt_path, null_scores=null_scores)
+    logger.info(f"{gmt_type.upper()} GSEA prerank completed. Results saved in: {sub_output_dir}")
 
-        return updated_output_file
+    # Drop 'Name' column, add term links and save filtered GSEA results to CSV without index
+    filtered_results = add_term_links(filtered_results.drop(columns=['Name'], errors='ignore'), gmt_path)
+    gsea_output_file = os.path.join(sub_output_dir, f"{gmt_type}_gsea_results.csv")
+    filtered_results.to_csv(gsea_output_file, index=False)
+    logger.info(f"Filtered {gmt_type.upper()} GSEA results CSV with links saved to: {gsea_output_file}")
 
+    # Plot only the top terms by |NES|, streamed into the combined PDF; the other terms are
+    # rendered on demand by render_gsea_term_plot
+    try:
+        combined_pdf_path = write_enrichment_pdf(
+            filtered_results, ranked_list, get_gene_set_index(gmt_path),
+            os.path.join(sub_output_dir, f"{gmt_type}_gsea_plot.pdf"),
+            top_n=getattr(settings, 'GSEA_PLOT_TOP_N', 20)
+        )
     except Exception as e:
-        logger.error(f"Failed to update {gmt_type.upper()} GSEA results with links: {str(e)}")
-        return gsea_output_file
+        logger.error(f"Failed to save combined {gmt_type.upper()} PDF: {str(e)}")
+        combined_pdf_path = None
+    if combined_pdf_path is None:
+        logger.warning(f"No {gmt_type.upper()} GSEA plots produced")
+
+    return {'gmt_type': gmt_type, 'results_file': gsea_output_file, 'plot_file': combined_pdf_path}
+
+def get_gmt_paths(species):
+    """Return the gene-set library GMT paths of a species ({'go': path, 'kegg': path}), or {} if none are defined."""
+    species_to_gmt = {
+        'human': {
+            'go': 'homo_sapiens_go.gmt',
+            'kegg': 'homo_sapiens_kegg.gmt'
+        },
+        'mouse': {
+            'go': 'mus_musculus_go.gmt',
+            'kegg': 'mus_musculus_kegg.gmt'
+        },
+        'yeast': {
+            'go': 'saccharomyces_cerevisiae_go.gmt',
+            'kegg': 'saccharomyces_cerevisiae_kegg.gmt'
+        },
+        'arabidopsis': {
+            'go': 'arabidopsis_thaliana_go.gmt',
+            'kegg': 'arabidopsis_thaliana_kegg.gmt'
+        },
+        'worm': {
+            'go': 'caenorhabditis_elegans_go.gmt',
+            'kegg': 'caenorhabditis_elegans_kegg.gmt'
+        },
+        'zebrafish': {
+            'go': 'danio_rerio_go.gmt',
+            'kegg': 'danio_rerio_kegg.gmt'
+        },
+        'fly': {
+            'go': 'drosophila_melanogaster_go.gmt',
+            'kegg': 'drosophila_melanogaster_kegg.gmt'
+        },
+        'rice': {
+            'go': 'oryza_sativa_go.gmt',
+            'kegg': 'oryza_sativa_kegg.gmt'
+        },
+        'maize': {
+            'go': 'zea_mays_go.gmt',
+            'kegg': 'zea_mays_kegg.gmt'
+        }
+    }
+    gmt_files = species_to_gmt.get(species.lower(), {})
+    return {gmt_type: os.path.join(settings.BASE_DIR, 'rsa', 'references', 'gmt', gmt_file) for gmt_type, gmt_file in gmt_files.items()}
+
+def render_gsea_term_plot(project, output_dir, gmt_type, term):
+    """
+    Render the enrichment plot of one term of a project's GSEA results on demand.
+
+    Plots are cached in <output_dir>/<gmt_type>/plots, so each term is rendered once.
+
+    Returns:
+        str: Path of the term's PDF, or None if the term is not among the GSEA results.
+    """
+    gmt_path = get_gmt_paths(project.species).get(gmt_type)
+    results_file = os.path.join(output_dir, gmt_type, f"{gmt_type}_gsea_results.csv")
+    if not gmt_path or not os.path.exists(results_file):
+        return None
+    results = pd.read_csv(results_file)
+    match = results[results['Term'] == term]
+    if match.empty:
+        return None
+
+    plot_dir = os.path.join(output_dir, gmt_type, 'plots')
+    plot_name = re.sub(r'[^\w.-]', '_', term)
+    plot_path = os.path.join(plot_dir, f"{plot_name}.pdf")
+    if os.path.exists(plot_path):
+        return plot_path
+    os.makedirs(plot_dir, exist_ok=True)
+    ranked_list = prepare_ranked_list(pd.read_csv(os.path.join(output_dir, "deseq2_full_results.csv")))
+    plot_path = render_term_plot(ranked_list, get_gene_set_index(gmt_path), match.iloc[0], plot_path)
+    if plot_path:
+        logger.info(f"Rendered {gmt_type.upper()} GSEA plot for {term}: {plot_path}")
+    return plot_path
 
 def run_gsea(project, deseq2_output_file, gmt_paths, output_dir):
-    """Run GSEA prerank analysis on DESeq2 results, save filtered outputs, and combine PDFs for KEGG and GO."""
+    """
+    Run GSEA prerank on DESeq2 results for every gene-set library (GO, KEGG) concurrently,
+    save filtered outputs and combined PDFs, and register them once all libraries finished.
+    Raises RuntimeError if any library failed, after registering the others.
+    """
     try:
         # Read DESeq2 full results
         deseq2_df = pd.read_csv(deseq2_output_file)
@@ -251,81 +634,48 @@ def run_gsea(project, deseq2_output_file, gmt_paths, output_dir):
             logger.error("DESeq2 results missing required columns: gene_symbol or log2FoldChange")
             raise RuntimeError("Invalid DESeq2 results format for GSEA")
         
-        # Prepare ranked list: gene_symbol and log2FoldChange, convert to uppercase
-        ranked_list = deseq2_df[['gene_symbol', 'log2FoldChange']].dropna()
-        ranked_list['gene_symbol'] = ranked_list['gene_symbol'].str.upper()  # Convert to uppercase
-        ranked_list = ranked_list.set_index('gene_symbol')['log2FoldChange']
-        logger.info(f"Prepared ranked list for GSEA with {len(ranked_list)} genes")
-        logger.info(f"Sample gene symbols: {ranked_list.index[:5].tolist()}")
+        ranked_list = prepare_ranked_list(deseq2_df)
 
-        output_files = []
+        libraries = {}
         for gmt_type, gmt_path in gmt_paths.items():
             if not os.path.exists(gmt_path):
                 logger.warning(f"GMT file not found: {gmt_path}")
                 continue
-            
-            check_gmt_file(gmt_path)
-            sub_output_dir = os.path.join(output_dir, gmt_type)
-            os.makedirs(sub_output_dir, exist_ok=True)
-
-            # Run GSEA prerank
-            gsea_results = gp.prerank(
-                rnk=ranked_list,
-                gene_sets=gmt_path,
-                outdir=sub_output_dir,
-                permutation_num=100,  
-                min_size=15,  
-                max_size=500, 
-                seed=42,
-                threads=1
+            libraries[gmt_type] = gmt_path
+        if not libraries:
+            return []
+
+        # The libraries share the permutation null: compute it once here and pass it to the
+        # worker processes the libraries run in
+        null_scores = None
+        if getattr(settings, 'GSEA_ENGINE', 'numpy') == 'numpy':
+            null_scores = shared_null_enrichment_scores(
+                ranked_list, [get_gene_set_index(gmt_path) for gmt_path in libraries.values()],
+                permutations=getattr(settings, 'GSEA_PERMUTATIONS', 1000),
+                min_size=GSEA_MIN_SIZE, max_size=GSEA_MAX_SIZE, seed=42
             )
-            logger.info(f"{gmt_type.upper()} GSEA prerank completed. Results saved in: {sub_output_dir}")
-
-            # Filter GSEA results
-            filtered_results = gsea_results.res2d[
-                (gsea_results.res2d['NES'].abs() > 1.5) &
-                (gsea_results.res2d['FDR q-val'] < 0.25) &
-                (gsea_results.res2d['NOM p-val'] < 0.05)
-            ]
-            logger.info(f"Filtered {gmt_type.upper()} GSEA results to {len(filtered_results)} gene sets with "
-                        f"|NES| > 1.5, FDR < 0.25, NOM p-val < 0.05")
-
-            # Drop 'Name' column and save filtered GSEA results to CSV without index
-            filtered_results = filtered_results.drop(columns=['Name'], errors='ignore')
-            gsea_output_file = os.path.join(sub_output_dir, f"{gmt_type}_gsea_results.csv")
-            filtered_results.to_csv(gsea_output_file, index=False)
-            logger.info(f"Filtered {gmt_type.upper()} GSEA results CSV saved to: {gsea_output_file}")
-
-            # Update GSEA results with links
-            gsea_output_file = update_gsea_results_with_links(project, gsea_output_file, gmt_type, sub_output_dir)
-            output_files.append(gsea_output_file)
-
-            # Combine PDFs
-            prerank_dir = os.path.join(sub_output_dir, "prerank")
-            combined_pdf_path = os.path.join(sub_output_dir, f"{gmt_type}_gsea_plot.pdf")
-            merger = PdfMerger()
-            pdf_files = [f for f in os.listdir(prerank_dir) if f.endswith('.pdf')] if os.path.exists(prerank_dir) else []
-            
-            if pdf_files:
-                for pdf_file in sorted(pdf_files):
-                    pdf_path = os.path.join(prerank_dir, pdf_file)
-                    try:
-                        merger.append(pdf_path)
-                        logger.info(f"Added {pdf_path} to combined {gmt_type.upper()} PDF")
-                    except Exception as e:
-                        logger.warning(f"Failed to append {pdf_path}: {str(e)}")
+
+        library_outputs = {}
+        library_errors = []
+        with make_pool_executor(len(libraries)) as executor:
+            futures = {
+                executor.submit(run_gsea_library, ranked_list, project.species, gmt_type, gmt_path, output_dir, null_scores): gmt_type
+                for gmt_type, gmt_path in libraries.items()
+            }
+            for future in as_completed(futures):
+                gmt_type = futures[future]
                 try:
-                    merger.write(combined_pdf_path)
-                    logger.info(f"Combined {gmt_type.upper()} GSEA PDFs saved to: {combined_pdf_path}")
+                    library_outputs[gmt_type] = future.result()
                 except Exception as e:
-                    logger.error(f"Failed to save combined {gmt_type.upper()} PDF: {str(e)}")
-                    combined_pdf_path = None
-                finally:
-                    merger.close()
-            else:
-                logger.warning(f"No PDF files found in {prerank_dir}")
-                combined_pdf_path = None
+                    logger.error(f"{gmt_type.upper()} GSEA failed: {str(e)}")
+                    library_errors.append(f"{gmt_type.upper()}: {str(e)}")
 
+        output_files = []
+        for gmt_type in libraries:
+            if gmt_type not in library_outputs:
+                continue
+            combined_pdf_path = library_outputs[gmt_type]['plot_file']
+            gsea_output_file = library_outputs[gmt_type]['results_file']
             if combined_pdf_path and os.path.exists(combined_pdf_path):
                 file_size = os.path.getsize(combined_pdf_path)
                 ProjectFiles.objects.create(
@@ -353,185 +703,228 @@ def run_gsea(project, deseq2_output_file, gmt_paths, output_dir):
                         size=file_size
                     )
                     logger.info(f"Registered {gmt_type.upper()} GSEA file: {file_path} with size {file_size} bytes")
+                    output_files.append(file_path)
 
+        # The other libraries' outputs stay registered; the failed ones are reported
+        if library_errors:
+            raise RuntimeError('; '.join(library_errors))
         return output_files
 
     except Exception as e:
         logger.error(f"GSEA failed: {str(e)}")
-        return []
+        raise RuntimeError(f"GSEA failed: {str(e)}")
+
+def run_ora(project, deseq2_output_file, significant_output_file, gmt_paths, output_dir):
+    """
+    Run over-representation analysis (hypergeometric test, BH FDR) of the significant DESeq2
+    genes for every gene-set library (GO, KEGG) and register the filtered results with term links.
+
+    Args:
+        project: Project instance the results are registered to.
+        deseq2_output_file: Full DESeq2 results; its genes form the background.
+        significant_output_file: Filtered DESeq2 results; its genes are tested for enrichment.
+        gmt_paths: Mapping of gene-set library type to GMT path.
+        output_dir: Directory for the <type>/<type>_ora_results.csv outputs.
+
+    Returns:
+        list: Paths to the registered ORA result CSVs; raises RuntimeError if the analysis fails.
+    """
+    try:
+        universe = prepare_ranked_list(pd.read_csv(deseq2_output_file)).index
+        significant = prepare_ranked_list(pd.read_csv(significant_output_file)).index
+        output_files = []
+        for gmt_type, gmt_path in gmt_paths.items():
+            if not os.path.exists(gmt_path):
+                logger.warning(f"GMT file not found: {gmt_path}")
+                continue
+            sub_output_dir = os.path.join(output_dir, gmt_type)
+            os.makedirs(sub_output_dir, exist_ok=True)
+
+            results = over_representation(significant, universe, get_gene_set_index(gmt_path),
+                                          min_size=GSEA_MIN_SIZE, max_size=GSEA_MAX_SIZE)
+            filtered_results = results[results['Adjusted P-value'] < ORA_FDR_CUTOFF]
+            logger.info(f"{gmt_type.upper()} ORA: {len(filtered_results)} of {len(results)} gene sets "
+                        f"with adjusted p-value < {ORA_FDR_CUTOFF}")
+
+            ora_output_file = os.path.join(sub_output_dir, f"{gmt_type}_ora_results.csv")
+            add_term_links(filtered_results, gmt_path).to_csv(ora_output_file, index=False)
+
+            file_size = os.path.getsize(ora_output_file)
+            ProjectFiles.objects.create(
+                project=project,
+                type=f'{gmt_type}_ora_output',
+                path=ora_output_file,
+                is_directory=False,
+                file_format='csv',
+                size=file_size
+            )
+            logger.info(f"Registered {gmt_type.upper()} ORA file: {ora_output_file} with size {file_size} bytes")
+            output_files.append(ora_output_file)
+        return output_files
+
+    except Exception as e:
+        logger.error(f"ORA failed: {str(e)}")
+        raise RuntimeError(f"ORA failed: {str(e)}")
 
-def run_deseq2(project, counts_file, metadata_file, output_dir):
+def run_deseq2(project, counts_file, metadata_file, output_dir, on_results_ready=None):
     """
     Run DESeq2 on counts.csv and metadata.csv, adding gene symbols from GFF3.
+    The dataset is fitted once and every pairwise contrast between the conditions is tested on it;
+    the first contrast is written to output_dir and the others to output_dir/contrasts/<a>_vs_<b>.
     Filter results by project.pvalue_cutoff, log2FoldChange > 1, and baseMean > 10.
-    Generate cluster heatmap, PCA, and GSEA analysis.
+    Generate PCA, cluster heatmap, volcano and MA plots for the first contrast and heatmap, volcano
+    and MA plots for each other contrast; plots render in the render service while the other
+    contrasts are tested, and while whatever on_results_ready starts (the pipeline queues the
+    enrichment analysis, see run_enrichment) runs.
 
     Args:
         project: Project instance (contains species and pvalue_cutoff).
         counts_file: Path to counts.csv from FeatureCounts.
         metadata_file: Path to metadata.csv.
-        output_dir: Directory for DESeq2 and GSEA output (deseq2_results.csv, gsea_results.csv, and plots).
+        output_dir: Directory for DESeq2 output (deseq2_results.csv, deseq2_full_results.csv, and plots).
+        on_results_ready: Optional callable invoked once every contrast's results are saved and
+            registered, before waiting for the plots.
 
     Returns:
-        list: Paths to deseq2_results.csv, gsea_results.csv, and visualization PNGs/PDFs.
+        list: Paths to deseq2_results.csv and visualization PNGs.
     """
     os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, "deseq2_results.csv")
     full_output_file = os.path.join(output_dir, "deseq2_full_results.csv")
     heatmap_output = os.path.join(output_dir, "heatmap.png")
+    heatmap_order_output = os.path.join(output_dir, "heatmap_order.csv")
     pca_output = os.path.join(output_dir, "pca_plot.png")
+    volcano_output = os.path.join(output_dir, "volcano_plot.png")
+    ma_output = os.path.join(output_dir, "ma_plot.png")
 
-    species_to_gff3 = {
-        'human': 'Homo_sapiens.GRCh38.114.gff3',
-        'mouse': 'Mus_musculus.GRCm39.114.gff3',
-        'yeast': 'Saccharomyces_cerevisiae.R64-1-1.114.gff3',
-        'arabidopsis': 'Arabidopsis_thaliana.TAIR10.61.gff3',
-        'worm': 'Caenorhabditis_elegans.WBcel235.114.gff3',
-        'zebrafish': 'Danio_rerio.GRCz11.114.gff3',
-        'fly': 'Drosophila_melanogaster.BDGP6.54.61.gff3',
-        'rice': 'Oryza_sativa.IRGSP-1.0.61.gff3',
-        'maize': 'Zea_mays.Zm-B73-REFERENCE-NAM-5.0.61.gff3'
-    }
-    gff3_file = species_to_gff3.get(project.species.lower(), None)
-    if not gff3_file:
-        raise RuntimeError(f"No GFF3 file defined for species: {project.species}")
-    gff3_path = os.path.join(settings.BASE_DIR, 'rsa', 'references', 'gff3', gff3_file)
-    if not os.path.exists(gff3_path):
-        raise RuntimeError(f"GFF3 file not found: {gff3_path}")
+    gff3_path = get_gff3_path(project.species)
 
     try:
-        counts = pd.read_csv(counts_file, sep='\t')
-        counts = counts.set_index('Geneid')
-        columns_to_remove = ['Chr', 'Start', 'End', 'Strand', 'Length']
-        counts = counts.drop(columns=columns_to_remove, errors='ignore')
-        numeric_counts = counts.select_dtypes(include=['int64', 'float64'])
-        counts = counts[numeric_counts.sum(axis=1) > 0]
+        # Prefer the memory-mapped binary matrix written by FeatureCounts over re-parsing the text
+        counts = load_count_matrix(counts_file)
+        if counts is not None:
+            logger.info(f"Loaded binary count matrix for {counts_file}: {counts.shape}")
+            counts = counts[counts.sum(axis=1) > 0]
+        else:
+            # Read only the gene IDs and sample columns, with sample counts as int32
+            columns_to_remove = ['Chr', 'Start', 'End', 'Strand', 'Length']
+            header = pd.read_csv(counts_file, sep='\t', nrows=0).columns
+            sample_columns = [col for col in header if col != 'Geneid' and col not in columns_to_remove]
+            counts = pd.read_csv(counts_file, sep='\t', usecols=['Geneid'] + sample_columns, index_col='Geneid',
+                                 dtype={col: np.int32 for col in sample_columns})
+            counts = counts[counts.sum(axis=1) > 0]
         counts = counts.T
 
         metadata = pd.read_csv(metadata_file)
         metadata, counts = prepare_metadata(metadata, counts)
+        counts, genes_prefiltered = prefilter_counts(counts, metadata)
         
-        dds = DeseqDataSet(counts=counts, metadata=metadata, design='condition')
-        dds.deseq2()
-        stat_res = DeseqStats(dds, n_cpus=1, contrast=['condition', metadata['condition'].unique()[0], metadata['condition'].unique()[1]])
-        stat_res.summary()
-        results_df = stat_res.results_df
+        # Dispersion/LFC fitting and the Wald tests share one inference backend sized to the core budget
+        n_cpus = get_core_budget()
+        inference = DefaultInference(n_cpus=n_cpus)
+        timings = {}
+        dds = DeseqDataSet(counts=counts, metadata=metadata, design='condition', inference=inference, quiet=True, low_memory=True)
+        fit_deseq2(dds, timings)
+        logger.info(f"DESeq2 fitted {counts.shape[1]} genes x {counts.shape[0]} samples on {n_cpus} cores")
 
         gene_mapping = parse_gff3_for_symbols(gff3_path)
-        results_df['gene_symbol'] = results_df.index.map(gene_mapping)
-        
-        # Round numerical columns to 4 significant digits for full results
-        numeric_cols = results_df.select_dtypes(include=['float64', 'int64']).columns
-        results_df[numeric_cols] = results_df[numeric_cols].round(4)
-        results_df.to_csv(full_output_file)
-        logger.info(f"Full DESeq2 results saved to: {full_output_file}")
-        if os.path.exists(full_output_file):
-            file_size = os.path.getsize(full_output_file)
-            ProjectFiles.objects.create(
-                project=project,
-                type='deseq2_full_output',
-                path=full_output_file,
-                is_directory=False,
-                file_format='csv',
-                size=file_size
-            )
-            logger.info(f"Registered full DESeq2 output CSV: {full_output_file} with size {file_size} bytes")
-
-        pvalue_cutoff = project.pvalue_cutoff
-        results_df = results_df[
-            (results_df['padj'] < pvalue_cutoff) &
-            (results_df['log2FoldChange'].abs() > 1.0) &
-            (results_df['baseMean'] > 10.0)
-        ]
-        logger.info(f"Filtered DESeq2 results to {len(results_df)} genes with padj < {pvalue_cutoff}, "
-                    f"|log2FoldChange| > 1.0, and baseMean > 10.0")
-        
-        # Round numerical columns to 4 significant digits for filtered results
-        numeric_cols = results_df.select_dtypes(include=['float64', 'int64']).columns
-        results_df[numeric_cols] = results_df[numeric_cols].round(4)
-        results_df.to_csv(output_file)
-        logger.info(f"DESeq2 results saved to: {output_file}")
-
-        if os.path.exists(output_file):
-            file_size = os.path.getsize(output_file)
-            ProjectFiles.objects.create(
-                project=project,
-                type='deseq_output',
-                path=output_file,
-                is_directory=False,
-                file_format='csv',
-                size=file_size
-            )
-            logger.info(f"Registered DESeq2 output CSV: {output_file} with size {file_size} bytes")
-
+        save_expression_matrices(output_dir, dds, gene_mapping)
+        normed_counts = load_normalized_counts(output_dir)
+
+        # Every contrast is tested against the single fitted dataset; the first one is the
+        # primary comparison whose results keep the top-level file names
+        contrasts = get_contrasts(list(metadata['condition'].unique()))
+        primary_name = get_contrast_name(contrasts[0])
+        results_df = _timed(timings, f'wald_test_{primary_name}', run_contrast, dds, inference, contrasts[0], gene_mapping)
+        # Unrounded statistics for the volcano and MA plots (the saved results are rounded)
+        full_results_df = results_df[['baseMean', 'log2FoldChange', 'padj']].copy()
+        results_df, output_file = save_deseq2_results(project, results_df, output_dir, 'deseq2_full_output', 'deseq_output')
         output_files = [output_file]
-        create_pca_plot(counts, metadata, pca_output, project)
-        create_cluster_heatmap(dds, results_df, heatmap_output, project)
 
-        for plot_path in [heatmap_output, pca_output]:
-            if os.path.exists(plot_path):
-                file_size = os.path.getsize(plot_path)
-                ProjectFiles.objects.create(
-                    project=project,
-                    type='deseq2_visualization',
-                    path=plot_path,
-                    is_directory=False,
-                    file_format='png',
-                    size=file_size
-                )
-                logger.info(f"Registered DESeq2 visualization: {plot_path} with size {file_size} bytes")
-                output_files.append(plot_path)
-        
-        inspect_deseq2_output(output_file)
-
-        species_to_gmt = {
-            'human': {
-                'go': 'homo_sapiens_go.gmt',
-                'kegg': 'homo_sapiens_kegg.gmt'
-            },
-            'mouse': {
-                'go': 'mus_musculus_go.gmt',
-                'kegg': 'mus_musculus_kegg.gmt'
-            },
-            'yeast': {
-                'go': 'saccharomyces_cerevisiae_go.gmt',
-                'kegg': 'saccharomyces_cerevisiae_kegg.gmt'
-            },
-            'arabidopsis': {
-                'go': 'arabidopsis_thaliana_go.gmt',
-                'kegg': 'arabidopsis_thaliana_kegg.gmt'
-            },
-            'worm': {
-                'go': 'caenorhabditis_elegans_go.gmt',
-                'kegg': 'caenorhabditis_elegans_kegg.gmt'
-            },
-            'zebrafish': {
-                'go': 'danio_rerio_go.gmt',
-                'kegg': 'danio_rerio_kegg.gmt'
-            },
-            'fly': {
-                'go': 'drosophila_melanogaster_go.gmt',
-                'kegg': 'drosophila_melanogaster_kegg.gmt'
-            },
-            'rice': {
-                'go': 'oryza_sativa_go.gmt',
-                'kegg': 'oryza_sativa_kegg.gmt'
-            },
-            'maize': {
-                'go': 'zea_mays_go.gmt',
-                'kegg': 'zea_mays_kegg.gmt'
-            }
-        }
-        gmt_files = species_to_gmt.get(project.species.lower())
-        if gmt_files:
-            gmt_paths = {gmt_type: os.path.join(settings.BASE_DIR, 'rsa', 'references', 'gmt', gmt_file) for gmt_type, gmt_file in gmt_files.items()}
-            gsea_output_files = run_gsea(project, full_output_file, gmt_paths, output_dir)
-            output_files.extend(gsea_output_files)
-        else:
-            logger.warning(f"No GMT files defined for species: {project.species}")
+        # Plots are rendered by the render service from serialized data, concurrently with the
+        # remaining contrasts, and registered once those are done
+        plot_jobs = []
+        with make_render_executor() as renderer:
+            plot_jobs.append((renderer.submit(render_plot, 'pca', pca_plot_data(
+                counts, metadata, f"PCA Plot - {project.name}"), pca_output), pca_output, 'deseq2_visualization'))
+            try:
+                plot_jobs.append((renderer.submit(render_plot, 'heatmap', heatmap_plot_data(
+                    normed_counts, results_df, f"Clustered Heatmap - {project.name}"), heatmap_output),
+                    heatmap_output, 'deseq2_visualization'))
+                # The clustering order of the significant genes, beyond the plotted ones
+                plot_jobs.append((renderer.submit(write_cluster_order, cluster_order_data(normed_counts, results_df),
+                                                  heatmap_order_output), heatmap_order_output, 'heatmap_order'))
+            except ValueError:
+                logger.warning("Skipping heatmap: no significant genes")
+            change_data = expression_change_data(full_results_df, results_df, project.pvalue_cutoff,
+                                                 f"{project.name} ({contrasts[0][1]} vs {contrasts[0][2]})")
+            for kind, plot_path in [('volcano', volcano_output), ('ma', ma_output)]:
+                plot_jobs.append((renderer.submit(render_plot, kind, change_data, plot_path),
+                                  plot_path, 'deseq2_visualization'))
+
+            for contrast in contrasts[1:]:
+                contrast_name = get_contrast_name(contrast)
+                contrast_dir = os.path.join(output_dir, 'contrasts', contrast_name)
+                os.makedirs(contrast_dir, exist_ok=True)
+                contrast_df = _timed(timings, f'wald_test_{contrast_name}', run_contrast, dds, inference, contrast, gene_mapping)
+                full_contrast_df = contrast_df[['baseMean', 'log2FoldChange', 'padj']].copy()
+                contrast_df, contrast_output = save_deseq2_results(
+                    project, contrast_df, contrast_dir, 'deseq2_contrast_full_output', 'deseq2_contrast_output')
+                output_files.append(contrast_output)
+
+                # Contrast plots carry the contrast name, so downloads of different contrasts stay apart
+                contrast_change_data = expression_change_data(full_contrast_df, contrast_df, project.pvalue_cutoff,
+                                                              f"{project.name} ({contrast[1]} vs {contrast[2]})")
+                for kind in ['volcano', 'ma']:
+                    plot_path = os.path.join(contrast_dir, f"{contrast_name}_{kind}_plot.png")
+                    plot_jobs.append((renderer.submit(render_plot, kind, contrast_change_data, plot_path),
+                                      plot_path, 'deseq2_contrast_visualization'))
+                contrast_heatmap = os.path.join(contrast_dir, f"{contrast_name}_heatmap.png")
+                try:
+                    contrast_data = heatmap_plot_data(normed_counts, contrast_df,
+                                                      f"Clustered Heatmap - {project.name} ({contrast[1]} vs {contrast[2]})")
+                except ValueError:
+                    logger.warning(f"Skipping heatmap for contrast {contrast_name}")
+                    continue
+                plot_jobs.append((renderer.submit(render_plot, 'heatmap', contrast_data, contrast_heatmap),
+                                  contrast_heatmap, 'deseq2_contrast_visualization'))
+
+            logger.info(f"DESeq2 timings: {timings}")
+            write_deseq2_summary(project, output_dir, {
+                'n_cpus': n_cpus,
+                'n_genes': int(counts.shape[1]),
+                'n_genes_prefiltered': genes_prefiltered,
+                'n_samples': int(counts.shape[0]),
+                'contrasts': [get_contrast_name(contrast) for contrast in contrasts],
+                'timings': timings,
+            })
+
+            if on_results_ready:
+                on_results_ready()
+            output_files.extend(collect_plots(project, plot_jobs))
 
         return output_files
     
     except Exception as e:
         logger.error(f"DESeq2 failed: {str(e)}")
-        raise RuntimeError(f"DESeq2 failed: {str(e)}")
\ No newline at end of file
+        raise RuntimeError(f"DESeq2 failed: {str(e)}")
+
+def run_enrichment(project, output_dir):
+    """
+    Run the enrichment analysis of the first contrast on the DESeq2 results in output_dir:
+    GSEA prerank, or over-representation analysis of the significant genes when
+    project.enrichment_mode is 'ora'.
+
+    Returns:
+        list: Paths to the enrichment results CSVs and GSEA PDFs.
+    """
+    full_output_file = os.path.join(output_dir, "deseq2_full_results.csv")
+    output_file = os.path.join(output_dir, "deseq2_results.csv")
+    inspect_deseq2_output(output_file)
+
+    gmt_paths = get_gmt_paths(project.species)
+    if not gmt_paths:
+        logger.warning(f"No GMT files defined for species: {project.species}")
+        return []
+    if project.enrichment_mode == 'ora':
+        return run_ora(project, full_output_file, output_file, gmt_paths, output_dir)
+    return run_gsea(project, full_output_file, gmt_paths, output_dir)
@@ -0,0 +1,110 @@
+# rsa/util/expression.py
+import os
+import json
+import functools
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+EXPRESSION_MATRICES = {
+    'normalized': 'normalized_counts.npy',
+    'log': 'log_normalized_counts.npy',
+}
+EXPRESSION_INDEX = 'normalized_counts.json'
+
+def save_expression_matrices(output_dir, dds, gene_mapping=None):
+    """
+    Persist DESeq2-normalized and log2(normalized + 1) counts as float32 genes x samples .npy files.
+
+    Both matrices share one JSON index of gene IDs, gene symbols and sample names.
+
+    Args:
+        output_dir: DESeq2 output directory.
+        dds: Fitted DeseqDataSet.
+        gene_mapping: Optional gene_id -> gene symbol mapping.
+    """
+    normed_counts = np.ascontiguousarray(dds.layers['normed_counts'].T, dtype=np.float32)
+    np.save(os.path.join(output_dir, EXPRESSION_MATRICES['normalized']), normed_counts)
+    np.save(os.path.join(output_dir, EXPRESSION_MATRICES['log']), np.log2(normed_counts + 1.0, dtype=np.float32))
+    genes = dds.var_names.tolist()
+    gene_mapping = gene_mapping or {}
+    with open(os.path.join(output_dir, EXPRESSION_INDEX), 'w') as f:
+        json.dump({
+            'genes': genes,
+            'symbols': [gene_mapping.get(gene) or gene for gene in genes],
+            'samples': dds.obs_names.tolist(),
+        }, f)
+    logger.info(f"Saved {normed_counts.shape[0]} x {normed_counts.shape[1]} expression matrices to {output_dir}")
+
+@functools.lru_cache(maxsize=32)
+def _load_expression(matrix_path, index_path, mtime_ns):
+    """Memory-map an expression matrix and build its lookups (memoized per worker and file version)."""
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    genes = index['genes']
+    symbols = index.get('symbols') or genes
+    symbol_positions = {}
+    for position, symbol in enumerate(symbols):
+        symbol_positions.setdefault(symbol.upper(), []).append(position)
+    return {
+        'matrix': np.load(matrix_path, mmap_mode='r'),
+        'genes': genes,
+        'symbols': symbols,
+        'samples': index['samples'],
+        'gene_positions': {gene: position for position, gene in enumerate(genes)},
+        'symbol_positions': symbol_positions,
+    }
+
+def load_expression(output_dir, scale='normalized'):
+    """
+    Return the memory-mapped expression matrix of a DESeq2 output directory with its index.
+
+    Returns:
+        dict or None: matrix, genes, symbols, samples and position lookups; None if not persisted.
+    """
+    matrix_path = os.path.join(output_dir, EXPRESSION_MATRICES[scale])
+    index_path = os.path.join(output_dir, EXPRESSION_INDEX)
+    if not (os.path.exists(matrix_path) and os.path.exists(index_path)):
+        return None
+    return _load_expression(matrix_path, index_path, os.stat(matrix_path).st_mtime_ns)
+
+def load_normalized_counts(output_dir):
+    """Normalized counts as a memory-mapped genes x samples DataFrame (None if not persisted)."""
+    expression = load_expression(output_dir)
+    if expression is None:
+        return None
+    return pd.DataFrame(expression['matrix'], index=expression['genes'], columns=expression['samples'], copy=False)
+
+def query_expression(output_dir, genes, scale='normalized'):
+    """
+    Look up per-sample expression values for a list of gene IDs or gene symbols.
+
+    Gene IDs are matched exactly, symbols case-insensitively (a symbol may match several gene IDs).
+
+    Returns:
+        dict: samples, one entry per matched gene (gene_id, symbol, values) and the unmatched names;
+        None if the expression matrices were not persisted.
+    """
+    expression = load_expression(output_dir, scale)
+    if expression is None:
+        return None
+    positions, missing = [], []
+    for gene in genes:
+        position = expression['gene_positions'].get(gene)
+        matched = [position] if position is not None else expression['symbol_positions'].get(gene.upper(), [])
+        if not matched:
+            missing.append(gene)
+        positions.extend(matched)
+
+    values = np.asarray(expression['matrix'][positions], dtype=np.float64).round(4) if positions else np.empty((0, 0))
+    return {
+        'scale': scale,
+        'samples': expression['samples'],
+        'genes': [
+            {'gene_id': expression['genes'][position], 'symbol': expression['symbols'][position], 'values': row}
+            for position, row in zip(positions, values.tolist())
+        ],
+        'missing': missing,
+    }
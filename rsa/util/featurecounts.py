@@ -1,14 +1,140 @@
 # rsa/util/featurecounts.py
 import os
+import json
+import shutil
+import tempfile
+import functools
 import subprocess
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+import numpy as np
+import pandas as pd
 from django.conf import settings
 from rsa.models import Project, ProjectFiles
+from .annotation import get_saf_path
+from .resources import get_core_budget, get_scratch_dir
+from .samtools import decode_cram
 import re
 
 
 logger = logging.getLogger(__name__)
 
+# Columns featureCounts writes before the per-sample counts
+ANNOTATION_COLUMNS = ['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length']
+
+@functools.lru_cache(maxsize=None)
+def check_featurecounts():
+    """Verify FeatureCounts is installed (checked once per worker process)."""
+    try:
+        subprocess.run(['featureCounts', '-v'], capture_output=True, text=True, check=True)
+        logger.debug("FeatureCounts is installed and accessible")
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        logger.error("FeatureCounts is not installed or not found in PATH")
+        raise RuntimeError("FeatureCounts is not installed or not found in PATH")
+
+def get_sample_column_name(bam_path):
+    """Sample name used as the counts column header for a BAM path."""
+    filename = os.path.basename(bam_path)
+    # Remove .fastq and everything after it
+    filename = re.sub(r'\.fastq.*$', '', filename)
+    filename = re.sub(r'\.sorted.*$', '', filename)
+    return filename
+
+def build_featurecounts_cmd(saf_path, counts_file, sequencing_type, bam_files, threads=1):
+    """Build the featureCounts command line for a set of BAM files."""
+    cmd = [
+        'featureCounts',
+        '-F', 'SAF',  # Precompiled gene-level annotation (gene_id per GFF3 `gene` feature)
+        '-a', saf_path,  # Annotation file
+        '-o', counts_file,  # Output counts file
+        '-T', str(threads),  # Threads from the worker's core budget
+    ]
+
+    # Adjust parameters based on sequencing type
+    if sequencing_type.lower() == 'paired':
+        cmd.append('-p')  # Paired-end mode
+        cmd.append('--countReadPairs')  # Count read pairs instead of individual reads
+
+    # Add BAM files to the command
+    cmd.extend(bam_files)
+    return cmd
+
+def _decode_crams(bam_files, species, decode_dir, threads):
+    """featureCounts cannot read CRAM, so decode retained CRAMs to temporary BAMs."""
+    return [
+        decode_cram(path, species, os.path.join(decode_dir, f"{os.path.splitext(os.path.basename(path))[0]}.bam"), threads)
+        if path.endswith('.cram') else path
+        for path in bam_files
+    ]
+
+def rewrite_counts_header(counts_file):
+    """
+    Drop featureCounts' command comment and shorten BAM paths in the header to sample names.
+
+    The data rows are streamed through unchanged, so the file is never held in memory.
+    """
+    tmp_file = f"{counts_file}.tmp"
+    with open(counts_file, 'r') as src, open(tmp_file, 'w') as dst:
+        src.readline()  # First line is the featureCounts command comment
+        header = src.readline().rstrip('\n').split('\t')  # Second line is the header
+        header[1:] = [get_sample_column_name(col) for col in header[1:]]
+        dst.write('\t'.join(header) + '\n')
+        shutil.copyfileobj(src, dst, 4 * 1024 * 1024)
+    os.replace(tmp_file, counts_file)
+    logger.info(f"Post-processed counts.csv to use second row as header and removed first row")
+
+def get_count_matrix_paths(counts_file):
+    """Paths of the binary count matrix (.npy) and its gene/sample index (.json) for a counts.csv."""
+    base = os.path.splitext(counts_file)[0]
+    return f"{base}.matrix.npy", f"{base}.matrix.json"
+
+def save_count_matrix(counts_file, counts, genes, samples):
+    """Persist a genes x samples count matrix as int32 .npy with a JSON gene/sample index."""
+    matrix_path, index_path = get_count_matrix_paths(counts_file)
+    np.save(matrix_path, np.ascontiguousarray(counts, dtype=np.int32))
+    with open(index_path, 'w') as f:
+        json.dump({'genes': [str(gene) for gene in genes], 'samples': [str(sample) for sample in samples]}, f)
+    logger.info(f"Saved {len(genes)} x {len(samples)} count matrix to {matrix_path}")
+    return matrix_path
+
+def write_count_matrix(counts_file):
+    """Convert a post-processed counts.csv into the binary count matrix."""
+    header = pd.read_csv(counts_file, sep='\t', nrows=0).columns
+    samples = [col for col in header if col not in ANNOTATION_COLUMNS]
+    counts = pd.read_csv(counts_file, sep='\t', usecols=['Geneid'] + samples, index_col='Geneid',
+                         dtype={sample: np.int32 for sample in samples})
+    return save_count_matrix(counts_file, counts[samples].to_numpy(), counts.index, samples)
+
+def load_count_matrix(counts_file):
+    """
+    Load the binary count matrix for a counts.csv as a memory-mapped genes x samples DataFrame.
+
+    Returns:
+        DataFrame or None: None if the matrix has not been written for this counts file.
+    """
+    matrix_path, index_path = get_count_matrix_paths(counts_file)
+    if not (os.path.exists(matrix_path) and os.path.exists(index_path)):
+        return None
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    counts = np.load(matrix_path, mmap_mode='r')
+    return pd.DataFrame(counts, index=pd.Index(index['genes'], name='Geneid'), columns=index['samples'], copy=False)
+
+def register_counts_file(project, counts_file):
+    """Register counts.csv as a ProjectFiles entry."""
+    if os.path.exists(counts_file):
+        file_size = os.path.getsize(counts_file) if os.path.isfile(counts_file) else None
+        ProjectFiles.objects.create(
+            project=project,
+            type='featurecounts_counts',
+            path=counts_file,
+            is_directory=False,
+            file_format='csv',
+            size=file_size
+        )
+        logger.info(f"Registered FeatureCounts output: {counts_file} with size {file_size} bytes")
+
 def run_featurecounts(project, input_files, output_dir):
     """
     Run FeatureCounts to quantify reads from BAM files into a single counts.csv file.
@@ -23,38 +149,10 @@ def run_featurecounts(project, input_files, output_dir):
     """
     os.makedirs(output_dir, exist_ok=True)
     counts_file = os.path.join(output_dir, "counts.csv")
-    
-    # Map species to GFF3 annotation file
-    species_to_gff3 = {
-        'human': 'Homo_sapiens.GRCh38.114.gff3',
-        'mouse': 'Mus_musculus.GRCm39.114.gff3',
-        'yeast': 'Saccharomyces_cerevisiae.R64-1-1.114.gff3',
-        'arabidopsis': 'Arabidopsis_thaliana.TAIR10.61.gff3',
-        'worm': 'Caenorhabditis_elegans.WBcel235.114.gff3',
-        'zebrafish': 'Danio_rerio.GRCz11.114.gff3',
-        'fly': 'Drosophila_melanogaster.BDGP6.54.61.gff3',
-        'rice': 'Oryza_sativa.IRGSP-1.0.61.gff3',
-        'maize': 'Zea_mays.Zm-B73-REFERENCE-NAM-5.0.61.gff3'
-    }
-    gff3_file = species_to_gff3.get(project.species.lower(), None)
-    if not gff3_file:
-        logger.error(f"No GFF3 annotation file defined for species: {project.species}")
-        raise RuntimeError(f"No GFF3 annotation file defined for species: {project.species}")
-
-    # Use the provided annotation directory
-    gff3_path = os.path.join(settings.BASE_DIR, 'rsa', 'references', 'gff3', gff3_file)
-    logger.debug(f"Checking for GFF3 annotation at: {gff3_path}")
-    if not os.path.exists(gff3_path):
-        logger.error(f"GFF3 annotation file not found: {gff3_path}")
-        raise RuntimeError(f"GFF3 annotation file not found: {gff3_path}")
-
-    # Verify FeatureCounts is installed
-    try:
-        subprocess.run(['featureCounts', '-v'], capture_output=True, text=True, check=True)
-        logger.debug("FeatureCounts is installed and accessible")
-    except subprocess.CalledProcessError as e:
-        logger.error("FeatureCounts is not installed or not found in PATH")
-        raise RuntimeError("FeatureCounts is not installed or not found in PATH")
+
+    saf_path = get_saf_path(project.species)
+    logger.debug(f"Using SAF annotation at: {saf_path}")
+    check_featurecounts()
 
     # Collect BAM file paths
     bam_files = [input_file.path for input_file in input_files if input_file.type == 'samtools_bam']
@@ -62,64 +160,166 @@ def run_featurecounts(project, input_files, output_dir):
         logger.error("No BAM files found for FeatureCounts")
         raise RuntimeError("No BAM files found for FeatureCounts")
 
-    # Build FeatureCounts command
-    cmd = [
-        'featureCounts',
-        '-F', 'GFF',  # Specify GFF format for annotation
-        '-a', gff3_path,  # Annotation file
-        '-o', counts_file,  # Output counts file
-        '-g', 'gene_id',  # Count reads per gene ID
-        '-t', 'gene',  # Feature type to count
-    ]
-
-    # Adjust parameters based on sequencing type
-    sequencing_type = project.sequencing_type.lower()
-    if sequencing_type == 'paired':
-        cmd.append('-p')  # Paired-end mode
-        cmd.append('--countReadPairs')  # Count read pairs instead of individual reads
+    threads = get_core_budget()
+    decode_dir = None
+    if any(path.endswith('.cram') for path in bam_files):
+        decode_dir = tempfile.mkdtemp(prefix='featurecounts_', dir=get_scratch_dir())
+        try:
+            bam_files = _decode_crams(bam_files, project.species, decode_dir, threads)
+        except Exception:
+            shutil.rmtree(decode_dir, ignore_errors=True)
+            raise
 
-    # Add BAM files to the command
-    cmd.extend(bam_files)
+    cmd = build_featurecounts_cmd(saf_path, counts_file, project.sequencing_type, bam_files, threads)
 
     logger.debug(f"FeatureCounts command: {' '.join(cmd)}")
     try:
         result = subprocess.run(cmd, capture_output=True, text=True, check=True)
         logger.info(f"FeatureCounts completed: {counts_file}")
-        
+
         # Post-process counts.csv to remove first row and use second row as header
         if os.path.exists(counts_file):
-            with open(counts_file, 'r') as f:
-                lines = f.readlines()
-            if len(lines) > 1:  # Ensure there are at least two lines
-                header = lines[1].strip().split('\t')  # Second line is the header
-                for i, col in enumerate(header):
-                    if i > 0:  # Skip first column (Geneid)
-                        filename = os.path.basename(col)
-                        # Remove .fastq and everything after it
-                        filename = re.sub(r'\.fastq.*$', '', filename)
-                        filename = re.sub(r'\.sorted.*$', '', filename)
-                        header[i] = filename
-                # Write header (second row) and data rows (third row onward)
-                with open(counts_file, 'w') as f:
-                    f.write('\t'.join(header) + '\n')  # Write modified header
-                    f.writelines(lines[2:])  # Write data rows
-                logger.info(f"Post-processed counts.csv to use second row as header and removed first row")
+            rewrite_counts_header(counts_file)
+            write_count_matrix(counts_file)
 
         # Register counts.csv file
-        if os.path.exists(counts_file):
-            file_size = os.path.getsize(counts_file) if os.path.isfile(counts_file) else None
-            ProjectFiles.objects.create(
-                project=project,
-                type='featurecounts_counts',
-                path=counts_file,
-                is_directory=False,
-                file_format='csv',
-                size=file_size
-            )
-            logger.info(f"Registered FeatureCounts output: {counts_file} with size {file_size} bytes")
+        register_counts_file(project, counts_file)
 
         return [counts_file]
-    
+
     except subprocess.CalledProcessError as e:
         logger.error(f"FeatureCounts failed: {e.stderr}")
-        raise RuntimeError(f"FeatureCounts failed: {e.stderr}")
\ No newline at end of file
+        raise RuntimeError(f"FeatureCounts failed: {e.stderr}")
+    finally:
+        if decode_dir:
+            shutil.rmtree(decode_dir, ignore_errors=True)
+
+def count_sample(saf_path, species, sequencing_type, bam_path, shard_dir, threads=1, popen=subprocess.Popen):
+    """
+    Count one sample's BAM (or CRAM) into its own featureCounts shard.
+
+    featureCounts is started with popen, which lets FeatureCountsShards track the process.
+
+    Returns:
+        str: Path to the per-sample featureCounts output.
+    """
+    sample_name = get_sample_column_name(bam_path)
+    shard_file = os.path.join(shard_dir, f"{sample_name}.counts.txt")
+    decode_dir = tempfile.mkdtemp(prefix=f"featurecounts_{sample_name}_", dir=get_scratch_dir()) if bam_path.endswith('.cram') else None
+    try:
+        input_path = _decode_crams([bam_path], species, decode_dir, threads)[0] if decode_dir else bam_path
+        cmd = build_featurecounts_cmd(saf_path, shard_file, sequencing_type, [input_path], threads)
+        logger.debug(f"FeatureCounts shard command: {' '.join(cmd)}")
+        process = popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            logger.error(f"FeatureCounts failed for {bam_path}: {stderr}")
+            raise RuntimeError(f"FeatureCounts failed for {bam_path}: {stderr}")
+        logger.info(f"FeatureCounts shard completed for {bam_path}: {shard_file}")
+        return shard_file
+    finally:
+        if decode_dir:
+            shutil.rmtree(decode_dir, ignore_errors=True)
+
+def merge_count_shards(shard_files, sample_names, counts_file):
+    """
+    Merge per-sample featureCounts shards into one counts.csv in a single vectorized step.
+
+    The annotation columns are taken from the first shard; every shard contributes its
+    count column, which must follow the same gene order.
+    """
+    annotation = pd.read_csv(shard_files[0], sep='\t', comment='#', usecols=range(len(ANNOTATION_COLUMNS)))
+    counts = np.column_stack([
+        pd.read_csv(shard_file, sep='\t', comment='#', usecols=[len(ANNOTATION_COLUMNS)], dtype=np.int64).iloc[:, 0].to_numpy()
+        for shard_file in shard_files
+    ])
+    if counts.shape[0] != len(annotation):
+        raise RuntimeError("FeatureCounts shards do not share the same annotation")
+    merged = pd.concat([annotation, pd.DataFrame(counts, columns=sample_names)], axis=1)
+    merged.to_csv(counts_file, sep='\t', index=False)
+    save_count_matrix(counts_file, counts, annotation['Geneid'], sample_names)
+    logger.info(f"Merged {len(shard_files)} FeatureCounts shards into {counts_file}")
+    return counts_file
+
+class FeatureCountsShards:
+    """
+    Count samples as independent jobs as soon as their sorted BAMs are ready,
+    then merge the per-sample counts into the project's counts.csv.
+
+    Counting runs alongside SAMtools sorting, so it is sized to its own share of the cores
+    (core_budget, default: the whole core budget).
+    """
+
+    def __init__(self, project, output_dir, core_budget=None):
+        self.project = project
+        self.output_dir = output_dir
+        self.shard_dir = os.path.join(output_dir, 'shards')
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.saf_path = get_saf_path(project.species)
+        check_featurecounts()
+
+        core_budget = core_budget or get_core_budget()
+        self.threads = max(1, min(4, core_budget // 2))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, core_budget // self.threads))
+        self.futures = {}
+        # featureCounts processes started by the shards, killed if counting is shut down early
+        self.processes = []
+        self.processes_lock = threading.Lock()
+        self.stopped = False
+
+    def submit(self, bam_path):
+        """Queue counting for one sample; safe to call from SAMtools worker threads."""
+        if bam_path not in self.futures:
+            logger.info(f"Queued FeatureCounts shard for {bam_path}")
+            self.futures[bam_path] = self.executor.submit(
+                count_sample, self.saf_path, self.project.species, self.project.sequencing_type,
+                bam_path, self.shard_dir, self.threads, self._start_process
+            )
+
+    def _start_process(self, cmd, **kwargs):
+        """Start a shard's featureCounts process, unless counting has been shut down."""
+        with self.processes_lock:
+            if self.stopped:
+                raise RuntimeError("FeatureCounts counting was stopped")
+            process = subprocess.Popen(cmd, **kwargs)
+            self.processes.append(process)
+            return process
+
+    def merge(self, bam_files):
+        """
+        Wait for every sample's shard and merge them into counts.csv.
+
+        Returns:
+            list: Path to the generated counts.csv file (single file as a list for consistency).
+        """
+        if not bam_files:
+            logger.error("No BAM files found for FeatureCounts")
+            raise RuntimeError("No BAM files found for FeatureCounts")
+        for bam_path in bam_files:
+            self.submit(bam_path)
+        try:
+            # Stop at the first failing shard instead of waiting on the samples queued before it
+            done, _ = wait([self.futures[bam_path] for bam_path in bam_files], return_when=FIRST_EXCEPTION)
+            for future in done:
+                future.result()
+            shard_files = [self.futures[bam_path].result() for bam_path in bam_files]
+        finally:
+            self.shutdown()
+
+        counts_file = os.path.join(self.output_dir, "counts.csv")
+        merge_count_shards(shard_files, [get_sample_column_name(path) for path in bam_files], counts_file)
+        register_counts_file(self.project, counts_file)
+        shutil.rmtree(self.shard_dir, ignore_errors=True)
+        return [counts_file]
+
+    def shutdown(self):
+        """Stop accepting work, drop shards that have not started and kill running featureCounts processes."""
+        with self.processes_lock:
+            self.stopped = True
+            processes = list(self.processes)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            if process.poll() is None:
+                logger.warning(f"Killing FeatureCounts shard process {process.pid}")
+                process.kill()
+                process.wait()
@@ -0,0 +1,87 @@
+# rsa/util/genesets.py
+import os
+import functools
+import logging
+import numpy as np
+from django.conf import settings
+from .cache import get_cached_artifact
+
+logger = logging.getLogger(__name__)
+
+def build_gmt_index(gmt_path, index_path):
+    """
+    Compile a GMT file into a binary gene-set index (.npz).
+
+    Gene symbols are interned to integer IDs; every set is stored as a sorted, de-duplicated
+    int32 array inside one concatenated `members` array delimited by `offsets`, with its size.
+    """
+    symbol_ids = {}
+    terms, term_ids, members, offsets = [], [], [], [0]
+    with open(gmt_path, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3:
+                continue
+            ids = np.unique(np.fromiter(
+                (symbol_ids.setdefault(symbol, len(symbol_ids)) for symbol in fields[2:] if symbol),
+                dtype=np.int32
+            ))
+            terms.append(fields[0])
+            term_ids.append(fields[1])
+            members.append(ids)
+            offsets.append(offsets[-1] + len(ids))
+
+    with open(index_path, 'wb') as f:
+        np.savez(
+            f,
+            symbols=np.array(list(symbol_ids), dtype=str),
+            terms=np.array(terms, dtype=str),
+            term_ids=np.array(term_ids, dtype=str),
+            members=np.concatenate(members) if members else np.array([], dtype=np.int32),
+            offsets=np.array(offsets, dtype=np.int64),
+            sizes=np.diff(np.array(offsets, dtype=np.int64)).astype(np.int32),
+        )
+    logger.info(f"Compiled {len(terms)} gene sets over {len(symbol_ids)} genes from {gmt_path}")
+
+def get_gmt_index_path(gmt_path):
+    """Return the compiled index of a GMT file, rebuilt when the GMT checksum changes."""
+    index_dir = os.path.join(settings.BASE_DIR, 'rsa', 'references', 'gmt_index')
+    return get_cached_artifact(gmt_path, index_dir, '.npz', build_gmt_index)
+
+@functools.lru_cache(maxsize=16)
+def load_gmt_index(index_path):
+    """
+    Load a compiled gene-set index (memoized per worker).
+
+    Returns:
+        dict: symbols, terms, term_ids, members, offsets and sizes arrays.
+    """
+    with np.load(index_path) as index:
+        return {key: index[key] for key in index.files}
+
+def get_gene_set_index(gmt_path):
+    """Return the compiled gene-set index of a GMT file."""
+    return load_gmt_index(get_gmt_index_path(gmt_path))
+
+@functools.lru_cache(maxsize=32)
+def _load_gene_sets(index_path, min_size):
+    index = load_gmt_index(index_path)
+    symbols = index['symbols']
+    keep = np.flatnonzero(index['sizes'] >= min_size)
+    return {
+        index['terms'][i]: symbols[index['members'][index['offsets'][i]:index['offsets'][i + 1]]].tolist()
+        for i in keep
+    }
+
+def load_gene_sets(gmt_path, min_size=0):
+    """
+    Gene sets of a GMT file as {term: [gene symbols]}, read from the compiled index.
+
+    Sets with fewer than min_size genes are dropped up front; they can never reach min_size
+    genes once overlapped with a ranked list. The maximum size applies to that overlap, so it
+    is left to the enrichment run. The returned dict is shared between callers and must not
+    be modified.
+    """
+    gene_sets = _load_gene_sets(get_gmt_index_path(gmt_path), min_size)
+    logger.info(f"Loaded {len(gene_sets)} gene sets with at least {min_size} genes from {gmt_path}")
+    return gene_sets
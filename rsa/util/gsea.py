@@ -0,0 +1,355 @@
+# rsa/util/gsea.py
+import os
+import logging
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_pdf import PdfPages
+from gseapy.plot import gseaplot
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on permuted positions (permutations x ranked genes) held in memory per batch
+PERMUTATION_BATCH_ELEMENTS = 2 ** 24
+
+def sort_ranking(ranked_list):
+    """Sort a ranked list (gene symbol -> metric) in descending order, dropping missing values."""
+    ranked_list = ranked_list.dropna()
+    return ranked_list.iloc[np.argsort(-ranked_list.to_numpy(dtype=float), kind='stable')]
+
+def map_gene_sets(index, gene_names, min_size, max_size):
+    """
+    Overlap the sets of a compiled gene-set index with a sorted ranked list.
+
+    Every set becomes the sorted positions of its member genes in the ranked list, as gseapy does;
+    a duplicated gene name only matches its first (highest ranked) occurrence.
+
+    Args:
+        index (dict): Compiled gene-set index (see rsa.util.genesets.load_gmt_index).
+        gene_names (array): Gene names of the sorted ranked list.
+        min_size, max_size (int): Limits on the number of overlapping genes.
+
+    Returns:
+        tuple: Indices of the kept sets and a list with their hit positions.
+    """
+    n_genes = len(gene_names)
+    unique_names, first = np.unique(gene_names, return_index=True)
+    positions = pd.Index(unique_names).get_indexer(index['symbols'])
+    symbol_positions = np.where(positions >= 0, first[positions], -1)
+
+    member_positions = symbol_positions[index['members']]
+    set_ids = np.repeat(np.arange(len(index['sizes'])), index['sizes'])
+    found = member_positions >= 0
+    member_positions, set_ids = member_positions[found], set_ids[found]
+    order = np.lexsort((member_positions, set_ids))
+    member_positions, set_ids = member_positions[order], set_ids[order]
+
+    overlap = np.bincount(set_ids, minlength=len(index['sizes']))
+    bounds = np.concatenate([[0], np.cumsum(overlap)])
+    keep = np.flatnonzero((overlap >= min_size) & (overlap <= max_size) & (overlap < n_genes))
+    return keep, [member_positions[bounds[i]:bounds[i + 1]] for i in keep]
+
+def enrichment_scores(hits, weights, n_genes):
+    """
+    Enrichment scores of many gene sets of equal size at once.
+
+    The running sum only peaks right after a hit and bottoms out right before one, so the
+    scores are computed from the hit positions alone instead of walking the full ranked list.
+
+    Args:
+        hits (array): Sets x size matrix of sorted hit positions.
+        weights (array): |metric| ** weight for every position of the ranked list.
+        n_genes (int): Length of the ranked list.
+
+    Returns:
+        tuple: Enrichment score of each set and the column of the hit where it is reached.
+    """
+    size = hits.shape[1]
+    hit_weights = weights[hits]
+    running = np.cumsum(hit_weights, axis=1)
+    norm = running[:, -1:]
+    misses = (hits - np.arange(size)) / (n_genes - size)
+    peaks = running / norm - misses
+    troughs = (running - hit_weights) / norm - misses
+
+    top, bottom = peaks.argmax(axis=1), troughs.argmin(axis=1)
+    rows = np.arange(len(hits))
+    max_es, min_es = peaks[rows, top], troughs[rows, bottom]
+    positive = np.abs(max_es) > np.abs(min_es)
+    return np.where(positive, max_es, min_es), np.where(positive, top, bottom)
+
+def running_enrichment_score(hits, weights, n_genes):
+    """Full running enrichment score of one gene set over the ranked list, for plotting."""
+    tag = np.zeros(n_genes, dtype=bool)
+    tag[hits] = True
+    norm = weights[hits].sum()
+    return np.cumsum(np.where(tag, weights / norm, -1.0 / (n_genes - len(hits))))
+
+def null_enrichment_scores(weights, sizes, permutations, seed):
+    """
+    Enrichment scores of random gene sets for every gene-set size.
+
+    Each permutation shuffles the ranked positions once; the first k shuffled positions form a
+    random set of size k, so one batched shuffle serves all sizes. Permutations are processed in
+    batches of at most PERMUTATION_BATCH_ELEMENTS positions.
+
+    Returns:
+        array: Sizes x permutations matrix of null enrichment scores.
+    """
+    n_genes = len(weights)
+    rng = np.random.default_rng(seed)
+    batch_size = max(1, min(permutations, PERMUTATION_BATCH_ELEMENTS // n_genes))
+    es_null = np.empty((len(sizes), permutations))
+    for start in range(0, permutations, batch_size):
+        stop = min(start + batch_size, permutations)
+        shuffled = rng.permuted(np.tile(np.arange(n_genes, dtype=np.int32), (stop - start, 1)), axis=1)
+        for i, size in enumerate(sizes):
+            es_null[i, start:stop], _ = enrichment_scores(np.sort(shuffled[:, :size], axis=1), weights, n_genes)
+    return es_null
+
+def shared_null_enrichment_scores(ranked_list, indexes, permutations=1000, min_size=15, max_size=500,
+                                  weight=1.0, seed=42):
+    """
+    Null enrichment scores of every gene-set size of several indexes against one ranked list.
+
+    Null scores do not depend on set membership, so prerank runs of the libraries of one ranking
+    can share them: computed once here, they are passed to prerank as null_scores, including to
+    runs in worker processes.
+
+    Returns:
+        dict: size -> null scores array.
+    """
+    ranking = sort_ranking(ranked_list)
+    gene_names = ranking.index.to_numpy(dtype=str)
+    weights = np.abs(ranking.to_numpy(dtype=float)) ** weight
+    sizes = set()
+    for index in indexes:
+        _, hit_positions = map_gene_sets(index, gene_names, min_size, max_size)
+        sizes.update(len(hits) for hits in hit_positions)
+    if not sizes:
+        return {}
+    sizes = np.array(sorted(sizes))
+    return dict(zip(sizes.tolist(), null_enrichment_scores(weights, sizes, permutations, seed)))
+
+def _count_at_least(sorted_values, cumulative, values):
+    return cumulative[-1] - cumulative[np.searchsorted(sorted_values, values, side='left')]
+
+def _count_at_most(sorted_values, cumulative, values):
+    return cumulative[np.searchsorted(sorted_values, values, side='right')]
+
+def _count_below(sorted_values, cumulative, values):
+    return cumulative[np.searchsorted(sorted_values, values, side='left')]
+
+def _sign_fraction(sorted_values, cumulative, values, positive):
+    """Share of the same-signed values at or beyond each value (>= for positive, <= for negative)."""
+    return np.where(
+        positive,
+        _count_at_least(sorted_values, cumulative, values) / _count_at_least(sorted_values, cumulative, 0),
+        _count_at_most(sorted_values, cumulative, values) / _count_below(sorted_values, cumulative, 0)
+    )
+
+def gsea_significance(es, size_index, es_null, size_counts):
+    """
+    NES, nominal p-values, FDR and FWER p-values with gseapy's definitions.
+
+    Gene sets of the same size share one null distribution (row of es_null), so nothing is
+    expanded to sets x permutations; the pooled NES null used for the FDR weights every row
+    by the number of sets of that size.
+
+    Returns:
+        tuple: nes, pvals, fdrs and fwer arrays, one value per gene set.
+    """
+    permutations = es_null.shape[1]
+    counts = np.arange(permutations + 1)
+    positive = es >= 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        positive_null = es_null >= 0
+        null_pos_mean = np.where(positive_null, es_null, 0).sum(axis=1) / positive_null.sum(axis=1)
+        null_neg_mean = np.where(positive_null, 0, es_null).sum(axis=1) / (~positive_null).sum(axis=1)
+        nes = np.where(positive, es / null_pos_mean[size_index], -es / null_neg_mean[size_index])
+        nes_null = np.where(positive_null, es_null / null_pos_mean[:, None], -es_null / null_neg_mean[:, None])
+
+        # Nominal p-value against the same-signed part of the set's null (gseapy counts
+        # null >= ES for positive and null < ES for negative scores)
+        pvals = np.empty(len(es))
+        for i, null in enumerate(np.sort(es_null, axis=1)):
+            members = np.flatnonzero(size_index == i)
+            pvals[members] = np.where(
+                positive[members],
+                _count_at_least(null, counts, es[members]) / _count_at_least(null, counts, 0),
+                _count_below(null, counts, es[members]) / _count_below(null, counts, 0)
+            )
+
+        # FDR: share of the pooled null beyond the NES over the share of observed sets beyond it
+        order = np.argsort(nes_null, axis=None)
+        null_values = nes_null.ravel()[order]
+        null_cumulative = np.concatenate([[0], np.cumsum(np.repeat(size_counts, permutations)[order])])
+        observed = np.sort(nes)
+        fdrs = (_sign_fraction(null_values, null_cumulative, nes, positive)
+                / _sign_fraction(observed, np.arange(len(observed) + 1), nes, positive))
+        fdrs = np.nan_to_num(np.minimum(fdrs, 1.0), nan=1.0)
+
+        # FWER: chance that the most extreme same-signed NES of any set reaches the NES. Nulls of
+        # different sizes come from prefixes of the same shuffles and are correlated, so the
+        # maximum is taken over independent draws from each set's null instead:
+        # 1 - prod over sets of P(null NES short of the NES)
+        log_none = np.zeros(len(es))
+        for null, count in zip(np.sort(nes_null, axis=1), size_counts):
+            beyond = np.where(positive, _count_at_least(null, counts, nes), _count_at_most(null, counts, nes))
+            log_none += count * np.log1p(-beyond / permutations)
+        fwer = -np.expm1(log_none)
+    return nes, pvals, fdrs, fwer
+
+def term_running_score(ranking, index, term, weight=1.0):
+    """
+    Hit positions and running enrichment score of one term over a sorted ranking.
+
+    Returns:
+        tuple: Hit positions and running score arrays, or None if the term is not in the index.
+    """
+    matches = np.flatnonzero(index['terms'] == term)
+    if not len(matches):
+        return None
+    start, stop = index['offsets'][matches[0]], index['offsets'][matches[0] + 1]
+    gene_names = ranking.index.to_numpy(dtype=str)
+    unique_names, first = np.unique(gene_names, return_index=True)
+    positions = pd.Index(unique_names).get_indexer(index['symbols'][index['members'][start:stop]])
+    hits = np.sort(first[positions[positions >= 0]])
+    if not len(hits):
+        return None
+    weights = np.abs(ranking.to_numpy(dtype=float)) ** weight
+    return hits, running_enrichment_score(hits, weights, len(gene_names))
+
+def plot_term(ranking, index, record):
+    """
+    gseaplot figure of one result row (Term, NES, NOM p-val, FDR q-val) over a sorted ranking.
+
+    Returns:
+        Figure: A standalone figure (not registered with pyplot), or None if the term has no hits.
+    """
+    running = term_running_score(ranking, index, record['Term'])
+    if running is None:
+        return None
+    hits, running_score = running
+    axes = gseaplot(
+        term=record['Term'],
+        hits=hits.tolist(),
+        nes=record['NES'],
+        pval=record['NOM p-val'],
+        fdr=record['FDR q-val'],
+        RES=running_score,
+        rank_metric=ranking,
+        ofname=None
+    )
+    return axes[0].figure
+
+def write_enrichment_pdf(results, ranked_list, index, pdf_path, top_n=20):
+    """
+    Write the enrichment plots of the top_n results by |NES| into one PDF.
+
+    Pages are streamed into the PDF one figure at a time, so no per-term files are written and
+    at most one figure is alive; the other terms are left to render_term_plot.
+
+    Returns:
+        str: pdf_path, or None if no term could be plotted.
+    """
+    top = results.reindex(results['NES'].abs().sort_values(ascending=False, kind='stable').index).head(top_n)
+    if top.empty:
+        return None
+    ranking = sort_ranking(ranked_list)
+    pages = 0
+    with PdfPages(pdf_path) as pdf:
+        for _, record in top.iterrows():
+            figure = plot_term(ranking, index, record)
+            if figure is None:
+                logger.warning(f"No ranked genes to plot for term {record['Term']}")
+                continue
+            pdf.savefig(figure, bbox_inches='tight')
+            figure.clear()
+            pages += 1
+    if not pages:
+        os.remove(pdf_path)
+        return None
+    logger.info(f"Wrote {pages} enrichment plots to {pdf_path}")
+    return pdf_path
+
+def render_term_plot(ranked_list, index, record, output_path):
+    """Render the enrichment plot of one result row to output_path; returns None if the term has no hits."""
+    figure = plot_term(sort_ranking(ranked_list), index, record)
+    if figure is None:
+        return None
+    figure.savefig(output_path, bbox_inches='tight')
+    figure.clear()
+    return output_path
+
+def prerank(ranked_list, index, permutations=1000, min_size=15, max_size=500, weight=1.0, seed=42,
+            null_scores=None):
+    """
+    GSEA prerank of a ranked list against a compiled gene-set index.
+
+    Scores all gene sets against all permutations as batched NumPy operations over the integer
+    positions of the ranked list.
+
+    Args:
+        ranked_list (Series): Gene symbol -> ranking metric.
+        index (dict): Compiled gene-set index (see rsa.util.genesets.get_gene_set_index).
+        permutations (int): Number of gene permutations.
+        min_size, max_size (int): Limits on the number of genes overlapping the ranked list.
+        weight (float): Exponent of the metric weighting the running sum.
+        seed (int): Random seed of the permutations.
+        null_scores (dict): Precomputed null scores by gene-set size (see
+            shared_null_enrichment_scores); used when it covers every size of the index.
+
+    Returns:
+        DataFrame: gseapy res2d-compatible results (Name, Term, ES, NES, NOM p-val, FDR q-val,
+        FWER p-val, Tag %, Gene %, Lead_genes) sorted by |NES|.
+    """
+    ranking = sort_ranking(ranked_list)
+    gene_names = ranking.index.to_numpy(dtype=str)
+    n_genes = len(gene_names)
+    weights = np.abs(ranking.to_numpy(dtype=float)) ** weight
+    columns = ['Name', 'Term', 'ES', 'NES', 'NOM p-val', 'FDR q-val', 'FWER p-val', 'Tag %', 'Gene %', 'Lead_genes']
+
+    set_ids, hit_positions = map_gene_sets(index, gene_names, min_size, max_size)
+    logger.info(f"{len(set_ids)} gene sets with {min_size}-{max_size} genes in the ranked list of {n_genes} genes")
+    if not len(set_ids):
+        return pd.DataFrame(columns=columns)
+
+    # Observed scores, computed for all sets of one size at a time
+    set_sizes = np.array([len(hits) for hits in hit_positions])
+    sizes, size_index, size_counts = np.unique(set_sizes, return_inverse=True, return_counts=True)
+    es = np.empty(len(set_ids))
+    extreme = np.empty(len(set_ids), dtype=int)
+    for i, size in enumerate(sizes):
+        members = np.flatnonzero(size_index == i)
+        es[members], extreme[members] = enrichment_scores(
+            np.vstack([hit_positions[m] for m in members]), weights, n_genes)
+
+    if null_scores is not None and all(int(size) in null_scores for size in sizes):
+        es_null = np.vstack([null_scores[int(size)] for size in sizes])
+    else:
+        es_null = null_enrichment_scores(weights, sizes, permutations, seed)
+    nes, pvals, fdrs, fwer = gsea_significance(es, size_index, es_null, size_counts)
+    logger.info(f"Scored {len(set_ids)} gene sets against {permutations} permutations")
+
+    tag_pct, gene_pct, lead_genes = [], [], []
+    for hits, score, m in zip(hit_positions, es, extreme):
+        leading = hits[:m + 1] if score >= 0 else hits[m:][::-1]
+        gene_fraction = (hits[m] + 1) / n_genes if score >= 0 else (n_genes - hits[m] + 1) / n_genes
+        tag_pct.append(f"{len(leading)}/{len(hits)}")
+        gene_pct.append(f"{gene_fraction:.2%}")
+        lead_genes.append(';'.join(gene_names[leading]))
+
+    results = pd.DataFrame({
+        'Name': 'prerank',
+        'Term': index['terms'][set_ids],
+        'ES': es,
+        'NES': nes,
+        'NOM p-val': pvals,
+        'FDR q-val': fdrs,
+        'FWER p-val': fwer,
+        'Tag %': tag_pct,
+        'Gene %': gene_pct,
+        'Lead_genes': lead_genes,
+    }, columns=columns)
+    results = results.reindex(results['NES'].abs().sort_values(ascending=False, kind='stable').index)
+    return results.reset_index(drop=True)
@@ -1,11 +1,232 @@
 import os
+import gzip
+import shutil
+import tempfile
+import threading
 import subprocess
 import logging
 from django.conf import settings
 from rsa.models import Project, ProjectFiles
+from .resources import get_core_budget, get_memory_budget, get_scratch_dir
+from .samtools import get_sort_memory_per_thread
 
 logger = logging.getLogger(__name__)
 
+# Separates the sample index from the original read name in batched alignment mode
+BATCH_READ_TAG_SEPARATOR = '|'
+
+def get_sample_base_name(fastq_path, paired=False):
+    """Derive the sample name used for alignment outputs from a (trimmed) FASTQ path."""
+    base_name = os.path.splitext(os.path.basename(fastq_path))[0]
+    if paired:
+        base_name = base_name.replace('_tpaired_R1', '').replace('_tpaired_r1', '')
+        return base_name.replace('_R1', '').replace('_r1', '')
+    return base_name.replace('_trimmed', '')
+
+def get_alignment_samples(input_files, sequencing_type):
+    """
+    Group alignment input files into samples.
+
+    Returns:
+        list: Tuples (sample_name, [fastq paths]) with one path for single-end and
+              (forward, reverse) paths for paired-end samples.
+    """
+    if sequencing_type == 'paired':
+        from .trimmomatic import find_paired_files
+        paired_files = find_paired_files(input_files)
+        if not paired_files:
+            logger.error("No paired-end files found for paired-end project")
+            raise RuntimeError("No paired-end files found for paired-end project")
+        return [(get_sample_base_name(forward_path, paired=True), [forward_path, reverse_path])
+                for forward_path, reverse_path in paired_files]
+    return [(get_sample_base_name(input_file.path), [input_file.path]) for input_file in input_files]
+
+def _open_fastq(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def _write_tagged_reads(samples, mate, destination, errors):
+    """
+    Stream all samples' reads for one mate into a FIFO, prefixing read names with the sample index.
+
+    A read failure (e.g. a truncated .gz) is appended to errors: closing the FIFO looks like a
+    normal end of input to HISAT2, so the caller must re-raise it.
+    """
+    try:
+        with open(destination, 'wb', buffering=1024 * 1024) as out:
+            for sample_index, (sample_name, fastq_paths) in enumerate(samples):
+                prefix = f"@{sample_index}{BATCH_READ_TAG_SEPARATOR}".encode()
+                with _open_fastq(fastq_paths[mate]) as fastq:
+                    for line_number, line in enumerate(fastq):
+                        out.write(prefix + line[1:] if line_number % 4 == 0 else line)
+    except BrokenPipeError:
+        logger.warning(f"HISAT2 stopped reading batched input {destination}")
+    except Exception as e:
+        logger.error(f"Failed to stream batched input {destination}: {str(e)}")
+        errors.append(e)
+
+def _release_writers(fifos, writers):
+    """Unblock and join FIFO writers whose reader is gone or never opened the FIFO."""
+    while any(writer.is_alive() for writer in writers):
+        for fifo in fifos:
+            try:
+                os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        for writer in writers:
+            writer.join(timeout=1)
+
+def _split_alignments(hisat2_stdout, samples, output_bams, work_dir, sorters):
+    """
+    Demultiplex HISAT2 SAM output (binary) by sample in a single pass, tagging each record with
+    its read group and feeding it to a per-sample `samtools sort`.
+
+    Sorters are appended to the caller's sorters list as (process, stderr file) as soon as they
+    start, so the caller can reap them if demultiplexing fails.
+    """
+    header_lines = []
+    read_groups = [f"\tRG:Z:{sample_name}\n".encode() for sample_name, _ in samples]
+    separator = BATCH_READ_TAG_SEPARATOR.encode()
+    # All per-sample sorts run at once and share the worker's memory budget
+    largest_input = max(sum(os.path.getsize(path) for path in fastq_paths) for _, fastq_paths in samples)
+    sort_memory = get_sort_memory_per_thread(largest_input, memory_budget=get_memory_budget() // len(samples))
+
+    def start_sorters():
+        for (sample_name, _), output_bam in zip(samples, output_bams):
+            stderr_file = open(os.path.join(work_dir, f"{sample_name}.sort.log"), 'w+')
+            sort_cmd = ['samtools', 'sort', '-o', output_bam, '-m', sort_memory,
+                        '-T', os.path.join(work_dir, f"{sample_name}.sort"), '-']
+            logger.debug(f"SAMtools sort command: {' '.join(sort_cmd)}")
+            process = subprocess.Popen(sort_cmd, stdin=subprocess.PIPE, stderr=stderr_file)
+            sorters.append((process, stderr_file))
+            process.stdin.writelines(header_lines)
+            process.stdin.write(f"@RG\tID:{sample_name}\tSM:{sample_name}\n".encode())
+
+    for line in hisat2_stdout:
+        if line.startswith(b'@'):
+            header_lines.append(line)
+            continue
+        if not sorters:
+            start_sorters()
+        qname, record = line.split(b'\t', 1)
+        sample_index, read_name = qname.split(separator, 1)
+        sample_index = int(sample_index)
+        sorters[sample_index][0].stdin.write(read_name + b'\t' + record.rstrip(b'\n') + read_groups[sample_index])
+
+    if not sorters:
+        start_sorters()
+
+def _kill_processes(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+        try:
+            if process.stdin:
+                process.stdin.close()
+        except OSError:
+            pass
+        process.wait()
+
+def run_hisat2_batched(project, samples, index_base, output_dir):
+    """
+    Align all samples of a project with a single HISAT2 process so the index is loaded once.
+
+    Read names are tagged with their sample index on the way in, and the SAM stream is split
+    back into per-sample, read-group tagged, coordinate-sorted BAM files on the way out.
+
+    Args:
+        project: Project instance.
+        samples: List of (sample_name, [fastq paths]) from get_alignment_samples.
+        index_base: HISAT2 index prefix.
+        output_dir: Directory for HISAT2 output (BAM files).
+
+    Returns:
+        list: Paths to generated BAM files.
+    """
+    paired = len(samples[0][1]) == 2
+    output_bams = [os.path.join(output_dir, f"{sample_name}.bam") for sample_name, _ in samples]
+    work_dir = tempfile.mkdtemp(prefix='hisat2_batch_', dir=get_scratch_dir())
+    try:
+        fifos = []
+        for mate in range(2 if paired else 1):
+            fifo = os.path.join(work_dir, f"reads_{mate + 1}.fastq")
+            os.mkfifo(fifo)
+            fifos.append(fifo)
+
+        cmd = ['hisat2', '-p', str(get_core_budget()), '-x', index_base]
+        if paired:
+            cmd.extend(['-1', fifos[0], '-2', fifos[1]])
+        else:
+            cmd.extend(['-U', fifos[0]])
+        logger.debug(f"Batched HISAT2 command for {len(samples)} samples: {' '.join(cmd)}")
+
+        writer_errors = []
+        writers = [threading.Thread(target=_write_tagged_reads, args=(samples, mate, fifo, writer_errors), daemon=True)
+                   for mate, fifo in enumerate(fifos)]
+        for writer in writers:
+            writer.start()
+
+        with open(os.path.join(work_dir, 'hisat2.log'), 'w+') as hisat2_log:
+            hisat2_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=hisat2_log, bufsize=1024 * 1024)
+            sorters = []
+            try:
+                _split_alignments(hisat2_process.stdout, samples, output_bams, work_dir, sorters)
+            except BaseException:
+                # Do not leave HISAT2, the sorters or the FIFO writers behind
+                _kill_processes([hisat2_process] + [process for process, _ in sorters])
+                for _, stderr_file in sorters:
+                    stderr_file.close()
+                _release_writers(fifos, writers)
+                raise
+            hisat2_process.wait()
+            if hisat2_process.returncode != 0:
+                # Release writers still blocked opening a FIFO that HISAT2 never read
+                _release_writers(fifos, writers)
+            for writer in writers:
+                writer.join()
+
+            sort_errors = []
+            for (sample_name, _), (process, stderr_file) in zip(samples, sorters):
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+                process.wait()
+                if process.returncode != 0:
+                    stderr_file.seek(0)
+                    sort_errors.append(f"{sample_name}: {stderr_file.read()}")
+                stderr_file.close()
+
+            if hisat2_process.returncode != 0:
+                hisat2_log.seek(0)
+                hisat2_stderr = hisat2_log.read()
+                logger.error(f"Batched HISAT2 failed: {hisat2_stderr}")
+                raise RuntimeError(f"HISAT2 failed: {hisat2_stderr}")
+        if writer_errors:
+            # HISAT2 saw a normal end of input, so the affected samples are truncated
+            logger.error(f"Reading batched HISAT2 input failed: {writer_errors}")
+            raise RuntimeError(f"Reading FASTQ input failed: {'; '.join(str(e) for e in writer_errors)}")
+        if sort_errors:
+            logger.error(f"SAMtools sort failed for batched alignment: {sort_errors}")
+            raise RuntimeError(f"HISAT2 or samtools failed: {'; '.join(sort_errors)}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    logger.info(f"Batched HISAT2 and samtools completed for {len(samples)} samples")
+    for output_bam in output_bams:
+        file_size = os.path.getsize(output_bam) if os.path.isfile(output_bam) else None
+        ProjectFiles.objects.create(
+            project=project,
+            type='hisat2_bam',
+            path=output_bam,
+            is_directory=False,
+            file_format='bam',
+            size=file_size
+        )
+        logger.info(f"Registered HISAT2 output: {output_bam} with size {file_size} bytes")
+    return output_bams
+
 def run_hisat2(project, input_files, output_dir, data_txt_paths):
     """
     Run HISAT2 alignment on trimmed or untrimmed FASTQ files for a project.
@@ -50,6 +271,14 @@ def run_hisat2(project, input_files, output_dir, data_txt_paths):
             logger.error(f"Index directory does not exist: {index_dir}")
         raise RuntimeError(f"HISAT2 index not found: {index_base}")
     
+    # Small projects are aligned in one HISAT2 process to avoid per-sample index loading
+    samples = get_alignment_samples(input_files, sequencing_type)
+    batch_max_bytes = getattr(settings, 'HISAT2_BATCH_MAX_BYTES', 0)
+    total_input_size = sum(os.path.getsize(path) for _, paths in samples for path in paths if os.path.isfile(path))
+    if len(samples) > 1 and total_input_size <= batch_max_bytes:
+        logger.info(f"Using batched HISAT2 alignment for {len(samples)} samples ({total_input_size} bytes)")
+        return run_hisat2_batched(project, samples, index_base, output_dir)
+    
     if sequencing_type == 'paired':
         from .trimmomatic import find_paired_files
         paired_files = find_paired_files(input_files)
@@ -59,9 +288,7 @@ def run_hisat2(project, input_files, output_dir, data_txt_paths):
         
         for forward_path, reverse_path in paired_files:
             # Extract base name by removing _R1 or _R2 (case-insensitive) from forward file
-            base_name = os.path.splitext(os.path.basename(forward_path))[0]
-            base_name = base_name.replace('_tpaired_R1', '').replace('_tpaired_r1', '')
-            base_name = base_name.replace('_R1', '').replace('_r1', '')  # Additional removal for _R1/_r1
+            base_name = get_sample_base_name(forward_path, paired=True)
             output_bam = os.path.join(output_dir, f"{base_name}.bam")
             
             cmd = [
@@ -102,7 +329,7 @@ def run_hisat2(project, input_files, output_dir, data_txt_paths):
     else:
         for input_file in input_files:
             fastq_path = input_file.path
-            base_name = os.path.splitext(os.path.basename(fastq_path))[0].replace('_trimmed', '')
+            base_name = get_sample_base_name(fastq_path)
             output_bam = os.path.join(output_dir, f"{base_name}.bam")
             
             cmd = [
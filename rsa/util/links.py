@@ -0,0 +1,100 @@
+# rsa/util/links.py
+import os
+import re
+import json
+import functools
+import logging
+from django.conf import settings
+from .cache import get_cached_artifact
+from .resources import get_core_budget, make_pool_executor
+
+logger = logging.getLogger(__name__)
+
+# KEGG pathway (hsa/ath/osa/zma + 5 digits), KEGG network (N + 5 digits), GO and HPO term IDs
+TERM_ID_PATTERN = re.compile(r'^(?:(?P<kegg>hsa|ath|osa|zma)\d{5}|N\d{5}|(?P<ontology>GO|HP):\d{7})$')
+
+ONTOLOGY_LINKS = {
+    'GO': 'https://www.ebi.ac.uk/QuickGO/term/{}',
+    'HP': 'https://next.monarchinitiative.org/{}',
+}
+
+def get_term_link(term_id):
+    """Return the database link of a KEGG, GO or HPO term ID, or None if the ID is not recognized."""
+    match = TERM_ID_PATTERN.match(term_id)
+    if not match:
+        return None
+    if match.group('kegg'):
+        return f"https://www.genome.jp/dbget-bin/www_bget?pathway:{term_id}"
+    if match.group('ontology'):
+        return ONTOLOGY_LINKS[match.group('ontology')].format(term_id)
+    return f"https://www.genome.jp/entry/{term_id}"
+
+def build_link_index(gmt_path, index_path):
+    """
+    Compile the term -> link index of a GMT file into JSON.
+
+    The term ID is taken from the first or second GMT column, whichever matches; the index is
+    keyed by the first column, the term name enrichment results report.
+    """
+    links = {}
+    with open(gmt_path, 'r') as f:
+        for line in f:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) < 2:
+                continue
+            link = get_term_link(columns[0]) or get_term_link(columns[1])
+            if link:
+                links[columns[0]] = link
+    with open(index_path, 'w') as f:
+        json.dump(links, f)
+    logger.info(f"Compiled {len(links)} term links from {gmt_path}")
+
+def get_link_index_path(gmt_path):
+    """Return the term -> link index of a GMT file, rebuilt when the GMT checksum changes."""
+    links_dir = os.path.join(settings.BASE_DIR, 'rsa', 'references', 'term_links')
+    return get_cached_artifact(gmt_path, links_dir, '.links.json', build_link_index)
+
+@functools.lru_cache(maxsize=32)
+def load_term_links(index_path):
+    """Load a compiled term -> link index (memoized per worker)."""
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+def get_term_links(gmt_path):
+    """Return the term -> link mapping of a GMT file."""
+    return load_term_links(get_link_index_path(gmt_path))
+
+def build_link_indexes(gmt_dir=None):
+    """
+    Compile the term -> link index of every GMT file in gmt_dir (default rsa/references/gmt),
+    all species in parallel.
+
+    Returns:
+        dict: GMT path -> index path of the compiled indexes.
+    """
+    gmt_dir = gmt_dir or os.path.join(settings.BASE_DIR, 'rsa', 'references', 'gmt')
+    gmt_paths = sorted(os.path.join(gmt_dir, name) for name in os.listdir(gmt_dir) if name.endswith('.gmt'))
+    if not gmt_paths:
+        logger.warning(f"No GMT files found in {gmt_dir}")
+        return {}
+
+    with make_pool_executor(max(1, min(len(gmt_paths), get_core_budget()))) as executor:
+        index_paths = dict(zip(gmt_paths, executor.map(get_link_index_path, gmt_paths)))
+    logger.info(f"Term link indexes ready for {len(index_paths)} GMT files")
+    return index_paths
+
+def add_term_links(results_df, gmt_path):
+    """
+    Insert a Link column after Term, looked up in the memoized term -> link index of gmt_path.
+
+    Returns:
+        DataFrame: The results with links (unchanged if the index cannot be built).
+    """
+    try:
+        links = get_term_links(gmt_path)
+    except Exception as e:
+        logger.error(f"Failed to load term links for {gmt_path}: {str(e)}")
+        return results_df
+    results_df = results_df.drop(columns=['Link'], errors='ignore')
+    results_df.insert(results_df.columns.get_loc('Term') + 1, 'Link', results_df['Term'].map(links.get))
+    return results_df
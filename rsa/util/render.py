@@ -0,0 +1,211 @@
+# rsa/util/render.py
+import logging
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from scipy.cluster.hierarchy import dendrogram, leaves_list
+from django.conf import settings
+from .resources import make_pool_executor
+
+logger = logging.getLogger(__name__)
+
+try:
+    # fastcluster (in requirements.txt) is a drop-in linkage about twice as fast on large heatmaps
+    from fastcluster import linkage
+    LINKAGE_BACKEND = 'fastcluster'
+except ImportError:
+    from scipy.cluster.hierarchy import linkage
+    LINKAGE_BACKEND = 'scipy'
+    logger.warning("fastcluster is not installed; heatmap clustering uses scipy's slower linkage")
+
+# Plot jobs are (kind, data, output_path): data is a dict of plain arrays and strings, so jobs
+# pickle cheaply to the render worker processes. Renderers build standalone Figures (never
+# registered with pyplot), which keeps them independent of pyplot's global state.
+
+def render_pca(data):
+    """PCA scatter of the samples: data holds pcs (samples x 2), variance (2,), conditions and title."""
+    figure = Figure(figsize=(8, 6))
+    ax = figure.add_subplot()
+    pcs = np.asarray(data['pcs'])
+    conditions = np.asarray(data['conditions'])
+    for condition in dict.fromkeys(data['conditions']):
+        mask = conditions == condition
+        ax.scatter(pcs[mask, 0], pcs[mask, 1], s=100, label=condition, edgecolors='white')
+    ax.legend(title='Condition')
+    ax.set_title(data['title'])
+    ax.set_xlabel(f"PC1 ({data['variance'][0]:.2%} variance)")
+    ax.set_ylabel(f"PC2 ({data['variance'][1]:.2%} variance)")
+    figure.tight_layout()
+    return figure
+
+def z_score_rows(values):
+    """Standardize every row (ddof=1), as seaborn's clustermap(z_score=0) does; constant rows become 0."""
+    values = np.asarray(values, dtype=np.float64)
+    std = values.std(axis=1, ddof=1, keepdims=True)
+    return np.nan_to_num((values - values.mean(axis=1, keepdims=True)) / np.where(std > 0, std, np.nan))
+
+def cluster_order(values):
+    """Leaf order and linkage of average-linkage euclidean clustering of the rows (None for a single row)."""
+    if len(values) < 2:
+        return np.arange(len(values)), None
+    tree = linkage(values, method='average', metric='euclidean')
+    return leaves_list(tree), tree
+
+def _draw_dendrogram(ax, tree, orientation):
+    ax.set_axis_off()
+    if tree is not None:
+        dendrogram(tree, orientation=orientation, ax=ax, no_labels=True, link_color_func=lambda k: 'black')
+        for collection in ax.collections:
+            collection.set_rasterized(True)
+
+def render_heatmap(data):
+    """
+    Clustered heatmap with row and column dendrograms.
+
+    data holds values (genes x samples, log scale), genes, samples, title and max_labels; rows
+    are z-scored and both axes are clustered by average linkage, as seaborn's clustermap(z_score=0)
+    does. Cells are rasterized, and an axis with more than max_labels entries is left unlabeled.
+    """
+    z = z_score_rows(data['values'])
+    row_order, row_tree = cluster_order(z)
+    col_order, col_tree = cluster_order(z.T)
+    max_labels = data.get('max_labels', 100)
+
+    figure = Figure(figsize=(10, 8))
+    grid = figure.add_gridspec(2, 2, width_ratios=[0.2, 1], height_ratios=[0.2, 1],
+                               wspace=0.02, hspace=0.02, left=0.02, right=0.85, bottom=0.15, top=0.92)
+    _draw_dendrogram(figure.add_subplot(grid[1, 0]), row_tree, 'left')
+    _draw_dendrogram(figure.add_subplot(grid[0, 1]), col_tree, 'top')
+    ax = figure.add_subplot(grid[1, 1])
+    mesh = ax.pcolormesh(z[np.ix_(row_order, col_order)], cmap='RdYlBu_r', rasterized=True)
+    ax.set_xlim(0, len(col_order))
+    ax.set_ylim(0, len(row_order))
+    ax.yaxis.tick_right()
+    ax.yaxis.set_label_position('right')
+    if len(col_order) <= max_labels:
+        ax.set_xticks(np.arange(len(col_order)) + 0.5)
+        ax.set_xticklabels(np.asarray(data['samples'])[col_order], rotation=90)
+    else:
+        ax.set_xticks([])
+        ax.set_xlabel(f"{len(col_order)} samples")
+    if len(row_order) <= max_labels:
+        ax.set_yticks(np.arange(len(row_order)) + 0.5)
+        ax.set_yticklabels(np.asarray(data['genes'])[row_order])
+    else:
+        ax.set_yticks([])
+        ax.set_ylabel(f"{len(row_order)} genes")
+    ax.tick_params(length=0)
+    # Color bar in the free top-left corner, as clustermap places it
+    corner = figure.add_subplot(grid[0, 0])
+    corner.set_axis_off()
+    figure.colorbar(mesh, cax=corner.inset_axes([0.2, 0.1, 0.1, 0.8]), label='Z-score')
+    figure.suptitle(data['title'])
+    return figure
+
+def write_cluster_order(data, output_path):
+    """
+    Write the heatmap clustering order of the given genes as CSV; runs in a render worker or inline.
+
+    data holds values (genes x samples, log scale), genes and annotations (column -> per-gene
+    values) that are written alongside the order.
+
+    Returns:
+        str: output_path.
+    """
+    row_order, _ = cluster_order(z_score_rows(data['values']))
+    order = pd.DataFrame({'Geneid': np.asarray(data['genes'])[row_order]})
+    for column, values in data.get('annotations', {}).items():
+        order[column] = np.asarray(values)[row_order]
+    order.insert(0, 'order', np.arange(1, len(order) + 1))
+    order.to_csv(output_path, index=False)
+    logger.info(f"Wrote clustering order of {len(order)} genes ({LINKAGE_BACKEND} linkage) to: {output_path}")
+    return output_path
+
+def render_volcano(data):
+    """
+    Volcano plot: data holds log2fc, padj, significant (bool mask), padj_cutoff, log2fc_cutoff and title.
+    Genes without an adjusted p-value are left out.
+    """
+    log2fc = np.asarray(data['log2fc'], dtype=np.float64)
+    padj = np.asarray(data['padj'], dtype=np.float64)
+    significant = np.asarray(data['significant'], dtype=bool)
+    tested = ~np.isnan(padj) & ~np.isnan(log2fc)
+    score = -np.log10(np.maximum(padj, np.finfo(np.float64).tiny))
+
+    figure = Figure(figsize=(8, 6))
+    ax = figure.add_subplot()
+    groups = [
+        (tested & ~significant, 'lightgrey', 'Not significant'),
+        (tested & significant & (log2fc > 0), '#d62728', 'Up'),
+        (tested & significant & (log2fc < 0), '#1f77b4', 'Down'),
+    ]
+    for mask, color, label in groups:
+        ax.scatter(log2fc[mask], score[mask], s=6, c=color, label=f"{label} ({int(mask.sum())})", linewidths=0)
+    ax.axhline(-np.log10(data['padj_cutoff']), color='grey', linestyle='--', linewidth=0.8)
+    for cutoff in (-data['log2fc_cutoff'], data['log2fc_cutoff']):
+        ax.axvline(cutoff, color='grey', linestyle='--', linewidth=0.8)
+    ax.legend(markerscale=2)
+    ax.set_title(data['title'])
+    ax.set_xlabel('log2 fold change')
+    ax.set_ylabel('-log10 adjusted p-value')
+    figure.tight_layout()
+    return figure
+
+def render_ma(data):
+    """MA plot: data holds base_mean, log2fc, significant (bool mask) and title."""
+    base_mean = np.asarray(data['base_mean'], dtype=np.float64)
+    log2fc = np.asarray(data['log2fc'], dtype=np.float64)
+    significant = np.asarray(data['significant'], dtype=bool)
+    shown = (base_mean > 0) & ~np.isnan(log2fc)
+
+    figure = Figure(figsize=(8, 6))
+    ax = figure.add_subplot()
+    ax.scatter(base_mean[shown & ~significant], log2fc[shown & ~significant], s=6, c='lightgrey', linewidths=0)
+    ax.scatter(base_mean[shown & significant], log2fc[shown & significant], s=6, c='#d62728', linewidths=0,
+               label=f"Significant ({int((shown & significant).sum())})")
+    ax.axhline(0, color='grey', linewidth=0.8)
+    ax.set_xscale('log')
+    ax.legend(markerscale=2)
+    ax.set_title(data['title'])
+    ax.set_xlabel('Mean of normalized counts')
+    ax.set_ylabel('log2 fold change')
+    figure.tight_layout()
+    return figure
+
+PLOT_RENDERERS = {
+    'pca': render_pca,
+    'heatmap': render_heatmap,
+    'volcano': render_volcano,
+    'ma': render_ma,
+}
+
+def render_plot(kind, data, output_path):
+    """
+    Render one plot job to output_path; runs in a render worker or inline.
+
+    The figure is cleared once saved, so no figure outlives its job.
+
+    Returns:
+        str: output_path.
+    """
+    renderer = PLOT_RENDERERS.get(kind)
+    if renderer is None:
+        logger.error(f"Unknown plot kind: {kind}")
+        raise RuntimeError(f"Unknown plot kind: {kind}")
+    figure = renderer(data)
+    try:
+        figure.savefig(output_path)
+    finally:
+        figure.clear()
+    logger.info(f"Rendered {kind} plot to: {output_path}")
+    return output_path
+
+def make_render_executor():
+    """
+    Process pool of the plot render service, with PLOT_RENDER_WORKERS workers (default 2).
+
+    The pool lives for one run, so the memory of rendering is returned once the run finishes.
+    """
+    return make_pool_executor(max(1, int(getattr(settings, 'PLOT_RENDER_WORKERS', 2))))
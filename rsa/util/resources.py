@@ -0,0 +1,79 @@
+import os
+import tempfile
+import logging
+from concurrent.futures import Executor, Future
+from billiard.pool import Pool
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+def get_core_budget():
+    """Number of cores a pipeline worker may use (PIPELINE_THREADS, default: all usable cores)."""
+    threads = getattr(settings, 'PIPELINE_THREADS', None)
+    if threads:
+        return max(1, int(threads))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def get_memory_budget():
+    """
+    Bytes of memory a pipeline worker may use.
+
+    Uses PIPELINE_MEMORY_MB when set, otherwise half of the physical (or cgroup-limited) memory.
+    """
+    memory_mb = getattr(settings, 'PIPELINE_MEMORY_MB', None)
+    if memory_mb:
+        return int(memory_mb) * 1024 * 1024
+
+    total_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    try:
+        with open('/sys/fs/cgroup/memory.max', 'r') as f:
+            limit = f.read().strip()
+        if limit.isdigit():
+            total_memory = min(total_memory, int(limit))
+    except OSError:
+        pass
+    return total_memory // 2
+
+def get_scratch_dir():
+    """Fast local directory for temporary files (PIPELINE_SCRATCH_DIR, default: system temp dir)."""
+    scratch_dir = getattr(settings, 'PIPELINE_SCRATCH_DIR', None) or tempfile.gettempdir()
+    os.makedirs(scratch_dir, exist_ok=True)
+    return str(scratch_dir)
+
+class PoolExecutor(Executor):
+    """
+    concurrent.futures executor over a billiard process pool.
+
+    billiard, Celery's fork of multiprocessing, lets daemonic processes such as Celery prefork
+    workers start children (multiprocessing's ProcessPoolExecutor refuses to), so CPU-bound
+    work runs in separate processes inside the pipeline as well.
+    """
+
+    def __init__(self, max_workers):
+        self._pool = Pool(processes=max_workers)
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def set_exception(error):
+            # billiard reports task errors as ExceptionInfo, lost workers as exceptions
+            future.set_exception(error if isinstance(error, BaseException) else error.exception)
+
+        self._pool.apply_async(fn, args, kwargs, callback=future.set_result, error_callback=set_exception)
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        if cancel_futures:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        if wait:
+            self._pool.join()
+
+def make_pool_executor(max_workers):
+    """Executor for CPU-bound work: a pool of max_workers processes, usable from Celery workers too."""
+    return PoolExecutor(max_workers)
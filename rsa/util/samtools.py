@@ -1,45 +1,183 @@
 import os
+import shutil
+import functools
+import tempfile
 import subprocess
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 from rsa.models import Project, ProjectFiles
+from .resources import get_core_budget, get_memory_budget, get_scratch_dir
 
 logger = logging.getLogger(__name__)
 
-def run_samtools(project, input_files, output_dir):
+# Sorting in memory needs roughly this many bytes per byte of compressed BAM
+SORT_EXPANSION_FACTOR = 4
+SORT_MEMORY_FRACTION = 0.75
+SORT_MIN_MEMORY_PER_THREAD = 128 * 1024 * 1024
+
+def get_reference_fasta(species):
+    """Return the genome FASTA used as the CRAM reference for a species."""
+    species_to_fasta = {
+        'human': 'Homo_sapiens.GRCh38.dna.toplevel.fa',
+        'mouse': 'Mus_musculus.GRCm39.dna.toplevel.fa',
+        'yeast': 'Saccharomyces_cerevisiae.R64-1-1.dna.toplevel.fa',
+        'arabidopsis': 'Arabidopsis_thaliana.TAIR10.dna.toplevel.fa',
+        'worm': 'Caenorhabditis_elegans.WBcel235.dna.toplevel.fa',
+        'zebrafish': 'Danio_rerio.GRCz11.dna.primary_assembly.fa',
+        'fly': 'Drosophila_melanogaster.BDGP6.54.dna.toplevel.fa',
+        'rice': 'Oryza_sativa.IRGSP-1.0.dna.toplevel.fa',
+        'maize': 'Zea_mays.Zm-B73-REFERENCE-NAM-5.0.dna.toplevel.fa'
+    }
+    fasta_file = species_to_fasta.get(species.lower())
+    if not fasta_file:
+        logger.error(f"No reference FASTA defined for species: {species}")
+        raise RuntimeError(f"No reference FASTA defined for species: {species}")
+    fasta_path = os.path.join(settings.BASE_DIR, 'rsa', 'references', 'fasta', fasta_file)
+    if not os.path.exists(fasta_path):
+        logger.error(f"Reference FASTA not found: {fasta_path}")
+        raise RuntimeError(f"Reference FASTA not found: {fasta_path}")
+    return fasta_path
+
+def get_alignment_storage_format():
+    """Format retained alignments are stored in ('bam' or 'cram', from ALIGNMENT_STORAGE_FORMAT)."""
+    storage_format = getattr(settings, 'ALIGNMENT_STORAGE_FORMAT', 'bam').lower()
+    if storage_format not in ('bam', 'cram'):
+        raise RuntimeError(f"Unsupported alignment storage format: {storage_format}")
+    return storage_format
+
+def convert_to_cram(sorted_bam_output, fasta_path, threads=1):
+    """Compress a sorted BAM to CRAM against the reference FASTA and remove the BAM."""
+    cram_output = f"{os.path.splitext(sorted_bam_output)[0]}.cram"
+    cram_cmd = ['samtools', 'view', '-C', '-T', fasta_path, '-@', str(threads), '-o', cram_output, sorted_bam_output]
+    logger.debug(f"SAMtools CRAM command: {' '.join(cram_cmd)}")
+    try:
+        result = subprocess.run(cram_cmd, capture_output=True, text=True, check=True)
+        logger.info(f"CRAM conversion completed for {sorted_bam_output}: {cram_output}")
+    except subprocess.CalledProcessError as e:
+        if os.path.exists(cram_output):
+            os.remove(cram_output)
+        logger.error(f"SAMtools CRAM conversion failed for {sorted_bam_output}: {e.stderr}")
+        raise RuntimeError(f"SAMtools CRAM conversion failed: {e.stderr}")
+    os.remove(sorted_bam_output)
+    return cram_output
+
+def decode_cram(cram_path, species, output_bam, threads=1):
+    """Decode a CRAM file back to BAM using the species reference FASTA."""
+    decode_cmd = ['samtools', 'view', '-b', '-T', get_reference_fasta(species), '-@', str(threads), '-o', output_bam, cram_path]
+    logger.debug(f"SAMtools CRAM decode command: {' '.join(decode_cmd)}")
+    try:
+        result = subprocess.run(decode_cmd, capture_output=True, text=True, check=True)
+        logger.info(f"Decoded CRAM {cram_path} to {output_bam}")
+    except subprocess.CalledProcessError as e:
+        logger.error(f"SAMtools CRAM decode failed for {cram_path}: {e.stderr}")
+        raise RuntimeError(f"SAMtools CRAM decode failed: {e.stderr}")
+    return output_bam
+
+def get_reference_names(alignment_path):
+    """Reference sequence names (@SQ SN) in the header of a BAM or CRAM file."""
+    try:
+        result = subprocess.run(['samtools', 'view', '-H', alignment_path], capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Could not read header of {alignment_path}: {e.stderr}")
+        raise RuntimeError(f"Could not read alignment header: {e.stderr}")
+    names = []
+    for line in result.stdout.splitlines():
+        if line.startswith('@SQ'):
+            names.extend(field[3:] for field in line.split('\t') if field.startswith('SN:'))
+    return names
+
+def stream_alignment(alignment_path, species, regions=None, output_format='bam', chunk_size=1024 * 1024):
     """
-    Convert SAM files to sorted BAM files and generate index files using SAMtools.
-    
-    Args:
-        project: Project instance.
-        input_files: QuerySet of ProjectFiles (SAM files from HISAT2).
-        output_dir: Directory for SAMtools output (BAM and BAI files).
-    
+    Stream an alignment file (optionally restricted to regions) as BAM or CRAM bytes.
+
+    CRAM inputs are decoded against the species reference FASTA on the fly. The first chunk is
+    read before returning, so a SAMtools failure that ends the output early (e.g. an invalid
+    region or an undecodable CRAM) raises RuntimeError here instead of yielding an empty or
+    truncated file.
+
     Returns:
-        list: Paths to generated BAM files.
+        generator: Chunks of the alignment.
     """
-    os.makedirs(output_dir, exist_ok=True)
-    bam_files = []
-    
-    # Verify SAMtools is installed
+    stream_cmd = ['samtools', 'view', '-h', '-C' if output_format == 'cram' else '-b']
+    if alignment_path.endswith('.cram') or output_format == 'cram':
+        stream_cmd.extend(['-T', get_reference_fasta(species)])
+    stream_cmd.append(alignment_path)
+    stream_cmd.extend(regions or [])
+    logger.debug(f"SAMtools stream command: {' '.join(stream_cmd)}")
+    stderr_file = tempfile.TemporaryFile(dir=get_scratch_dir())
+    process = subprocess.Popen(stream_cmd, stdout=subprocess.PIPE, stderr=stderr_file)
+    first_chunk = process.stdout.read(chunk_size)
+    if len(first_chunk) < chunk_size and process.wait() != 0:
+        process.stdout.close()
+        stderr_file.seek(0)
+        error = stderr_file.read().decode(errors='replace').strip()
+        stderr_file.close()
+        logger.error(f"SAMtools stream failed for {alignment_path}: {error}")
+        raise RuntimeError(f"SAMtools stream failed: {error}")
+    return _stream_chunks(process, stderr_file, first_chunk, chunk_size, alignment_path)
+
+def _stream_chunks(process, stderr_file, first_chunk, chunk_size, alignment_path):
     try:
-        subprocess.run(['samtools', '--version'], capture_output=True, text=True, check=True)
-        logger.debug("SAMtools is installed and accessible")
+        chunk = first_chunk
+        while chunk:
+            yield chunk
+            chunk = process.stdout.read(chunk_size)
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        if process.returncode not in (0, -9):
+            stderr_file.seek(0)
+            logger.error(f"SAMtools stream failed for {alignment_path} with exit code {process.returncode}: "
+                         f"{stderr_file.read().decode(errors='replace').strip()}")
+        stderr_file.close()
+
+def is_coordinate_sorted(bam_path):
+    """Check the BAM header for SO:coordinate (set by batched HISAT2 alignment)."""
+    try:
+        result = subprocess.run(['samtools', 'view', '-H', bam_path], capture_output=True, text=True, check=True)
     except subprocess.CalledProcessError as e:
-        logger.error("SAMtools is not installed or not found in PATH")
-        raise RuntimeError("SAMtools is not installed or not found in PATH")
-    
-    for input_file in input_files:
-        sam_path = input_file.path
-        if not os.path.exists(sam_path):
-            logger.error(f"SAM file not found: {sam_path}")
-            raise RuntimeError(f"SAM file not found: {sam_path}")
-        
-        base_name = os.path.splitext(os.path.basename(sam_path))[0]
-        bam_output = os.path.join(output_dir, f"{base_name}.bam")
-        sorted_bam_output = os.path.join(output_dir, f"{base_name}.sorted.bam")
-        bai_output = f"{sorted_bam_output}.bai"
-        
+        logger.warning(f"Could not read header of {bam_path}: {e.stderr}")
+        return False
+    for line in result.stdout.splitlines():
+        if line.startswith('@HD'):
+            return 'SO:coordinate' in line.split('\t')
+    return False
+
+def get_sort_memory_per_thread(input_size, threads=1, memory_budget=None):
+    """
+    Size `samtools sort -m` so the whole input fits in memory when the budget allows.
+
+    Args:
+        input_size: Size in bytes of the (compressed) input to sort.
+        threads: Number of sort threads sharing the memory.
+        memory_budget: Bytes available to this sort (default: the worker's memory budget).
+
+    Returns:
+        str: Per-thread memory argument for `samtools sort -m` (e.g. '1536M').
+    """
+    if memory_budget is None:
+        memory_budget = get_memory_budget()
+    # samtools can overshoot -m, so only hand out part of the budget
+    available = int(memory_budget * SORT_MEMORY_FRACTION) // threads
+    needed = input_size * SORT_EXPANSION_FACTOR // threads
+    per_thread = max(SORT_MIN_MEMORY_PER_THREAD, min(available, needed))
+    return f"{per_thread // (1024 * 1024)}M"
+
+def _convert_and_sort(sam_path, sorted_bam_output, threads=1, memory_budget=None):
+    """
+    Convert SAM to BAM and coordinate-sort it.
+
+    Intermediate and temporary files are staged in the local scratch directory, and the sorted
+    BAM is moved into place once complete. Scratch files are removed even if a step fails.
+    """
+    base_name = os.path.splitext(os.path.basename(sam_path))[0]
+    work_dir = tempfile.mkdtemp(prefix=f"{base_name}_sort_", dir=get_scratch_dir())
+    bam_output = os.path.join(work_dir, f"{base_name}.bam")
+    staged_sorted_bam = os.path.join(work_dir, f"{base_name}.sorted.bam")
+    try:
         # Step 1: Convert SAM to BAM
         view_cmd = ['samtools', 'view', '-bS', sam_path, '-o', bam_output]
         logger.debug(f"SAMtools view command: {' '.join(view_cmd)}")
@@ -49,51 +187,154 @@ def run_samtools(project, input_files, output_dir):
         except subprocess.CalledProcessError as e:
             logger.error(f"SAMtools view failed for {sam_path}: {e.stderr}")
             raise RuntimeError(f"SAMtools view failed: {e.stderr}")
-        
+
         # Step 2: Sort BAM
-        sort_cmd = ['samtools', 'sort', bam_output, '-o', sorted_bam_output]
+        sort_memory = get_sort_memory_per_thread(os.path.getsize(bam_output), threads, memory_budget)
+        sort_cmd = [
+            'samtools', 'sort', bam_output, '-o', staged_sorted_bam,
+            '-m', sort_memory, '-@', str(threads),
+            '-T', os.path.join(work_dir, f"{base_name}.tmp")
+        ]
         logger.debug(f"SAMtools sort command: {' '.join(sort_cmd)}")
         try:
             result = subprocess.run(sort_cmd, capture_output=True, text=True, check=True)
-            logger.info(f"BAM sorting completed for {bam_output}: {sorted_bam_output}")
+            shutil.move(staged_sorted_bam, sorted_bam_output)
+            logger.info(f"BAM sorting completed for {sam_path}: {sorted_bam_output}")
         except subprocess.CalledProcessError as e:
             logger.error(f"SAMtools sort failed for {bam_output}: {e.stderr}")
             raise RuntimeError(f"SAMtools sort failed: {e.stderr}")
-        
-        # Step 3: Index sorted BAM
-        index_cmd = ['samtools', 'index', sorted_bam_output]
-        logger.debug(f"SAMtools index command: {' '.join(index_cmd)}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+@functools.lru_cache(maxsize=None)
+def check_samtools():
+    """Verify SAMtools is installed (checked once per worker process)."""
+    try:
+        result = subprocess.run(['samtools', '--version'], capture_output=True, text=True, check=True)
+        logger.debug("SAMtools is installed and accessible")
+        return result.stdout.splitlines()[0] if result.stdout else 'samtools'
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        logger.error("SAMtools is not installed or not found in PATH")
+        raise RuntimeError("SAMtools is not installed or not found in PATH")
+
+def index_alignment(alignment_path):
+    """Index a coordinate-sorted BAM (.bai) or CRAM (.crai) file and return the index path."""
+    index_output = f"{alignment_path}.crai" if alignment_path.endswith('.cram') else f"{alignment_path}.bai"
+    index_cmd = ['samtools', 'index', alignment_path]
+    logger.debug(f"SAMtools index command: {' '.join(index_cmd)}")
+    try:
+        result = subprocess.run(index_cmd, capture_output=True, text=True, check=True)
+        logger.info(f"Alignment indexing completed for {alignment_path}: {index_output}")
+    except subprocess.CalledProcessError as e:
+        logger.error(f"SAMtools index failed for {alignment_path}: {e.stderr}")
+        raise RuntimeError(f"SAMtools index failed: {e.stderr}")
+    return index_output
+
+def _sort_bam(sam_path, output_dir, threads, memory_budget):
+    """Produce the coordinate-sorted BAM for one alignment file and return its path."""
+    if not os.path.exists(sam_path):
+        logger.error(f"SAM file not found: {sam_path}")
+        raise RuntimeError(f"SAM file not found: {sam_path}")
+
+    base_name = os.path.splitext(os.path.basename(sam_path))[0]
+    sorted_bam_output = os.path.join(output_dir, f"{base_name}.sorted.bam")
+
+    # Already sorted BAMs (batched alignment) only need to be linked into place
+    if is_coordinate_sorted(sam_path):
+        if os.path.exists(sorted_bam_output):
+            os.remove(sorted_bam_output)
         try:
-            result = subprocess.run(index_cmd, capture_output=True, text=True, check=True)
-            logger.info(f"BAM indexing completed for {sorted_bam_output}: {bai_output}")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"SAMtools index failed for {sorted_bam_output}: {e.stderr}")
-            raise RuntimeError(f"SAMtools index failed: {e.stderr}")
-        
-        # Register sorted BAM and index files
+            os.link(sam_path, sorted_bam_output)
+        except OSError:
+            shutil.copyfile(sam_path, sorted_bam_output)
+        logger.info(f"Input already coordinate-sorted, skipped SAMtools sort for {sam_path}: {sorted_bam_output}")
+    else:
+        _convert_and_sort(sam_path, sorted_bam_output, threads=threads, memory_budget=memory_budget)
+    return sorted_bam_output
+
+def run_samtools(project, input_files, output_dir, on_bam_ready=None, core_budget=None):
+    """
+    Convert SAM files to sorted BAM files and generate index files using SAMtools.
+
+    Samples are sorted concurrently by a bounded worker pool sized from the core budget.
+    Each sorted BAM is indexed on a separate pool, so indexing overlaps with the next sort.
+    Outputs are registered in one batch once every sample has finished. With
+    ALIGNMENT_STORAGE_FORMAT = 'cram', sorted BAMs are kept as CRAM + .crai instead, and the
+    HISAT2 BAMs are removed (and unregistered) once converted, so no BAM copy is retained.
+    
+    Args:
+        project: Project instance.
+        input_files: QuerySet of ProjectFiles (SAM files from HISAT2).
+        output_dir: Directory for SAMtools output (BAM and BAI files).
+        on_bam_ready: Optional callable invoked with each sorted BAM/CRAM path as soon as it
+            is written (e.g. to start counting that sample while others are still sorting).
+        core_budget: Cores for sorting (default: the whole core budget); less when other work,
+            such as counting from on_bam_ready, runs alongside.
+    
+    Returns:
+        list: Paths to generated BAM files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    check_samtools()
+    storage_format = get_alignment_storage_format()
+    fasta_path = get_reference_fasta(project.species) if storage_format == 'cram' else None
+
+    sam_paths = [input_file.path for input_file in input_files]
+    if not sam_paths:
+        return []
+
+    # Split cores and memory evenly between concurrently sorted samples
+    core_budget = core_budget or get_core_budget()
+    workers = max(1, min(len(sam_paths), core_budget))
+    threads_per_sort = max(1, core_budget // workers)
+    memory_per_sort = get_memory_budget() // workers
+    logger.info(f"Processing {len(sam_paths)} BAM files with {workers} workers, {threads_per_sort} threads each")
+
+    def sort_and_queue_index(sam_path):
+        sorted_bam_output = _sort_bam(sam_path, output_dir, threads_per_sort, memory_per_sort)
+        if fasta_path:
+            sorted_bam_output = convert_to_cram(sorted_bam_output, fasta_path, threads_per_sort)
+            # The CRAM replaces the HISAT2 BAM too (batched alignment hard-links it as the sorted BAM)
+            os.remove(sam_path)
+            logger.info(f"Removed HISAT2 alignment {sam_path}, retained as {sorted_bam_output}")
+        if on_bam_ready:
+            on_bam_ready(sorted_bam_output)
+        return sorted_bam_output, index_pool.submit(index_alignment, sorted_bam_output)
+
+    with ThreadPoolExecutor(max_workers=workers) as index_pool:
+        with ThreadPoolExecutor(max_workers=workers) as sort_pool:
+            sort_futures = [sort_pool.submit(sort_and_queue_index, sam_path) for sam_path in sam_paths]
+            outputs = []
+            for future in sort_futures:
+                sorted_bam_output, index_future = future.result()
+                outputs.append((sorted_bam_output, index_future.result()))
+
+    # Register sorted BAM and index files
+    bam_files = []
+    registered_files = []
+    for sorted_bam_output, bai_output in outputs:
         for output_path, file_type in [
             (sorted_bam_output, 'samtools_bam'),
             (bai_output, 'samtools_bai')
         ]:
             if os.path.exists(output_path):
                 file_size = os.path.getsize(output_path) if os.path.isfile(output_path) else None
-                ProjectFiles.objects.create(
+                registered_files.append(ProjectFiles(
                     project=project,
                     type=file_type,
                     path=output_path,
                     is_directory=False,
                     file_format=output_path.split('.')[-1],
                     size=file_size
-                )
-                logger.info(f"Registered SAMtools output: {output_path} with size {file_size} bytes")
-                if output_path.endswith('.bam'):
+                ))
+                if file_type == 'samtools_bam':
                     bam_files.append(output_path)
             else:
                 logger.warning(f"SAMtools output not found: {output_path}")
-        
-        # Clean up unsorted BAM file
-        if os.path.exists(bam_output):
-            os.remove(bam_output)
-            logger.info(f"Removed unsorted BAM file: {bam_output}")
+    ProjectFiles.objects.bulk_create(registered_files)
+    logger.info(f"Registered {len(registered_files)} SAMtools outputs: {[f.path for f in registered_files]}")
+    if fasta_path:
+        input_files.filter(path__in=sam_paths).delete()
+        logger.info(f"Unregistered {len(sam_paths)} HISAT2 alignments replaced by CRAM")
     
     return bam_files
\ No newline at end of file
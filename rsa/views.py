@@ -1,14 +1,22 @@
 # rsa/views.py
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from django.http import FileResponse, JsonResponse
+from django.http import FileResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
 from .models import User, Project, ProjectFiles
 from .forms import RNAseekForm, DeseqMetadataForm
 from .tasks import run_rnaseek_pipeline
+from .util.samtools import stream_alignment, get_reference_names
+from .util.annotation import find_gene_region
+from .util.deseq2 import rethreshold_deseq2, rethreshold_heatmap_order, render_gsea_term_plot
+from .util.expression import query_expression
 import uuid
 import logging
 import os
+import math
+import re
 import csv
+import json
 import shutil
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
@@ -92,7 +100,8 @@ def home(request):
                         }.get(form.cleaned_data['genome_of_interest'], 'Unknown'),
                         pipeline_version='1.0.0',
                         sequencing_type=form.cleaned_data['sequencing_type'],
-                        pvalue_cutoff=form.cleaned_data['pvalue_cutoff']
+                        pvalue_cutoff=form.cleaned_data['pvalue_cutoff'],
+                        enrichment_mode=form.cleaned_data['enrichment_mode'] or 'gsea'
                     )
 
                     project_dir = os.path.join(settings.MEDIA_ROOT, 'r_fastq', str(session_id), str(project.id))
@@ -120,32 +129,33 @@ def home(request):
                         )
                         logger.info(f"Registered input FASTQ file: {file_path} with size {file_size} bytes")
 
-                        deseq_dir = os.path.join(settings.MEDIA_ROOT, 'deseq', str(session_id), str(project.id))
-                        os.makedirs(deseq_dir, exist_ok=True)
-                        metadata_path = os.path.join(deseq_dir, 'metadata.csv')
-                        with open(metadata_path, 'w', newline='') as csvfile:
-                            writer = csv.writer(csvfile)
-                            writer.writerow(['sample', 'condition'])
-                            for condition in sorted(grouped_samples.keys()):
-                                for sample_name in sorted(grouped_samples[condition]):
-                                    writer.writerow([sample_name, condition])
-                                    logger.debug(f"Writing grouped metadata: sample={sample_name}, condition={condition}")
-                            csvfile.flush()  # Ensure file is written
-                            os.fsync(csvfile.fileno())  # Force to disk
-                        if not os.path.isfile(metadata_path):
-                            logger.error(f"Metadata file not created: {metadata_path}")
-                            raise RuntimeError(f"Metadata file not created: {metadata_path}")
-                        file_size = os.path.getsize(metadata_path)
-                        total_size += file_size
-                        ProjectFiles.objects.create(
-                            project=project,
-                            type='deseq_metadata',
-                            path=metadata_path,
-                            is_directory=False,
-                            file_format='csv',
-                            size=file_size
-                        )
-                        logger.info(f"Registered DESeq2 metadata file: {metadata_path} with size {file_size} bytes")
+                    deseq_dir = os.path.join(settings.MEDIA_ROOT, 'deseq', str(session_id), str(project.id))
+                    os.makedirs(deseq_dir, exist_ok=True)
+                    metadata_path = os.path.join(deseq_dir, 'metadata.csv')
+                    grouped_samples = deseq_form.get_grouped_samples()
+                    with open(metadata_path, 'w', newline='') as csvfile:
+                        writer = csv.writer(csvfile)
+                        writer.writerow(['sample', 'condition'])
+                        for condition in sorted(grouped_samples.keys()):
+                            for sample_name in sorted(grouped_samples[condition]):
+                                writer.writerow([sample_name, condition])
+                                logger.debug(f"Writing grouped metadata: sample={sample_name}, condition={condition}")
+                        csvfile.flush()  # Ensure file is written
+                        os.fsync(csvfile.fileno())  # Force to disk
+                    if not os.path.isfile(metadata_path):
+                        logger.error(f"Metadata file not created: {metadata_path}")
+                        raise RuntimeError(f"Metadata file not created: {metadata_path}")
+                    file_size = os.path.getsize(metadata_path)
+                    total_size += file_size
+                    ProjectFiles.objects.create(
+                        project=project,
+                        type='deseq_metadata',
+                        path=metadata_path,
+                        is_directory=False,
+                        file_format='csv',
+                        size=file_size
+                    )
+                    logger.info(f"Registered DESeq2 metadata file: {metadata_path} with size {file_size} bytes")
 
                     project.project_size = total_size
                     project.save()
@@ -215,11 +225,11 @@ def example_analysis(request):
             'genome_of_interest': 'yeast',
             'sequencing_type': 'single',
             'pvalue_cutoff': 0.05,
+            'enrichment_mode': 'gsea',
             'example_analysis': 'true',  # Added to bypass files validation
         }
         deseq_data = {
-            'condition1': 'control',
-            'condition2': 'treatment',
+            'conditions': 'control, treatment',
             'condition_sample1_control': 'condition1',
             'condition_sample2_control': 'condition1',
             'condition_sample3_control': 'condition1',
@@ -263,7 +273,8 @@ def example_analysis(request):
             genome_reference='Saccharomyces cerevisiae (R64-1-1)',
             pipeline_version='1.0.0',
             sequencing_type=form.cleaned_data['sequencing_type'],
-            pvalue_cutoff=form.cleaned_data['pvalue_cutoff']
+            pvalue_cutoff=form.cleaned_data['pvalue_cutoff'],
+            enrichment_mode=form.cleaned_data['enrichment_mode'] or 'gsea'
         )
 
         project_dir = os.path.join(settings.MEDIA_ROOT, 'r_fastq', str(session_id), str(project.id))
@@ -294,13 +305,13 @@ def example_analysis(request):
         with open( metadata_path, 'w', newline='') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(['sample', 'condition'])
-            writer.writerow(['sample1_control', deseq_data['condition1']])
-            writer.writerow(['sample2_control', deseq_data['condition1']])
-            writer.writerow(['sample3_control', deseq_data['condition1']])
-            writer.writerow(['sample4_treatment', deseq_data['condition2']])
-            writer.writerow(['sample5_treatment', deseq_data['condition2']])
-            writer.writerow(['sample6_treatment', deseq_data['condition2']])
-            writer.writerow(['sample7_treatment', deseq_data['condition2']])
+            writer.writerow(['sample1_control', deseq_form.condition_names[0]])
+            writer.writerow(['sample2_control', deseq_form.condition_names[0]])
+            writer.writerow(['sample3_control', deseq_form.condition_names[0]])
+            writer.writerow(['sample4_treatment', deseq_form.condition_names[1]])
+            writer.writerow(['sample5_treatment', deseq_form.condition_names[1]])
+            writer.writerow(['sample6_treatment', deseq_form.condition_names[1]])
+            writer.writerow(['sample7_treatment', deseq_form.condition_names[1]])
             logger.debug(f"Created metadata CSV at {metadata_path}")
             csvfile.flush()  # Ensure file is written
             os.fsync(csvfile.fileno())  # Force to disk
@@ -372,13 +383,22 @@ def project_detail(request, project_id):
     try:
         user = User.objects.get(session_id=session_id)
         project = get_object_or_404(Project, id=project_id, user=user)
-        if project.status != 'completed':
+        # DE results are viewable as soon as they are ready; enrichment results follow
+        if project.status not in ('completed', 'de_ready'):
             messages.warning(request, "Project analysis is not yet completed.")
             return redirect('results')
         files = ProjectFiles.objects.filter(project=project).exclude(
             Q(type__in=['samtools_bam', 'samtools_bai']) |
             Q(type='fastqc_output', file_format__in=['txt', 'html'])
         ).order_by('created_at')
+
+        # Indexed alignments of the samples, downloadable whole or sliced by region
+        alignment_files = sorted(
+            ((os.path.basename(f.path).split('.sorted.')[0], f)
+             for f in ProjectFiles.objects.filter(project=project, type='samtools_bam')),
+            key=lambda item: item[0]
+        )
+        alignment_samples = [sample for sample, _ in alignment_files]
         
         # Read metadata.csv
         metadata_content = None
@@ -410,10 +430,10 @@ def project_detail(request, project_id):
             logger.error(f"Error reading deseq_output.csv for project {project.id}: {str(e)}")
             deseq_output_content = []
 
-        # Read go_gsea_results.csv
+        # Read go_gsea_results.csv (go_ora_results.csv for over-representation projects)
         go_gsea_output_content = None
         try:
-            go_gsea_output_file = ProjectFiles.objects.get(project=project, type='go_gsea_output')
+            go_gsea_output_file = ProjectFiles.objects.get(project=project, type__in=['go_gsea_output', 'go_ora_output'])
             with open(go_gsea_output_file.path, 'r') as csvfile:
                 reader = csv.reader(csvfile)
                 go_gsea_output_content = list(reader)[:6]  # Limit to first 5 rows + header for preview
@@ -425,10 +445,10 @@ def project_detail(request, project_id):
             logger.error(f"Error reading go_gsea_results.csv for project {project.id}: {str(e)}")
             go_gsea_output_content = []
 
-        # Read kegg_gsea_results.csv
+        # Read kegg_gsea_results.csv (kegg_ora_results.csv for over-representation projects)
         kegg_gsea_output_content = None
         try:
-            kegg_gsea_output_file = ProjectFiles.objects.get(project=project, type='kegg_gsea_output')
+            kegg_gsea_output_file = ProjectFiles.objects.get(project=project, type__in=['kegg_gsea_output', 'kegg_ora_output'])
             with open(kegg_gsea_output_file.path, 'r') as csvfile:
                 reader = csv.reader(csvfile)
                 kegg_gsea_output_content = list(reader)[:6]  # Limit to first 5 rows + header for preview
@@ -440,13 +460,27 @@ def project_detail(request, project_id):
             logger.error(f"Error reading kegg_gsea_results.csv for project {project.id}: {str(e)}")
             kegg_gsea_output_content = []
 
+        # Read deseq2_summary.json for the genes tested and removed by the prefilter
+        deseq2_summary = None
+        try:
+            deseq2_summary_file = ProjectFiles.objects.get(project=project, type='deseq2_summary')
+            with open(deseq2_summary_file.path, 'r') as jsonfile:
+                deseq2_summary = json.load(jsonfile)
+        except ProjectFiles.DoesNotExist:
+            logger.warning(f"No deseq2_summary.json found for project {project.id}")
+        except Exception as e:
+            logger.error(f"Error reading deseq2_summary.json for project {project.id}: {str(e)}")
+
         return render(request, 'project_detail.html', {
             'project': project,
             'files': files,
+            'deseq2_summary': deseq2_summary,
             'metadata_content': metadata_content,
             'deseq_output_content': deseq_output_content,
             'go_gsea_output_content': go_gsea_output_content,
-            'kegg_gsea_output_content': kegg_gsea_output_content
+            'kegg_gsea_output_content': kegg_gsea_output_content,
+            'alignment_samples': alignment_samples,
+            'alignment_files': alignment_files
         })
     except User.DoesNotExist:
         messages.error(request, "Invalid session. Please start a new session.")
@@ -471,8 +505,18 @@ def download_file(request, file_id):
             messages.error(request, "File not found.")
             return redirect('project_detail', project_id=project_file.project.id)
 
-        file = open(file_path, 'rb')
         file_name = os.path.basename(file_path)
+        # CRAM alignments are decoded to BAM on demand for tools that cannot read CRAM
+        if project_file.file_format == 'cram' and request.GET.get('format') == 'bam':
+            response = StreamingHttpResponse(
+                stream_alignment(file_path, project_file.project.species, output_format='bam'),
+                content_type='application/octet-stream'
+            )
+            response['Content-Disposition'] = f'attachment; filename="{os.path.splitext(file_name)[0]}.bam"'
+            logger.info(f"Streaming CRAM {file_name} as BAM for project {project_file.project.id}")
+            return response
+
+        file = open(file_path, 'rb')
         response = FileResponse(file, as_attachment=True, filename=file_name)
         logger.info(f"Serving file: {file_name} for project {project_file.project.id}")
         return response
@@ -482,4 +526,182 @@ def download_file(request, file_id):
     except Exception as e:
         logger.error(f"Error serving file {file_id}: {str(e)}")
         messages.error(request, "An error occurred while downloading the file.")
-        return redirect('project_detail', project_id=project_file.project.id)
\ No newline at end of file
+        return redirect('project_detail', project_id=project_file.project.id)
+
+def download_region(request, project_id):
+    session_id = request.COOKIES.get('session_id')
+    if not session_id:
+        logger.error("No session_id provided for region download")
+        raise PermissionDenied("Session expired. Please start a new session.")
+
+    try:
+        user = User.objects.get(session_id=session_id)
+        project = get_object_or_404(Project, id=project_id, user=user)
+        sample = request.GET.get('sample', '').strip()
+        region = request.GET.get('region', '').strip()
+        gene = request.GET.get('gene', '').strip()
+        if not sample or not (region or gene):
+            return JsonResponse({'error': 'A sample and a region or gene are required'}, status=400)
+
+        alignment_file = next((
+            f for f in ProjectFiles.objects.filter(project=project, type='samtools_bam')
+            if os.path.basename(f.path).split('.sorted.')[0] == sample
+        ), None)
+        if not alignment_file or not os.path.exists(alignment_file.path):
+            logger.error(f"No alignment found for sample {sample} in project {project.id}")
+            return JsonResponse({'error': f"No alignment found for sample {sample}"}, status=404)
+        index_path = f"{alignment_file.path}.crai" if alignment_file.file_format == 'cram' else f"{alignment_file.path}.bai"
+        if not os.path.exists(index_path):
+            logger.error(f"Alignment index not found: {index_path}")
+            return JsonResponse({'error': f"Alignment index not found for sample {sample}"}, status=404)
+
+        if gene:
+            region = find_gene_region(project.species, gene)
+            if not region:
+                return JsonResponse({'error': f"Gene {gene} not found in the {project.species} annotation"}, status=404)
+        elif not re.match(r'^[\w.\-|]+(:[\d,]+(-[\d,]+)?)?$', region):
+            return JsonResponse({'error': f"Invalid region: {region}"}, status=400)
+        region = region.replace(',', '')
+        if region.split(':')[0] not in get_reference_names(alignment_file.path):
+            return JsonResponse({'error': f"Unknown reference sequence in region: {region}"}, status=404)
+
+        file_name = f"{sample}_{gene or re.sub(r'[:-]', '_', region)}.bam"
+        response = StreamingHttpResponse(
+            stream_alignment(alignment_file.path, project.species, regions=[region], output_format='bam'),
+            content_type='application/octet-stream'
+        )
+        response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+        logger.info(f"Streaming region {region} of sample {sample} for project {project.id}")
+        return response
+    except User.DoesNotExist:
+        logger.error("Invalid session_id for region download")
+        raise PermissionDenied("Invalid session. Please start a new session.")
+    except RuntimeError as e:
+        logger.error(f"Error serving region for project {project_id}: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+def rethreshold_results(request, project_id):
+    session_id = request.COOKIES.get('session_id')
+    if not session_id:
+        logger.error("No session_id provided for re-thresholding")
+        raise PermissionDenied("Session expired. Please start a new session.")
+
+    try:
+        user = User.objects.get(session_id=session_id)
+        project = get_object_or_404(Project, id=project_id, user=user)
+        try:
+            padj_cutoff = float(request.GET.get('padj') or project.pvalue_cutoff)
+            log2fc_cutoff = float(request.GET.get('log2fc') or 1.0)
+            base_mean_cutoff = float(request.GET.get('base_mean') or 10.0)
+        except ValueError:
+            return JsonResponse({'error': 'Thresholds must be numbers'}, status=400)
+        if not all(math.isfinite(cutoff) for cutoff in (padj_cutoff, log2fc_cutoff, base_mean_cutoff)):
+            return JsonResponse({'error': 'Thresholds must be finite numbers'}, status=400)
+        if not 0.0 < padj_cutoff <= 1.0 or log2fc_cutoff < 0.0 or base_mean_cutoff < 0.0:
+            return JsonResponse({'error': 'padj must be in (0, 1]; log2fc and base_mean must not be negative'}, status=400)
+
+        full_output = ProjectFiles.objects.filter(project=project, type='deseq2_full_output').first()
+        if not full_output or not os.path.exists(full_output.path):
+            logger.error(f"No full DESeq2 results found for project {project.id}")
+            return JsonResponse({'error': 'No DESeq2 results found for this project'}, status=404)
+
+        summary = rethreshold_deseq2(project, os.path.dirname(full_output.path),
+                                     padj_cutoff, log2fc_cutoff, base_mean_cutoff)
+        requested_file = request.GET.get('file')
+        if requested_file == 'csv':
+            return FileResponse(open(summary['results'], 'rb'), as_attachment=True,
+                                filename=f"deseq2_results_padj{padj_cutoff:g}_lfc{log2fc_cutoff:g}_basemean{base_mean_cutoff:g}.csv")
+        if requested_file == 'heatmap':
+            if not summary['heatmap']:
+                return JsonResponse({'error': 'No genes pass these thresholds'}, status=404)
+            return FileResponse(open(summary['heatmap'], 'rb'), content_type='image/png')
+        if requested_file == 'heatmap_order':
+            order_file = rethreshold_heatmap_order(os.path.dirname(full_output.path), summary)
+            if not order_file:
+                return JsonResponse({'error': 'No genes pass these thresholds'}, status=404)
+            return FileResponse(open(order_file, 'rb'), as_attachment=True,
+                                filename=f"heatmap_order_padj{padj_cutoff:g}_lfc{log2fc_cutoff:g}_basemean{base_mean_cutoff:g}.csv")
+
+        query = f"padj={padj_cutoff!r}&log2fc={log2fc_cutoff!r}&base_mean={base_mean_cutoff!r}"
+        url = reverse('rethreshold_results', args=[project.id])
+        return JsonResponse({
+            'padj': padj_cutoff,
+            'log2fc': log2fc_cutoff,
+            'base_mean': base_mean_cutoff,
+            'n_genes': summary['n_genes'],
+            'results_url': f"{url}?{query}&file=csv",
+            'heatmap_url': f"{url}?{query}&file=heatmap" if summary['heatmap'] else None,
+            'heatmap_order_url': f"{url}?{query}&file=heatmap_order" if summary['heatmap'] else None,
+        })
+    except User.DoesNotExist:
+        logger.error("Invalid session_id for re-thresholding")
+        raise PermissionDenied("Invalid session. Please start a new session.")
+    except RuntimeError as e:
+        logger.error(f"Error re-thresholding results for project {project_id}: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+def expression_query(request, project_id):
+    session_id = request.COOKIES.get('session_id')
+    if not session_id:
+        logger.error("No session_id provided for expression query")
+        raise PermissionDenied("Session expired. Please start a new session.")
+
+    try:
+        user = User.objects.get(session_id=session_id)
+        project = get_object_or_404(Project, id=project_id, user=user)
+        genes = [gene.strip() for gene in request.GET.get('genes', '').split(',') if gene.strip()]
+        scale = request.GET.get('scale', 'normalized')
+        if not genes:
+            return JsonResponse({'error': 'At least one gene ID or symbol is required'}, status=400)
+        if len(genes) > 5000:
+            return JsonResponse({'error': 'At most 5000 genes can be queried at once'}, status=400)
+        if scale not in ('normalized', 'log'):
+            return JsonResponse({'error': "scale must be 'normalized' or 'log'"}, status=400)
+
+        full_output = ProjectFiles.objects.filter(project=project, type='deseq2_full_output').first()
+        expression = query_expression(os.path.dirname(full_output.path), genes, scale) if full_output else None
+        if expression is None:
+            logger.error(f"No normalized expression found for project {project.id}")
+            return JsonResponse({'error': 'No normalized expression found for this project'}, status=404)
+        return JsonResponse(expression)
+    except User.DoesNotExist:
+        logger.error("Invalid session_id for expression query")
+        raise PermissionDenied("Invalid session. Please start a new session.")
+
+def project_status(request, project_id):
+    session_id = request.COOKIES.get('session_id')
+    if not session_id:
+        logger.error("No session_id provided for project status")
+        raise PermissionDenied("Session expired. Please start a new session.")
+
+    try:
+        user = User.objects.get(session_id=session_id)
+        project = get_object_or_404(Project, id=project_id, user=user)
+        return JsonResponse({'project_id': str(project.id), 'status': project.status})
+    except User.DoesNotExist:
+        logger.error("Invalid session_id for project status")
+        raise PermissionDenied("Invalid session. Please start a new session.")
+
+def gsea_term_plot(request, project_id):
+    session_id = request.COOKIES.get('session_id')
+    if not session_id:
+        logger.error("No session_id provided for GSEA term plot")
+        raise PermissionDenied("Session expired. Please start a new session.")
+
+    try:
+        user = User.objects.get(session_id=session_id)
+        project = get_object_or_404(Project, id=project_id, user=user)
+        gmt_type = request.GET.get('gmt', '')
+        term = request.GET.get('term', '').strip()
+        if gmt_type not in ('go', 'kegg') or not term:
+            return JsonResponse({'error': "gmt must be 'go' or 'kegg' and a term is required"}, status=400)
+
+        full_output = ProjectFiles.objects.filter(project=project, type='deseq2_full_output').first()
+        plot_path = render_gsea_term_plot(project, os.path.dirname(full_output.path), gmt_type, term) if full_output else None
+        if plot_path is None:
+            logger.error(f"No {gmt_type.upper()} GSEA plot for term {term} in project {project.id}")
+            return JsonResponse({'error': 'No GSEA result found for this term'}, status=404)
+        return FileResponse(open(plot_path, 'rb'), content_type='application/pdf')
+    except User.DoesNotExist:
+        logger.error("Invalid session_id for GSEA term plot")
+        raise PermissionDenied("Invalid session. Please start a new session.")
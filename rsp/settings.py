@@ -63,6 +63,43 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 
+# Pipeline settings
+# Projects whose alignment inputs total at most this many bytes are aligned by a single
+# HISAT2 process and demultiplexed into per-sample BAMs (set to 0 to disable)
+HISAT2_BATCH_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
+# Cores and memory (MB) a pipeline worker may use; None detects them from the host
+PIPELINE_THREADS = None
+PIPELINE_MEMORY_MB = None
+# Fast local disk for temporary files such as samtools sort spills; None uses the system temp dir
+PIPELINE_SCRATCH_DIR = None
+# Storage format for retained alignments: 'bam' (BAM + .bai) or 'cram' (CRAM + .crai, referenced
+# against the species FASTA in rsa/references/fasta)
+ALIGNMENT_STORAGE_FORMAT = 'bam'
+# Count each sample with its own featureCounts job as soon as its BAM is sorted, then merge
+FEATURECOUNTS_SHARDED = True
+# DESeq2 prefilter: keep genes with at least DESEQ2_PREFILTER_MIN_COUNT reads in at least
+# DESEQ2_PREFILTER_MIN_SAMPLES samples (None: smallest condition group; a min count of 0 disables it)
+DESEQ2_PREFILTER_MIN_COUNT = 10
+DESEQ2_PREFILTER_MIN_SAMPLES = None
+# Re-threshold results kept per project (least recently used threshold combinations are removed first)
+RETHRESHOLD_CACHE_MAX = 20
+# Workers of the plot render service (PCA, heatmap, volcano and MA plots render alongside enrichment)
+PLOT_RENDER_WORKERS = 2
+# Clustered heatmap: at most HEATMAP_MAX_GENES genes (None: all), the top ones by 'padj' or 'log2fc'
+# (HEATMAP_RANK_BY); axes with more than HEATMAP_MAX_LABELS entries are drawn without labels
+HEATMAP_MAX_GENES = 500
+HEATMAP_RANK_BY = 'padj'
+HEATMAP_MAX_LABELS = 100
+# The heatmap_order.csv clustering order covers at most the top HEATMAP_ORDER_MAX_GENES genes, as
+# average linkage needs memory quadratic in the number of genes (5000 genes: about 100 MB)
+HEATMAP_ORDER_MAX_GENES = 5000
+# GSEA prerank engine: 'numpy' (batched in-project engine, rsa/util/gsea.py) or 'gseapy'
+GSEA_ENGINE = 'numpy'
+# Gene permutations for the GSEA null distribution (NOM p-val, FDR q-val)
+GSEA_PERMUTATIONS = 1000
+# Enrichment plots rendered into the combined GSEA PDF (top terms by |NES|); the others render on demand
+GSEA_PLOT_TOP_N = 20
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',